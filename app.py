@@ -1,374 +1,83 @@
 import os
+import sys
 import subprocess
 import tempfile
-import uuid
-import base64
+import hashlib
 import json
+import time
+import threading
 from datetime import datetime
 from flask import Flask, request, render_template, jsonify, send_file
 from werkzeug.utils import secure_filename
-from openai import OpenAI
-from denoise_pipeline import run_denoise
-from PIL import Image
-from math_chatbot import math_engine, format_reply
+# denoise_pipeline (cv2, numpy), math_chatbot (SymPy) and PIL are imported by the routes that use them,
+# so the server starts (and the debug reloader restarts) without loading them; see warm_up()
+from job_queue import JobQueue, QueueFull
+from latex_compile import CompilePool, CompileQueueFull
+from llm_client import get_client
+from pipeline import (DOCS_DIR, COMPILE_WORKERS, COMPILE_QUEUE_SIZE, allowed_file, read_image, denoise_images,
+                      transcribe_images, save_note, compile_note, latex_compiler, note_catalog)
+import metrics
+import shared_state
+from metrics import span, record
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.config['UPLOAD_FOLDER'] = tempfile.gettempdir()
 
 # =============== CONFIG ===============
-DOCS_DIR = "notes_out"
 FEEDBACK_DIR = "notes_feedback"
-MODEL_NAME = "gpt-4o"  # OpenAI GPT-4o with vision capabilities
-API_KEY = os.environ.get("OPENAI_API_KEY") or os.environ.get("DEEPSEEK_API_KEY") or "sk-your-key-here"
-BASE_URL = None  # None uses default OpenAI endpoint
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", 2))  # concurrent pipeline runs
+UPLOAD_QUEUE_SIZE = int(os.environ.get("UPLOAD_QUEUE_SIZE", 8))  # waiting jobs before /upload answers 429
+HISTORY_PAGE_SIZE = 100
+HISTORY_MAX_PAGE_SIZE = 500
+FILE_OFFLOAD = os.environ.get("FILE_OFFLOAD", "")  # x-accel (nginx) | x-sendfile (Apache, lighttpd): the proxy sends note files
+FILE_ACCEL_PREFIX = os.environ.get("FILE_ACCEL_PREFIX", "/_notes/")  # nginx internal location aliasing DOCS_DIR
+NOTE_FILE_MAX_AGE = 365 * 24 * 3600  # versioned note URLs (?v=<content hash>) never change
+APP_WARMUP = os.environ.get("APP_WARMUP", "1") != "0"  # load cv2, SymPy and the LLM client in the background at startup
+LAZY_MODULES = ("denoise_pipeline", "math_chatbot", "PIL.Image", "openai")  # imported on first use
 # ======================================
 
-os.makedirs(DOCS_DIR, exist_ok=True)
 os.makedirs(FEEDBACK_DIR, exist_ok=True)
 
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
-
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
-
-def encode_image_to_base64(image_path):
-    """Encode an image file to base64 string for vision API"""
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
-
-def get_image_mime_type(image_path):
-    """Determine MIME type based on file extension"""
-    ext = image_path.lower().split('.')[-1]
-    mime_types = {
-        'jpg': 'image/jpeg',
-        'jpeg': 'image/jpeg',
-        'png': 'image/png',
-        'gif': 'image/gif',
-        'bmp': 'image/bmp',
-        'webp': 'image/webp'
-    }
-    return mime_types.get(ext, 'image/jpeg')
+upload_jobs = JobQueue(workers=UPLOAD_WORKERS, max_queued=UPLOAD_QUEUE_SIZE, store=shared_state.store)
+compile_pool = CompilePool(latex_compiler, workers=COMPILE_WORKERS, max_queued=COMPILE_QUEUE_SIZE)
 
-def process_images_to_latex(image_paths):
+def process_images_to_latex(images, progress=None, use_cache=True, on_delta=None, denoise_profile=None):
     """
     Process multiple images through the full pipeline: denoise -> GPT-4o Vision -> LaTeX
     Sends images directly to GPT-4o vision API instead of using OCR.
     Combines all images into a single LaTeX document.
+    `images` are the raw uploaded image bytes (file paths are read from disk).
     Returns the LaTeX source code and paths to generated files.
+    `progress(stage, status, detail=None)` is called as each stage starts and ends.
+    use_cache=False skips the transcription cache lookup (the fresh result still refreshes it).
+    on_delta(text) streams the raw LaTeX as it is generated; clean-up runs once on the full document.
+    denoise_profile overrides DENOISE_PROFILE (fast, quality or auto).
     """
-    # Create a temporary processed directory for this session
-    session_id = str(uuid.uuid4())
-    processed_dir = os.path.join(tempfile.gettempdir(), f"lecture_processed_{session_id}")
-    os.makedirs(processed_dir, exist_ok=True)
-    
-    try:
-        enhanced_images = []
-        
-        # Process each image through denoise pipeline
-        for idx, image_path in enumerate(image_paths):
-            print(f"[INFO] Processing image {idx + 1}/{len(image_paths)}...")
-            
-            # Step 1: Run denoise pipeline
-            paths = run_denoise(in_path=image_path, processed_dir=processed_dir)
-            enh_path = paths["enhanced"]
-            print(f"[INFO] Enhanced image saved: {enh_path}")
-            enhanced_images.append(enh_path)
-
-        print(f"[INFO] Enhanced {len(enhanced_images)} images. Preparing for GPT-4o vision API...")
-
-        # Generate meaningful filename with date/time
-        now = datetime.now()
-        date_str = now.strftime('%Y-%m-%d_%H-%M-%S')
-        if len(image_paths) > 1:
-            note_name = f"notes_{date_str}_multi{len(image_paths)}"
-        else:
-            note_name = f"notes_{date_str}"
-
-        # Step 2: Prepare images and call GPT-4o vision API
-        if BASE_URL:
-            client = OpenAI(api_key=API_KEY, base_url=BASE_URL)
-        else:
-            client = OpenAI(api_key=API_KEY)  # Use default OpenAI endpoint
-
-        system_prompt = (
-            "You are a LaTeX math transcription AND explanation assistant using GPT-4o vision capabilities. "
-            "You will be given images of handwritten mathematics from a blackboard. "
-            "Your task is to carefully analyze the images, understand the mathematical content, and "
-            "produce a polished, structured LaTeX article with detailed explanations.\n\n"
-
-            "=== CORE TASKS ===\n"
-            "1. Carefully examine the images and transcribe all mathematical content into proper LaTeX.\n"
-            "2. Add clear explanatory text (in full sentences) before or after each major step, "
-            "suitable for an advanced undergraduate or beginning graduate student.\n"
-            "3. Preserve all important equations, derivations, and logical structure.\n"
-            "4. Interpret handwritten symbols, equations, and mathematical notation accurately using your vision capabilities.\n\n"
-
-            "=== STRICT LATEX RULES ===\n"
-            "• Every mathematical symbol or expression MUST be in math mode.\n"
-            "  – Inline math → \\( ... \\)\n"
-            "  – Display math → \\[ ... \\]\n"
-            "• Never leave raw math symbols in text (e.g. x^2, sum, int, a/b).\n"
-            "• Use correct LaTeX operators: \\ker, \\operatorname{Gal}, \\Hom, \\bQ, \\bZ, \\mod, \\leq, etc.\n"
-            "• Use standard formatting for groups, fields, cosets, cyclotomic extensions, etc.\n"
-            "• No markdown code fences. ONLY pure LaTeX.\n\n"
-
-            "=== DOCUMENT STRUCTURE ===\n"
-            "• Output a complete LaTeX document:\n"
-            "  \\documentclass[12pt]{article}\n"
-            "  \\usepackage{amsmath, amssymb, amsfonts, amsthm}\n"
-            "  ...\n"
-            "  \\begin{document}\n"
-            "  ... content ...\n"
-            "  \\end{document}\n"
-            "• Use sections, subsections, and paragraphs to organize the material.\n"
-            "• You may use environments such as theorem, definition, remark, proof, itemize, or enumerate.\n"
-            "• Explanations must also follow the strict math-mode rules when referencing symbols.\n\n"
-
-            "=== STYLE REQUIREMENTS ===\n"
-            "Your output should resemble a clean textbook or research monograph style similar to "
-            "graduate-level algebraic number theory literature. "
-            "Ensure consistent math-mode usage, operator spacing, and paragraph structure.\n\n"
-
-            "If something in an image is ambiguous or unreadable, include a LaTeX comment '% unclear'.\n"
-            "Output ONLY LaTeX, with no markdown and no external commentary."
-        )
-        
-        # Build the user message content with text and images (OpenAI vision format)
-        user_content = []
-        
-        # Add text instruction
-        if len(enhanced_images) == 1:
-            instruction_text = (
-                "Please analyze this image of handwritten mathematics from a blackboard using your vision capabilities. "
-                "Transcribe all mathematical content into clean LaTeX, using article class with packages: amsmath and amssymb. "
-                "Insert detailed explanations and commentary in LaTeX so that a reader can follow the reasoning.\n\n"
-                "You should keep the original mathematical content and derivations, but you are encouraged to:\n"
-                "• Organize the material with sections/subsections,\n"
-                "• Add short explanatory paragraphs around each important formula or step, and\n"
-                "• Clarify the meaning of symbols and assumptions when they are implicit.\n"
-                "• Include \\usepackage{amsmath} and \\usepackage{amssymb} in the preamble."
-            )
-        else:
-            instruction_text = (
-                f"Please analyze these {len(enhanced_images)} images of handwritten mathematics from a blackboard using your vision capabilities. "
-                "They may be part of a sequence of related content. "
-                "Transcribe all mathematical content from all images into a single coherent LaTeX document, "
-                "using article class with packages: amsmath and amssymb. "
-                "Insert detailed explanations and commentary in LaTeX so that a reader can follow the reasoning.\n\n"
-                "You should keep the original mathematical content and derivations, but you are encouraged to:\n"
-                "• Combine all images into a single coherent document,\n"
-                "• Organize the material with sections/subsections,\n"
-                "• Add short explanatory paragraphs around each important formula or step, and\n"
-                "• Clarify the meaning of symbols and assumptions when they are implicit.\n"
-                "• Include \\usepackage{amsmath} and \\usepackage{amssymb} in the preamble."
-            )
-        
-        user_content.append({"type": "text", "text": instruction_text})
-        
-        # Add each enhanced image
-        for idx, enh_path in enumerate(enhanced_images):
-            print(f"[INFO] Encoding image {idx + 1}/{len(enhanced_images)} for vision API...")
-            base64_image = encode_image_to_base64(enh_path)
-            mime_type = get_image_mime_type(enh_path)
-            
-            user_content.append({
-                "type": "image_url",
-                "image_url": {
-                    "url": f"data:{mime_type};base64,{base64_image}"
-                }
-            })
-            
-            if len(enhanced_images) > 1 and idx < len(enhanced_images) - 1:
-                # Add separator text between images
-                user_content.append({
-                    "type": "text",
-                    "text": f"\n--- End of Image {idx + 1} / {len(enhanced_images)} ---\n"
-                })
-
-        print(f"[INFO] Sending {len(enhanced_images)} image(s) to GPT-4o vision API...")
-        
-        response = client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_content},
-            ],
-            stream=False,
-        )
-
-        latex_source = response.choices[0].message.content
-        print("[INFO] LLM returned LaTeX.")
-
-        # Clean up markdown code fences if present
-        if latex_source.strip().startswith("```"):
-            latex_source = latex_source.strip().strip("`")
-            if latex_source.startswith("latex"):
-                latex_source = latex_source[5:].strip()
-            if latex_source.startswith("\n"):
-                latex_source = latex_source[1:]
-        
-        # Ensure document has proper structure (only fix if clearly broken)
-        if "\\documentclass" not in latex_source:
-            # Missing document class - wrap the content
-            latex_source = "\\documentclass{article}\n\\usepackage{amsmath}\n\\usepackage{amssymb}\n\\begin{document}\n" + latex_source + "\n\\end{document}"
-        else:
-            # Ensure amssymb package is included (needed for symbols like \lhd, \rhd, etc.)
-            if "\\usepackage{amssymb}" not in latex_source and "\\usepackage{amsmath}" in latex_source:
-                latex_source = latex_source.replace("\\usepackage{amsmath}", "\\usepackage{amsmath}\n\\usepackage{amssymb}")
-            elif "\\usepackage{amssymb}" not in latex_source:
-                # Add both packages if neither exists
-                if "\\begin{document}" in latex_source:
-                    latex_source = latex_source.replace("\\begin{document}", "\\usepackage{amsmath}\n\\usepackage{amssymb}\n\\begin{document}")
-                else:
-                    # Add before \documentclass if structure is unusual
-                    if "\\documentclass" in latex_source:
-                        docclass_pos = latex_source.find("\\documentclass")
-                        next_line = latex_source.find("\n", docclass_pos)
-                        if next_line != -1:
-                            latex_source = latex_source[:next_line+1] + "\\usepackage{amsmath}\n\\usepackage{amssymb}\n" + latex_source[next_line+1:]
-            
-            if "\\begin{document}" not in latex_source and "\\end{document}" in latex_source:
-                # Has end but no begin - insert begin before end
-                latex_source = latex_source.replace("\\end{document}", "\\begin{document}\n\\end{document}")
-            elif "\\end{document}" not in latex_source and "\\begin{document}" in latex_source:
-                # Has begin but no end - add end
-                latex_source = latex_source + "\n\\end{document}"
-
-        # Step 4: Save LaTeX file
-        tex_path = os.path.join(DOCS_DIR, f"{note_name}.tex")
-        with open(tex_path, "w") as f:
-            f.write(latex_source)
-        print(f"[INFO] Wrote LaTeX to {tex_path}")
-
-        # Step 5: Compile to PDF (optional, may fail if LaTeX not installed)
-        pdf_path = None
-        compilation_error = None
-        
-        # Try latexmk first
-        try:
-            result = subprocess.run(
-                ["latexmk", "-pdf", "-interaction=nonstopmode", f"{note_name}.tex", f"-outdir={DOCS_DIR}"],
-                check=True,
-                cwd=DOCS_DIR,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                timeout=60,
-            )
-            # latexmk with -outdir creates a subdirectory, check both locations with retry
-            import time
-            pdf_path = None
-            for attempt in range(3):
-                # Check main directory first
-                main_path = os.path.join(DOCS_DIR, f"{note_name}.pdf")
-                if os.path.exists(main_path):
-                    pdf_path = main_path
-                    break
-                # Check subdirectory (latexmk sometimes creates notes_out/notes_out/)
-                subdir_path = os.path.join(DOCS_DIR, DOCS_DIR, f"{note_name}.pdf")
-                if os.path.exists(subdir_path):
-                    pdf_path = subdir_path
-                    break
-                # Wait a bit before retrying (file system might need time)
-                if attempt < 2:
-                    time.sleep(0.5)
-            
-            if pdf_path and os.path.exists(pdf_path):
-                print(f"[INFO] PDF generated → {pdf_path}")
-            else:
-                pdf_path = None
-                print("[WARN] PDF file not found after latexmk compilation")
-                # Try to read log file for errors
-                log_path = os.path.join(DOCS_DIR, DOCS_DIR, f"{note_name}.log")
-                if os.path.exists(log_path):
-                    with open(log_path, 'r', errors='ignore') as f:
-                        log_content = f.read()
-                        if 'Error' in log_content or 'Fatal' in log_content:
-                            # Extract error lines
-                            error_lines = [line for line in log_content.split('\n') if 'Error' in line or 'Fatal' in line]
-                            compilation_error = '\n'.join(error_lines[-5:])  # Last 5 error lines
-                            print(f"[ERROR] LaTeX compilation errors found:\n{compilation_error}")
-        except FileNotFoundError:
-            print("[WARN] latexmk not found, trying pdflatex...")
-            # Fallback to pdflatex
-            try:
-                subprocess.run(
-                    ["pdflatex", "-interaction=nonstopmode", f"{note_name}.tex"],
-                    check=True,
-                    cwd=DOCS_DIR,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    timeout=60,
-                )
-                # Run twice for references
-                subprocess.run(
-                    ["pdflatex", "-interaction=nonstopmode", f"{note_name}.tex"],
-                    check=True,
-                    cwd=DOCS_DIR,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    timeout=60,
-                )
-                # Check for PDF with retry (file system might need time)
-                import time
-                pdf_path = None
-                for attempt in range(3):
-                    main_path = os.path.join(DOCS_DIR, f"{note_name}.pdf")
-                    if os.path.exists(main_path):
-                        pdf_path = main_path
-                        break
-                    subdir_path = os.path.join(DOCS_DIR, DOCS_DIR, f"{note_name}.pdf")
-                    if os.path.exists(subdir_path):
-                        pdf_path = subdir_path
-                        break
-                    if attempt < 2:
-                        time.sleep(0.5)
-                
-                if pdf_path and os.path.exists(pdf_path):
-                    print(f"[INFO] PDF generated with pdflatex → {pdf_path}")
-                else:
-                    pdf_path = None
-                    print("[WARN] PDF file not found after pdflatex compilation")
-            except (FileNotFoundError, subprocess.TimeoutExpired, subprocess.CalledProcessError) as e:
-                print(f"[WARN] pdflatex also failed: {str(e)}")
-                if isinstance(e, subprocess.CalledProcessError):
-                    compilation_error = e.stderr.decode("utf-8", errors="ignore")[:1000]
-        except subprocess.TimeoutExpired:
-            print("[WARN] PDF compilation timed out")
-            compilation_error = "Compilation timed out after 60 seconds"
-        except subprocess.CalledProcessError as e:
-            print("[WARN] LaTeX compilation failed")
-            stderr_output = e.stderr.decode("utf-8", errors="ignore")
-            stdout_output = e.stdout.decode("utf-8", errors="ignore")
-            compilation_error = stderr_output[:1000] if stderr_output else stdout_output[:1000]
-            print(f"[ERROR] Compilation error:\n{compilation_error}")
-            
-            # Try to read log file for more details
-            log_path = os.path.join(DOCS_DIR, DOCS_DIR, f"{note_name}.log")
-            if os.path.exists(log_path):
-                with open(log_path, 'r', errors='ignore') as f:
-                    log_content = f.read()
-                    if 'Error' in log_content or 'Fatal' in log_content:
-                        error_lines = [line for line in log_content.split('\n') if 'Error' in line or 'Fatal' in line]
-                        if error_lines:
-                            compilation_error = '\n'.join(error_lines[-10:])  # Last 10 error lines
-                            print(f"[ERROR] Log file errors:\n{compilation_error}")
-
-        return {
-            "latex": latex_source,
-            "tex_path": tex_path,
-            "pdf_path": pdf_path,
-            "note_name": note_name,
-            "compilation_error": compilation_error
-        }
-    finally:
-        # Clean up temporary processed files
-        try:
-            import shutil
-            if os.path.exists(processed_dir):
-                shutil.rmtree(processed_dir)
-        except:
-            pass
+    if progress is None:
+        progress = lambda stage, status, detail=None: None
+    timings = {}  # stage -> seconds, returned as "timing" (see metrics.span)
+    started = time.perf_counter()
+    images = [read_image(img) for img in images]
+
+    uploaded_at = datetime.now()  # names the note; a free name is only reserved once it is saved
+    enhanced_images, denoise_stats = denoise_images(images, progress, timings, denoise_profile)
+    latex_source, cached, vision_stats = transcribe_images(enhanced_images, progress, timings, use_cache, on_delta)
+    note_name, tex_path = save_note(latex_source, len(images), timings, when=uploaded_at)
+    pdf_path, compilation_error = compile_note(note_name, compile_pool, progress, timings)
+    record("pipeline", time.perf_counter() - started, timings)
+
+    return {
+        "latex": latex_source,
+        "tex_path": tex_path,
+        "pdf_path": pdf_path,
+        "note_name": note_name,
+        "compilation_error": compilation_error,
+        "cached": cached,
+        "vision": vision_stats,
+        "denoise": denoise_stats,
+        "timing": timings
+    }
 
 def process_image_to_latex(image_path):
     """
@@ -394,200 +103,326 @@ def upload_file():
     
     # Filter out empty files and validate
     valid_files = []
-    temp_paths = []
+    uploads = []
     
     for file in files:
         if file.filename == '':
             continue
         
         if not allowed_file(file.filename):
-            # Clean up any already saved files
-            for path in temp_paths:
-                try:
-                    if os.path.exists(path):
-                        os.remove(path)
-                except:
-                    pass
             return jsonify({'error': f'Invalid file type: {file.filename}. Please upload images (png, jpg, jpeg, gif, bmp)'}), 400
         
-        # Save uploaded file temporarily
-        filename = secure_filename(file.filename)
-        temp_path = os.path.join(app.config['UPLOAD_FOLDER'], f"upload_{uuid.uuid4()}_{filename}")
-        file.save(temp_path)
+        # Keep the upload in memory; the denoise pipeline decodes it directly
         valid_files.append(file)
-        temp_paths.append(temp_path)
+        uploads.append(file.read())
 
     if not valid_files:
         return jsonify({'error': 'No valid files provided'}), 400
 
+    # no_cache=1 forces a fresh vision call even if these images were transcribed before
+    use_cache = not form_flag('no_cache')
+    # stream=1 streams the LaTeX as it is generated, readable from /jobs/<id>/stream
+    stream = form_flag('stream')
+    # timing=1 adds a per-stage timing breakdown (seconds) to the result
+    timing = form_flag('timing')
+    # denoise=fast|quality|auto overrides the server's denoise profile for this upload
+    denoise_profile = request.form.get('denoise') or None
+    from denoise_pipeline import DENOISE_PROFILES
+    if denoise_profile and denoise_profile not in DENOISE_PROFILES:
+        return jsonify({'error': f"Invalid denoise profile: {denoise_profile}. Use one of {', '.join(DENOISE_PROFILES)}"}), 400
+
     try:
-        # Process all images (single or multiple)
-        result = process_images_to_latex(temp_paths)
-        
-        # Double-check PDF existence (in case it was just created)
-        has_pdf = False
-        if result['pdf_path'] and os.path.exists(result['pdf_path']):
-            has_pdf = True
+        job = upload_jobs.submit(run_upload_job, uploads, use_cache=use_cache, stream=stream, timing=timing,
+                                 denoise_profile=denoise_profile)
+    except QueueFull as e:
+        print(f"[WARN] Upload rejected, job queue full (retry in {e.retry_after}s)")
+        response = jsonify({'error': 'The server is busy processing other uploads. Please try again shortly.',
+                            'retry_after': e.retry_after})
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 429
+
+    print(f"[INFO] Queued upload job {job.id} ({len(valid_files)} image(s))")
+    return jsonify({
+        'success': True,
+        'job_id': job.id,
+        'status_url': f"/jobs/{job.id}",
+        'result_url': f"/jobs/{job.id}/result",
+        'stream_url': f"/jobs/{job.id}/stream",
+        'image_count': len(valid_files),
+        'queue_position': upload_jobs.position(job)
+    }), 202
+
+def form_flag(name):
+    """True if the upload form field is set to 1/true/yes/on"""
+    return request.form.get(name, '').lower() in ('1', 'true', 'yes', 'on')
+
+def run_upload_job(uploads, progress=None, emit=None, use_cache=True, stream=False, timing=False,
+                   denoise_profile=None):
+    """Job body for /upload: run the pipeline and build the result payload."""
+    # Process all images (single or multiple)
+    result = process_images_to_latex(uploads, progress=progress, use_cache=use_cache,
+                                     on_delta=emit if stream else None, denoise_profile=denoise_profile)
+    
+    has_pdf = bool(result['pdf_path'])
+    
+    payload = {
+        'success': True,
+        'latex': result['latex'],
+        'note_name': result['note_name'],
+        'has_pdf': has_pdf,
+        'image_count': len(uploads),
+        'compilation_error': result.get('compilation_error'),
+        'cached': result.get('cached', False),
+        'vision': result.get('vision'),
+        'denoise': result.get('denoise'),
+        **note_urls(result['note_name'])
+    }
+    if timing:
+        payload['timing'] = result['timing']
+    return payload
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Report the status and per-stage progress of an upload job"""
+    job = upload_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    status = job.to_dict()
+    status['queue_position'] = upload_jobs.position(job)
+    return jsonify(status)
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    """Return the result of a finished upload job (202 while it is still running)"""
+    job = upload_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job.status == 'failed':
+        return jsonify({'error': f'Processing failed: {job.error}', 'job_id': job.id}), 500
+    if job.status != 'done':
+        status = job.to_dict()
+        status['queue_position'] = upload_jobs.position(job)
+        return jsonify(status), 202
+    return jsonify({'job_id': job.id, **job.result})
+
+@app.route('/jobs/<job_id>/stream')
+def job_stream(job_id):
+    """
+    Server-Sent Events feed of an upload job:
+    `delta` events carry LaTeX as it is generated, `status` events the stage progress,
+    and a final `done` (the /result payload) or `error` event ends the stream.
+    Event ids are chunk counts, so a reconnecting EventSource resumes via Last-Event-ID.
+    """
+    job = upload_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    try:
+        start = int(request.headers.get('Last-Event-ID', 0))
+    except ValueError:
+        start = 0
+
+    def sse(event, data, event_id=None):
+        msg = f"event: {event}\n"
+        if event_id is not None:
+            msg += f"id: {event_id}\n"
+        return msg + f"data: {json.dumps(data)}\n\n"
+
+    def generate():
+        sent, version = start, None
+        while True:
+            finished = job.finished  # read before draining so no trailing chunk is missed
+            chunks = job.output[sent:]
+            for chunk in chunks:
+                sent += 1
+                yield sse('delta', {'text': chunk}, sent)
+            if job.version() != version:
+                version = job.version()
+                status = job.to_dict()
+                status['queue_position'] = upload_jobs.position(job)
+                yield sse('status', status)
+            if finished:
+                if job.status == 'done':
+                    yield sse('done', {'job_id': job.id, **job.result})
+                else:
+                    yield sse('error', {'error': f'Processing failed: {job.error}', 'job_id': job.id})
+                return
+            if not job.wait_for_update(sent, version, timeout=15):
+                yield ": keep-alive\n\n"
+
+    return app.response_class(generate(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+_file_etags = {}  # path -> (size, mtime_ns, content hash); note files change when they are recompiled
+_file_etags_lock = threading.Lock()
+
+def find_note_file(note_name, ext):
+    """(path, os.stat_result) of a note's .tex or .pdf, or None. latexmk may leave the PDF in a nested notes_out/."""
+    if secure_filename(note_name) != note_name:
+        return None
+    candidates = [os.path.join(DOCS_DIR, f"{note_name}{ext}")]
+    if ext == ".pdf":
+        candidates.append(os.path.join(DOCS_DIR, DOCS_DIR, f"{note_name}{ext}"))
+    for path in candidates:
+        try:
+            return path, os.stat(path)
+        except OSError:
+            pass
+    return None
+
+def file_etag(path, st):
+    """Strong ETag of a file: its content hash, computed once per version of the file (size and mtime)"""
+    with _file_etags_lock:
+        cached = _file_etags.get(path)
+    if cached and cached[:2] == (st.st_size, st.st_mtime_ns):
+        return cached[2]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    etag = digest.hexdigest()[:32]
+    with _file_etags_lock:
+        _file_etags[path] = (st.st_size, st.st_mtime_ns, etag)
+    return etag
+
+def note_urls(note_name):
+    """Versioned preview/download URLs of a note's files: cacheable forever, since a recompile changes them"""
+    urls = {}
+    tex = find_note_file(note_name, ".tex")
+    if tex:
+        urls['tex_url'] = f"/download/{note_name}?type=tex&v={file_etag(*tex)}"
+    pdf = find_note_file(note_name, ".pdf")
+    if pdf:
+        version = file_etag(*pdf)
+        urls['preview_url'] = f"/preview/{note_name}?v={version}"
+        urls['pdf_url'] = f"/download/{note_name}?type=pdf&v={version}"
+    return urls
+
+def send_note_file(path, st, mimetype=None, download_name=None):
+    """
+    Send a note file with a strong ETag: If-None-Match answers 304, Range (and If-Range) 206.
+    URLs carrying the current ?v=<etag> are cached as immutable; plain ones are revalidated on each use.
+    With FILE_OFFLOAD set, the proxy in front sends the bytes (X-Accel-Redirect or X-Sendfile).
+    """
+    etag = file_etag(path, st)
+    if FILE_OFFLOAD in ("x-accel", "x-sendfile"):
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
         else:
-            # Retry checking for PDF (file system timing)
-            import time
-            for attempt in range(2):
-                main_path = os.path.join(DOCS_DIR, f"{result['note_name']}.pdf")
-                subdir_path = os.path.join(DOCS_DIR, DOCS_DIR, f"{result['note_name']}.pdf")
-                if os.path.exists(main_path) or os.path.exists(subdir_path):
-                    has_pdf = True
-                    break
-                if attempt < 1:
-                    time.sleep(0.3)
-        
-        return jsonify({
-            'success': True,
-            'latex': result['latex'],
-            'note_name': result['note_name'],
-            'has_pdf': has_pdf,
-            'image_count': len(valid_files),
-            'compilation_error': result.get('compilation_error')
-        })
-    except Exception as e:
-        print(f"[ERROR] Processing failed: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({'error': f'Processing failed: {str(e)}'}), 500
-    finally:
-        # Clean up uploaded files
-        for temp_path in temp_paths:
-            try:
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
-            except:
-                pass
+            response = app.response_class(mimetype=mimetype or 'application/octet-stream')
+            if FILE_OFFLOAD == "x-accel":
+                response.headers['X-Accel-Redirect'] = FILE_ACCEL_PREFIX + os.path.relpath(path, DOCS_DIR).replace(os.sep, '/')
+            else:
+                response.headers['X-Sendfile'] = os.path.abspath(path)
+            if download_name:
+                response.headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+        response.set_etag(etag)
+    else:
+        # Under gunicorn the file goes out through wsgi.file_wrapper (sendfile) rather than Python reads
+        response = send_file(path, mimetype=mimetype, as_attachment=download_name is not None,
+                             download_name=download_name, conditional=True, etag=etag)
+    if request.args.get('v') == etag:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = NOTE_FILE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
 
 @app.route('/preview/<note_name>')
 def preview_pdf(note_name):
-    """Preview the generated PDF file"""
-    # Check both possible locations (latexmk may create subdirectory)
-    file_path = os.path.join(DOCS_DIR, f"{note_name}.pdf")
-    if not os.path.exists(file_path):
-        subdir_path = os.path.join(DOCS_DIR, DOCS_DIR, f"{note_name}.pdf")
-        if os.path.exists(subdir_path):
-            file_path = subdir_path
-    
-    if os.path.exists(file_path):
-        return send_file(file_path, mimetype='application/pdf')
-    return jsonify({'error': 'PDF not found'}), 404
+    """Preview the generated PDF file (conditional and Range requests supported, see send_note_file)"""
+    found = find_note_file(note_name, ".pdf")
+    if found is None:
+        return jsonify({'error': 'PDF not found'}), 404
+    with span("serve.preview"):
+        return send_note_file(*found, mimetype='application/pdf')
 
 @app.route('/history')
 def get_history():
-    """Get list of all generated notes organized by date"""
-    notes = []
-    
-    # Scan notes_out directory for .tex files
-    if os.path.exists(DOCS_DIR):
-        for filename in os.listdir(DOCS_DIR):
-            if filename.endswith('.tex'):
-                note_name = filename[:-4]  # Remove .tex extension
-                tex_path = os.path.join(DOCS_DIR, filename)
-                
-                # Get file modification time
-                mtime = os.path.getmtime(tex_path)
-                date_created = datetime.fromtimestamp(mtime)
-                
-                # Extract date from filename if it follows the pattern notes_YYYY-MM-DD_HH-MM-SS
-                display_name = note_name
-                if note_name.startswith('notes_') and len(note_name) > 6:
-                    # Try to parse date from filename
-                    try:
-                        date_part = note_name[6:]  # Remove 'notes_' prefix
-                        
-                        # Check if it's a multi-image file (contains 'multi' and number)
-                        is_multi = False
-                        image_count = None
-                        if '_multi' in date_part:
-                            parts = date_part.split('_multi')
-                            date_part = parts[0]
-                            if len(parts) > 1:
-                                image_count = parts[1]
-                                is_multi = True
-                        
-                        if '_' in date_part:
-                            date_str, time_str = date_part.split('_', 1)
-                            parsed_date = datetime.strptime(f"{date_str}_{time_str}", '%Y-%m-%d_%H-%M-%S')
-                            if is_multi and image_count:
-                                display_name = f"Notes from {parsed_date.strftime('%B %d, %Y at %I:%M %p')} ({image_count} images)"
-                            else:
-                                display_name = f"Notes from {parsed_date.strftime('%B %d, %Y at %I:%M %p')}"
-                    except:
-                        # If parsing fails, use the original name
-                        pass
-                
-                # Check if PDF exists
-                pdf_path = os.path.join(DOCS_DIR, f"{note_name}.pdf")
-                pdf_exists = os.path.exists(pdf_path)
-                if not pdf_exists:
-                    # Check subdirectory
-                    subdir_pdf = os.path.join(DOCS_DIR, DOCS_DIR, f"{note_name}.pdf")
-                    pdf_exists = os.path.exists(subdir_pdf)
-                
-                notes.append({
-                    'note_name': note_name,
-                    'display_name': display_name,
-                    'date_created': date_created.isoformat(),
-                    'date_display': date_created.strftime('%B %d, %Y at %I:%M %p'),
-                    'date_sort': date_created.strftime('%Y-%m-%d'),
-                    'has_pdf': pdf_exists
-                })
-    
-    # Sort by date (newest first)
-    notes.sort(key=lambda x: x['date_created'], reverse=True)
+    """
+    Get generated notes organized by date, newest first, served from the note catalog.
+    Query params: page (1-based), per_page, from/to (YYYY-MM-DD, inclusive).
+    Responses carry an ETag of the catalog version, so unchanged history answers 304.
+    """
+    try:
+        page = max(1, int(request.args.get('page', 1)))
+        per_page = max(1, min(HISTORY_MAX_PAGE_SIZE, int(request.args.get('per_page', HISTORY_PAGE_SIZE))))
+    except ValueError:
+        return jsonify({'error': 'page and per_page must be integers'}), 400
+    date_from = request.args.get('from')
+    date_to = request.args.get('to')
+    for value in (date_from, date_to):
+        if value:
+            try:
+                datetime.strptime(value, '%Y-%m-%d')
+            except ValueError:
+                return jsonify({'error': 'from/to must be YYYY-MM-DD'}), 400
+
+    etag = f"history-{note_catalog.version()}-{page}-{per_page}-{date_from or ''}-{date_to or ''}"
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+
+    rows, total = note_catalog.page(offset=(page - 1) * per_page, limit=per_page,
+                                    date_from=date_from, date_to=date_to)
     
-    # Group by date
+    # Group by date (rows are already sorted newest first)
     grouped_notes = {}
-    for note in notes:
-        date_key = note['date_sort']
+    for row in rows:
+        date_created = datetime.fromisoformat(row['created_at'])
+        date_key = row['date_sort']
         if date_key not in grouped_notes:
             grouped_notes[date_key] = {
-                'date_display': datetime.fromisoformat(note['date_created']).strftime('%B %d, %Y'),
+                'date_display': date_created.strftime('%B %d, %Y'),
                 'notes': []
             }
-        grouped_notes[date_key]['notes'].append(note)
+        grouped_notes[date_key]['notes'].append({
+            'note_name': row['note_name'],
+            'display_name': row['display_name'],
+            'date_created': row['created_at'],
+            'date_display': date_created.strftime('%B %d, %Y at %I:%M %p'),
+            'date_sort': date_key,
+            'has_pdf': bool(row['has_pdf']),
+            'feedback_count': row['feedback_count']
+        })
     
     # Convert to list sorted by date (newest first)
     history = [{'date': k, **v} for k, v in sorted(grouped_notes.items(), reverse=True)]
     
-    return jsonify({'history': history})
+    response = jsonify({
+        'history': history,
+        'page': page,
+        'per_page': per_page,
+        'total': total,
+        'has_more': page * per_page < total
+    })
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'  # always revalidate with If-None-Match
+    return response
 
 @app.route('/delete/<note_name>', methods=['DELETE'])
 def delete_note(note_name):
     """Delete a note and its associated files"""
+    if secure_filename(note_name) != note_name:
+        return jsonify({'error': 'Invalid note name'}), 400
     deleted_files = []
     errors = []
     
-    # Delete .tex file
-    tex_path = os.path.join(DOCS_DIR, f"{note_name}.tex")
-    if os.path.exists(tex_path):
-        try:
-            os.remove(tex_path)
-            deleted_files.append(f"{note_name}.tex")
-        except Exception as e:
-            errors.append(f"Failed to delete .tex: {str(e)}")
-    
-    # Delete .pdf file (check both locations)
-    pdf_path = os.path.join(DOCS_DIR, f"{note_name}.pdf")
-    if os.path.exists(pdf_path):
+    # Delete the .tex and .pdf files (find_note_file also checks latexmk's nested notes_out/ for the PDF)
+    for ext in ('.tex', '.pdf'):
+        found = find_note_file(note_name, ext)
+        if found is None:
+            continue
+        path = found[0]
         try:
-            os.remove(pdf_path)
-            deleted_files.append(f"{note_name}.pdf")
+            os.remove(path)
+            deleted_files.append(f"{note_name}{ext}")
         except Exception as e:
-            errors.append(f"Failed to delete .pdf: {str(e)}")
-    else:
-        # Check subdirectory
-        subdir_pdf = os.path.join(DOCS_DIR, DOCS_DIR, f"{note_name}.pdf")
-        if os.path.exists(subdir_pdf):
-            try:
-                os.remove(subdir_pdf)
-                deleted_files.append(f"{note_name}.pdf")
-            except Exception as e:
-                errors.append(f"Failed to delete .pdf: {str(e)}")
+            errors.append(f"Failed to delete {ext}: {str(e)}")
+        with _file_etags_lock:
+            _file_etags.pop(path, None)
     
     # Delete auxiliary files (.aux, .log, .fls, .fdb_latexmk)
     aux_extensions = ['.aux', '.log', '.fls', '.fdb_latexmk']
@@ -607,6 +442,10 @@ def delete_note(note_name):
             except:
                 pass
     
+    # Drop the latexmk state kept for recompiles
+    latex_compiler.remove_state(note_name)
+    note_catalog.remove(note_name)
+    
     if errors:
         return jsonify({'error': '; '.join(errors), 'deleted': deleted_files}), 500
     
@@ -617,28 +456,74 @@ def delete_note(note_name):
 
 @app.route('/download/<note_name>')
 def download_file(note_name):
-    """Download the generated .tex or .pdf file"""
+    """Download the generated .tex or .pdf file (conditional and Range requests supported, see send_note_file)"""
     file_type = request.args.get('type', 'tex')  # 'tex' or 'pdf'
-    
-    if file_type == 'pdf':
-        # Check both possible locations (latexmk may create subdirectory)
-        file_path = os.path.join(DOCS_DIR, f"{note_name}.pdf")
-        if not os.path.exists(file_path):
-            subdir_path = os.path.join(DOCS_DIR, DOCS_DIR, f"{note_name}.pdf")
-            if os.path.exists(subdir_path):
-                file_path = subdir_path
-        if os.path.exists(file_path):
-            return send_file(file_path, as_attachment=True, download_name=f"{note_name}.pdf")
-    else:
-        file_path = os.path.join(DOCS_DIR, f"{note_name}.tex")
-        if os.path.exists(file_path):
-            return send_file(file_path, as_attachment=True, download_name=f"{note_name}.tex")
-    
-    return jsonify({'error': 'File not found'}), 404
+    ext = ".pdf" if file_type == 'pdf' else ".tex"
+    found = find_note_file(note_name, ext)
+    if found is None:
+        return jsonify({'error': 'File not found'}), 404
+    with span("serve.download"):
+        return send_note_file(*found, mimetype='application/pdf' if ext == ".pdf" else 'text/x-tex',
+                              download_name=f"{note_name}{ext}")
+
+@app.route('/recompile/<note_name>', methods=['POST'])
+def recompile_note(note_name):
+    """
+    Recompile a note's PDF, e.g. after a feedback correction.
+    Optional JSON {"latex": "..."} replaces the .tex first; latexmk reuses its previous state.
+    """
+    if secure_filename(note_name) != note_name:
+        return jsonify({'error': 'Invalid note name'}), 400
+    tex_path = os.path.join(DOCS_DIR, f"{note_name}.tex")
+    if not os.path.exists(tex_path):
+        return jsonify({'error': 'Note not found'}), 404
+
+    data = request.get_json(silent=True) or {}
+    latex = data.get('latex')
+    if latex:
+        with open(tex_path, "w") as f:
+            f.write(latex)
+        print(f"[INFO] Updated LaTeX for {note_name}")
+
+    try:
+        compiled = compile_pool.compile(note_name)
+    except CompileQueueFull:
+        response = jsonify({'error': 'The PDF compiler is busy. Please try again shortly.'})
+        response.headers['Retry-After'] = '10'
+        return response, 429
+    note_catalog.set_pdf(note_name, compiled['pdf_path'] is not None)
+    return jsonify({
+        'success': compiled['pdf_path'] is not None,
+        'note_name': note_name,
+        'has_pdf': compiled['pdf_path'] is not None,
+        'compilation_error': compiled['compilation_error'],
+        'engine': compiled['engine'],
+        'passes': compiled['passes'],
+        'format': compiled['format'],
+        'seconds': compiled['seconds'],
+        **note_urls(note_name)
+    })
+
+@app.route('/compile/stats')
+def compile_stats():
+    """Compile pool queue depth, outcomes and timings"""
+    return jsonify(compile_pool.stats())
+
+@app.route('/chat/stats')
+def chat_stats():
+    """SymPy result cache size and hit/miss counts, and the CAS worker pool"""
+    from math_chatbot import cas_cache, cas_pool
+    return jsonify({**cas_cache.stats(), 'cas_workers': cas_pool.stats() if cas_pool else None})
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Stage latency histograms and token / cache / compile counters in Prometheus text format"""
+    return app.response_class(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
 
 @app.route('/chat', methods=['POST'])
 def chat():
     """Handle chat messages for math help"""
+    from math_chatbot import math_engine, format_reply
     data = request.json
     message = data.get('message', '').strip()
     use_llm = data.get('use_llm', True)
@@ -647,12 +532,18 @@ def chat():
         return jsonify({'error': 'No message provided'}), 400
     
     try:
-        reply = math_engine(message, use_llm=use_llm)
-        formatted_reply = format_reply(reply)
-        return jsonify({
+        timings = {}
+        with span("chat", timings):
+            reply = math_engine(message, use_llm=use_llm, timings=timings)
+            formatted_reply = format_reply(reply)
+        response = {
             'success': True,
             'reply': formatted_reply
-        })
+        }
+        # {"timing": true} adds the per-stage breakdown (seconds)
+        if data.get('timing'):
+            response['timing'] = timings
+        return jsonify(response)
     except Exception as e:
         print(f"[ERROR] Chat error: {str(e)}")
         import traceback
@@ -704,6 +595,7 @@ def submit_feedback():
         with open(filename, "a", encoding="utf-8") as f:
             f.write(json.dumps(record, ensure_ascii=False) + "\n")
 
+        note_catalog.add_feedback(note_name)
         print(f"[INFO] Saved feedback for {note_name}")
         return jsonify({"success": True, "saved_to": filename})
 
@@ -713,6 +605,85 @@ def submit_feedback():
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
 
+def warm_up():
+    """
+    Load the lazily imported modules in the background and run a tiny enhance_chalkboard and a trivial
+    chat query, so the first upload or chat doesn't pay for cv2, SymPy (and the CAS workers) or the LLM client.
+    """
+    def _warm():
+        started = time.perf_counter()
+        try:
+            import numpy as np
+            from denoise_pipeline import enhance_chalkboard
+            from math_chatbot import math_engine
+            enhance_chalkboard(np.full((64, 64, 3), 40, np.uint8))
+            get_client()
+            math_engine("simplify x + x", use_llm=False)
+        except Exception as e:
+            print(f"[WARN] Warm-up failed: {e}")
+            return
+        record("startup.warmup", time.perf_counter() - started)
+        print(f"[INFO] Warm-up done in {time.perf_counter() - started:.1f}s")
+    threading.Thread(target=_warm, name="app-warmup", daemon=True).start()
+
+def drain(timeout):
+    """
+    Stop taking uploads and compiles, then wait up to `timeout` seconds for the queued and running ones
+    (uploads first, they compile their PDF at the end). serve.py calls this as a worker shuts down.
+    """
+    deadline = time.monotonic() + timeout
+    jobs = upload_jobs.stats()
+    print(f"[INFO] Draining {jobs['queued']} queued and {jobs['running']} running upload(s)...")
+    drained = upload_jobs.drain(timeout)
+    drained = compile_pool.drain(max(0.0, deadline - time.monotonic())) and drained
+    if drained:
+        print("[INFO] Drained, no uploads or compiles left")
+    else:
+        print(f"[WARN] Gave up draining after {timeout:g}s, unfinished uploads are lost")
+    return drained
+
+def import_time_report(top=10):
+    """
+    Print where startup time goes: `python -X importtime` in a fresh interpreter imports the app,
+    then each of LAZY_MODULES; reports their cumulative times and the slowest packages by self time.
+    """
+    code = "import app\n" + "".join(f"import {name}\n" for name in LAZY_MODULES)
+    env = dict(os.environ, APP_WARMUP="0")
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+    if result.returncode != 0:
+        print(result.stderr)
+        raise SystemExit(result.returncode)
+    cumulative, packages = {}, {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        if not name[1:].startswith(" "):  # imported directly by the -c code, not by another module
+            cumulative[name.strip()] = int(cumulative_us) / 1e6
+        package = name.strip().split(".")[0]
+        packages[package] = packages.get(package, 0.0) + int(self_us) / 1e6
+    print(f"{'startup (import app)':<32}{cumulative.get('app', 0.0):>8.3f} s")
+    for name in LAZY_MODULES:
+        seconds = cumulative.get(name)
+        print(f"{'  first use: ' + name:<32}" + (f"{seconds:>8.3f} s" if seconds is not None else "  (loaded at startup)"))
+    print("\nslowest packages (self time):")
+    for package, seconds in sorted(packages.items(), key=lambda item: -item[1])[:top]:
+        print(f"  {package:<30}{seconds:>8.3f} s")
+
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Lecture-to-LaTeX web app")
+    parser.add_argument("--import-times", action="store_true",
+                        help="print an import-time breakdown of startup and the lazily loaded modules, then exit")
+    args = parser.parse_args()
+    if args.import_times:
+        import_time_report()
+        raise SystemExit(0)
+    # The debug reloader runs this twice: in the file watcher and in the server process it restarts
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        latex_compiler.warm()
+        if APP_WARMUP:
+            warm_up()
     app.run(debug=True, host='0.0.0.0', port=5000)
 
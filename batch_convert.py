@@ -0,0 +1,312 @@
+# Batch converter for whole directories of lecture photos
+# Finds the images under the given directories / globs, groups them into notes (one per folder, or
+# split within a folder wherever consecutive photos are more than --gap-minutes apart) and runs each
+# note through the same denoise -> transcribe -> compile stages as the web app (see pipeline.py).
+# The stages overlap: while one note is being transcribed the next is denoised and finished ones
+# compile. Progress is checkpointed to a JSON manifest, so running the same command again resumes
+# where it stopped.
+#
+# Usage:
+#   python batch_convert.py archive/fall2024/                     # one note per subfolder
+#   python batch_convert.py "archive/**/*.jpg" --group gap --gap-minutes 20
+#   python batch_convert.py archive/ --vision-workers 4 --compile-workers 2 --manifest fall.json
+#   python batch_convert.py archive/ --dry-run                    # show the grouping only
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from datetime import datetime
+
+import pipeline
+from latex_compile import CompilePool, CompileQueueFull
+from metrics import record
+
+MANIFEST_PATH = "batch_manifest.json"
+GAP_MINUTES = 30  # --group gap: a longer pause between photos starts a new note
+EXIF_DATETIME_ORIGINAL = 36867
+EXIF_DATETIME = 306
+EXIF_IFD = 0x8769
+
+
+# ---------- finding and grouping images ----------
+def is_image(path):
+    return os.path.isfile(path) and pipeline.allowed_file(os.path.basename(path))
+
+def find_images(inputs):
+    """Image files under the given directories (recursively) or matching the given globs, without duplicates."""
+    found = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, _, files in os.walk(item):
+                found.update(os.path.join(root, name) for name in files)
+        else:
+            found.update(glob.glob(item, recursive=True))
+    return sorted(os.path.abspath(path) for path in found if is_image(path))
+
+def photo_time(path):
+    """When the photo was taken: EXIF DateTimeOriginal (or DateTime) if present, else the file's mtime."""
+    from PIL import Image
+    try:
+        with Image.open(path) as img:
+            exif = img.getexif()
+            stamp = exif.get_ifd(EXIF_IFD).get(EXIF_DATETIME_ORIGINAL) or exif.get(EXIF_DATETIME)
+        if stamp:
+            return datetime.strptime(str(stamp).strip("\x00 "), "%Y:%m:%d %H:%M:%S")
+    except (OSError, ValueError):
+        pass
+    return datetime.fromtimestamp(os.path.getmtime(path))
+
+def group_images(paths, mode="folder", gap_minutes=GAP_MINUTES):
+    """
+    Split the images into notes: one per folder, in photo-time order. In gap mode a folder is split
+    further wherever two consecutive photos are more than gap_minutes apart.
+    Returns a list of {"id", "images", "taken"} sorted by when the first photo was taken.
+    """
+    folders = {}
+    for path in paths:
+        folders.setdefault(os.path.dirname(path), []).append((photo_time(path), path))
+    groups = []
+    for folder, photos in folders.items():
+        photos.sort()
+        current = []
+        for taken, path in photos:
+            if current and mode == "gap" and (taken - current[-1][0]).total_seconds() > gap_minutes * 60:
+                groups.append(current)
+                current = []
+            current.append((taken, path))
+        groups.append(current)
+    groups.sort(key=lambda photos: photos[0])
+    return [{"id": f"{photos[0][1]}+{len(photos)}", "images": [path for _, path in photos], "taken": photos[0][0]}
+            for photos in groups]
+
+def fingerprint(paths):
+    """Changes when an image of the group is added, removed or modified."""
+    digest = hashlib.sha1()
+    for path in paths:
+        st = os.stat(path)
+        digest.update(f"{path}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+# ---------- checkpointing ----------
+class Manifest:
+    """
+    Per-group progress, saved as JSON after every change (written to a temp file and renamed, so an
+    interrupted run never leaves it half-written). A group goes pending -> transcribed (.tex saved)
+    -> done (PDF built), or failed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.groups = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.groups = json.load(f).get("groups", {})
+
+    def entry(self, group):
+        """The saved entry for a group; a new pending one if it is new or its images changed."""
+        images_hash = fingerprint(group["images"])
+        with self._lock:
+            saved = self.groups.get(group["id"])
+            if saved is None or saved.get("fingerprint") != images_hash:
+                saved = self.groups[group["id"]] = {"fingerprint": images_hash, "images": len(group["images"]),
+                                                    "status": "pending"}
+            return dict(saved)
+
+    def update(self, group_id, **fields):
+        with self._lock:
+            self.groups[group_id].update(fields, updated_at=datetime.now().isoformat(timespec="seconds"))
+            self._save()
+
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"groups": self.groups}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+# ---------- running the stages ----------
+class BatchRun:
+    """
+    Runs the groups through the pipeline. Up to vision_workers groups are in flight: each is denoised
+    (one group at a time, its images spread over denoise_workers processes), transcribed, then queued
+    on the compile pool, freeing the slot for the next group.
+    """
+
+    def __init__(self, manifest, denoise_workers=None, vision_workers=2, compile_workers=1, max_queued=16,
+                 denoise_profile=None, use_cache=True):
+        self.manifest = manifest
+        self.denoise_workers = denoise_workers
+        self.vision_workers = max(1, vision_workers)
+        self.denoise_profile = denoise_profile
+        self.use_cache = use_cache
+        self.compile_pool = CompilePool(pipeline.latex_compiler, workers=compile_workers, max_queued=max_queued)
+        self._denoise_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._compiles = []  # one future per queued PDF, done once its result is in the manifest
+        self.stage_seconds = {"denoise": 0.0, "vision": 0.0, "compile": 0.0}
+        self.counts = {"done": 0, "failed": 0, "skipped": 0, "cached": 0, "no_pdf": 0, "images": 0}
+
+    def _add(self, stage, seconds):
+        with self._lock:
+            self.stage_seconds[stage] += seconds
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self.counts[key] += amount
+
+    def _transcribe(self, group, note_name=None):
+        """Denoise and transcribe a group and save its .tex (as note_name if given). Returns the note name."""
+        progress = lambda stage, status, detail=None: None
+        timings = {}
+        images = [pipeline.read_image(path) for path in group["images"]]
+        with self._denoise_lock:
+            started = time.perf_counter()
+            enhanced, _ = pipeline.denoise_images(images, progress, timings, self.denoise_profile, self.denoise_workers)
+            self._add("denoise", time.perf_counter() - started)
+        started = time.perf_counter()
+        latex_source, cached, _ = pipeline.transcribe_images(enhanced, progress, timings, self.use_cache)
+        self._add("vision", time.perf_counter() - started)
+        if cached:
+            self._count("cached")
+        # A new note is named after its first photo (with _2, _3... if another note has that time)
+        note_name, _ = pipeline.save_note(latex_source, len(images), timings, note_name=note_name,
+                                          when=group["taken"], created=group["taken"])
+        return note_name
+
+    def _compile(self, group, note_name):
+        """Queue the note's PDF on the compile pool; the returned future resolves once the manifest is updated."""
+        finished = Future()
+        with self._lock:
+            self._compiles.append(finished)
+        try:
+            compiled = self.compile_pool.submit(note_name)
+        except CompileQueueFull as e:
+            self._compiled(group, note_name, None, str(e))
+            finished.set_result(None)
+            return finished
+
+        def on_done(future):
+            try:
+                result = future.result()
+                self._add("compile", result.get("queue_seconds", 0.0) + result["seconds"])
+                self._compiled(group, note_name, result["pdf_path"], result["compilation_error"])
+            except Exception as e:
+                self._compiled(group, note_name, None, str(e))
+            finally:
+                finished.set_result(None)
+
+        compiled.add_done_callback(on_done)
+        return finished
+
+    def _compiled(self, group, note_name, pdf_path, compilation_error):
+        pipeline.note_catalog.set_pdf(note_name, pdf_path is not None)
+        if pdf_path:
+            self.manifest.update(group["id"], status="done", error=None)
+            print(f"[INFO] {note_name}: PDF built")
+        else:
+            # The .tex is saved; a later run retries just the compile
+            self.manifest.update(group["id"], error=compilation_error)
+            self._count("no_pdf")
+            print(f"[WARN] {note_name}: no PDF ({compilation_error})")
+        self._count("done")
+        self._count("images", len(group["images"]))
+
+    def _run_group(self, group, entry):
+        try:
+            note_name = entry.get("note_name")
+            tex_path = note_name and os.path.join(pipeline.DOCS_DIR, f"{note_name}.tex")
+            if entry["status"] != "transcribed" or not os.path.exists(tex_path):
+                note_name = self._transcribe(group, note_name)
+                self.manifest.update(group["id"], status="transcribed", note_name=note_name, error=None)
+            self._compile(group, note_name)
+        except Exception as e:
+            print(f"[ERROR] {os.path.dirname(group['images'][0])} ({len(group['images'])} image(s)): {e}")
+            self.manifest.update(group["id"], status="failed", error=str(e))
+            self._count("failed")
+
+    def run(self, groups):
+        todo = []
+        for group in groups:
+            entry = self.manifest.entry(group)
+            if entry["status"] == "done":
+                self._count("skipped")
+            else:
+                todo.append((group, entry))
+        print(f"[INFO] {len(groups)} note(s): {self.counts['skipped']} already done, {len(todo)} to convert")
+        executor = ThreadPoolExecutor(max_workers=self.vision_workers, thread_name_prefix="batch")
+        futures = [executor.submit(self._run_group, group, entry) for group, entry in todo]
+        try:
+            wait(futures)
+        finally:
+            # On Ctrl-C only the notes already in flight finish; the rest stay pending in the manifest
+            for future in futures:
+                future.cancel()
+            executor.shutdown()
+            wait(self._compiles)
+
+def print_summary(run, wall_seconds):
+    counts, stages = run.counts, run.stage_seconds
+    record("batch", wall_seconds)
+    print("\n=== Batch summary ===")
+    print(f"Notes:   {counts['done']} converted ({counts['cached']} from cache), "
+          f"{counts['no_pdf']} without a PDF, {counts['skipped']} already done, {counts['failed']} failed")
+    print(f"Images:  {counts['images']} in {wall_seconds:.1f}s")
+    for stage, seconds in stages.items():
+        average = seconds / counts["done"] if counts["done"] else 0.0
+        print(f"  {stage:<8} {seconds:8.1f}s total  {average:6.1f}s per note")
+    minutes = max(wall_seconds, 1e-9) / 60
+    print(f"Throughput: {counts['images'] / minutes:.1f} images/min, {counts['done'] / minutes:.2f} notes/min")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert directories of lecture photos into LaTeX notes")
+    parser.add_argument("inputs", nargs="+", help="directories (searched recursively) or globs of images")
+    parser.add_argument("--group", choices=("folder", "gap"), default="folder",
+                        help="one note per folder, or also split a folder at pauses between photos")
+    parser.add_argument("--gap-minutes", type=float, default=GAP_MINUTES,
+                        help="--group gap: pause that starts a new note (default %(default)s)")
+    parser.add_argument("--manifest", default=MANIFEST_PATH, help="progress file used to resume (default %(default)s)")
+    parser.add_argument("--denoise-workers", type=int, default=pipeline.DENOISE_WORKERS,
+                        help="processes denoising a note's images (default: CPU count)")
+    parser.add_argument("--vision-workers", type=int, default=2, help="notes transcribed at once (default %(default)s)")
+    parser.add_argument("--compile-workers", type=int, default=pipeline.COMPILE_WORKERS,
+                        help="PDFs compiled at once (default %(default)s)")
+    parser.add_argument("--profile", choices=("fast", "quality", "auto"), help="denoise profile (default DENOISE_PROFILE)")
+    parser.add_argument("--no-cache", action="store_true", help="don't reuse cached transcriptions")
+    parser.add_argument("--dry-run", action="store_true", help="print the grouping and exit")
+    args = parser.parse_args(argv)
+
+    paths = find_images(args.inputs)
+    if not paths:
+        raise SystemExit("[ERROR] No images found")
+    groups = group_images(paths, args.group, args.gap_minutes)
+    print(f"[INFO] Found {len(paths)} image(s) in {len(groups)} note(s)")
+    if args.dry_run:
+        for group in groups:
+            print(f"  {group['taken']:%Y-%m-%d %H:%M}  {len(group['images']):3d} image(s)  "
+                  f"{os.path.dirname(group['images'][0])}")
+        return
+
+    os.makedirs(pipeline.DOCS_DIR, exist_ok=True)
+    run = BatchRun(Manifest(args.manifest), denoise_workers=args.denoise_workers,
+                   vision_workers=args.vision_workers, compile_workers=args.compile_workers,
+                   max_queued=len(groups), denoise_profile=args.profile, use_cache=not args.no_cache)
+    started = time.perf_counter()
+    try:
+        run.run(groups)
+    except KeyboardInterrupt:
+        print(f"\n[WARN] Interrupted, progress is saved in {args.manifest}; run again to resume")
+        raise SystemExit(130)
+    finally:
+        print_summary(run, time.perf_counter() - started)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,432 @@
+# Offline benchmark for the denoise -> transcribe -> compile pipeline
+# Every stage runs in its own child process (so peak RSS is per stage) against
+# synthetic boards, optional real photos, the notes in notes_out/ and a local
+# stub LLM, and the results can be saved as a JSON baseline to compare against.
+#
+#   python benchmark.py --save bench_baseline.json
+#   python benchmark.py --compare bench_baseline.json --tolerance 0.2
+#   python benchmark.py --stages enhance,denoise --sizes 1024,2048 --images raw/
+#   python benchmark.py --stages parse --repeat 20
+
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import resource
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+STAGES = ("enhance", "denoise", "compile", "pipeline", "parse")
+DEFAULT_SIZES = (1024, 2048, 4032)  # long edge in px; 4032 is a 12MP phone photo
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+
+CANNED_LATEX = r"""\documentclass{article}
+\usepackage{amsmath}
+\usepackage{amssymb}
+\begin{document}
+\section{Benchmark}
+The derivative of $x^2$ is
+\begin{equation}
+  \frac{d}{dx} x^2 = 2x .
+\end{equation}
+\end{document}
+"""
+
+# Chat messages as students type them (typos included) for the parse stage
+CHAT_MESSAGES = (
+    "derivative of sin(x)^2", "derivatve of x^3*exp(x)", "what's the derivative of cos x", "d/dx tan3x",
+    "differentiat log x", "integrate x^2 from 0 to 1", "intgrate sin 2x", "integral of e^x from 0 to 1",
+    "limit sin(x)/x as x->0", "limit (1+1/n)^n as n->oo", "solve x^2=4", "slove x^2 - 5x + 6 = 0",
+    "roots of x^3-1", "solve {x+y=3, x-y=1}", "simplify (x^2-1)/(x-1)", "simplfy sin(x)^2+cos(x)^2",
+    "factor x^2-1", "expnad (x+1)^3", "explain eigenvalues", "what is a derivative", "intuition for limits",
+    "2+3*4", "sqrtx + ln x", "sec x csc y", "9+10", "(x+1)^2 - x^2",
+)
+
+
+# ---------- corpus ----------
+def synthetic_board(long_edge: int, seed: int = 0) -> np.ndarray:
+    """A 4:3 chalkboard-like photo: dark green board, uneven lighting, chalk formulas and sensor noise."""
+    rng = np.random.default_rng(seed)
+    w, h = long_edge, long_edge * 3 // 4
+    board = np.empty((h, w, 3), np.float32)
+    board[:] = (45, 70, 40)  # BGR dark green
+    # Uneven lighting: brighter towards one corner
+    yy, xx = np.mgrid[0:h, 0:w].astype(np.float32)
+    board *= (0.75 + 0.5 * (xx / w) * (1 - 0.5 * yy / h))[..., None]
+    scale = long_edge / 1024
+    chalk = np.zeros((h, w), np.uint8)
+    formulas = ["f(x) = x^2 + 3x - 1", "d/dx sin(x) = cos(x)", "int_0^1 x dx = 1/2",
+                "lim (1+1/n)^n = e", "a^2 + b^2 = c^2", "det(A - tI) = 0"]
+    for i in range(int(h / (90 * scale))):
+        text = formulas[int(rng.integers(len(formulas)))]
+        org = (int(rng.integers(20, max(21, w // 4))), int((i + 1) * 85 * scale))
+        cv2.putText(chalk, text, org, cv2.FONT_HERSHEY_SIMPLEX, 1.6 * scale, 255, max(1, int(3 * scale)), cv2.LINE_AA)
+    alpha = (chalk.astype(np.float32) / 255 * 0.85)[..., None]
+    board = board * (1 - alpha) + np.float32(220) * alpha
+    board += rng.normal(0, 12, board.shape).astype(np.float32)
+    return np.clip(board, 0, 255).astype(np.uint8)
+
+
+def resize_long_edge(img: np.ndarray, long_edge: int) -> np.ndarray:
+    h, w = img.shape[:2]
+    scale = long_edge / max(h, w)
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+    return cv2.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=interpolation)
+
+
+def load_corpus(long_edge: int, synthetic: int, images_dir: str = None):
+    """[(name, jpeg bytes)] at the given long edge: `synthetic` generated boards plus any real photos."""
+    corpus = []
+    for i in range(synthetic):
+        ok, buf = cv2.imencode(".jpg", synthetic_board(long_edge, seed=i), [cv2.IMWRITE_JPEG_QUALITY, 90])
+        corpus.append((f"synthetic-{i}", buf.tobytes()))
+    if images_dir:
+        for name in sorted(os.listdir(images_dir)):
+            if not name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            img = cv2.imread(os.path.join(images_dir, name), cv2.IMREAD_COLOR)
+            if img is None:
+                print(f"[WARN] Skipping unreadable image {name}")
+                continue
+            ok, buf = cv2.imencode(".jpg", resize_long_edge(img, long_edge), [cv2.IMWRITE_JPEG_QUALITY, 90])
+            corpus.append((name, buf.tobytes()))
+    return corpus
+
+
+# ---------- stub LLM ----------
+class StubLLMHandler(BaseHTTPRequestHandler):
+    """Minimal /v1/chat/completions that answers with canned LaTeX after a fixed delay."""
+
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+    reply = CANNED_LATEX
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body: bytes, content_type: str):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        time.sleep(self.latency)
+        usage = {"prompt_tokens": 1000, "completion_tokens": len(self.reply) // 4,
+                 "total_tokens": 1000 + len(self.reply) // 4}
+        base = {"id": "bench", "created": int(time.time()), "model": request.get("model", "stub")}
+        if request.get("stream"):
+            events = []
+            for i in range(0, len(self.reply), 64):
+                chunk = dict(base, object="chat.completion.chunk",
+                             choices=[{"index": 0, "delta": {"content": self.reply[i:i + 64]}, "finish_reason": None}])
+                events.append(f"data: {json.dumps(chunk)}\n\n")
+            events.append(f"data: {json.dumps(dict(base, object='chat.completion.chunk', choices=[], usage=usage))}\n\n")
+            events.append("data: [DONE]\n\n")
+            self._send("".join(events).encode(), "text/event-stream")
+            return
+        body = dict(base, object="chat.completion", usage=usage, choices=[
+            {"index": 0, "message": {"role": "assistant", "content": self.reply}, "finish_reason": "stop"}])
+        self._send(json.dumps(body).encode(), "application/json")
+
+
+def start_stub_llm(latency: float = 0.0) -> ThreadingHTTPServer:
+    handler = type("Handler", (StubLLMHandler,), {"latency": latency})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# ---------- stage runners (executed in a child process) ----------
+def _bench_enhance(options, size):
+    from denoise_pipeline import enhance_chalkboard
+    samples = []
+    for name, data in load_corpus(size, options["synthetic"], options["images"]):
+        img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        for _ in range(options["repeat"]):
+            started = time.perf_counter()
+            enhance_chalkboard(img, with_edges=False)
+            samples.append(time.perf_counter() - started)
+    return samples, {}
+
+
+def _bench_denoise(options, size):
+    from denoise_pipeline import denoise_image_bytes
+    samples, steps = [], {}
+    for name, data in load_corpus(size, options["synthetic"], options["images"]):
+        for _ in range(options["repeat"]):
+            started = time.perf_counter()
+            _, info = denoise_image_bytes(data, outputs=("vision",), vision_max_edge=options["vision_max_edge"],
+                                          with_info=True, tile_size=options["tile_size"], profile=options["profile"])
+            samples.append(time.perf_counter() - started)
+            for step, seconds in info["timings"].items():
+                steps.setdefault(step, []).append(seconds)
+    return samples, steps
+
+
+def _bench_compile(options, variant):
+    """Replays notes_out/*.tex in a scratch copy; 'cold' is the first compile of each note, 'warm' the rest."""
+    from latex_compile import LatexCompiler, COMMON_PREAMBLES, split_preamble
+    workdir = tempfile.mkdtemp(prefix="bench-compile-")
+    try:
+        notes = sorted(n[:-4] for n in os.listdir(options["notes_dir"]) if n.endswith(".tex"))[:options["max_notes"]]
+        for note in notes:
+            shutil.copy(os.path.join(options["notes_dir"], f"{note}.tex"), workdir)
+        compiler = LatexCompiler(workdir, fmt_dir=os.path.join(os.path.abspath(options["notes_dir"]), ".formats"),
+                                 timeout=options["compile_timeout"], use_formats=options["formats"])
+        if options["formats"]:
+            # Formats are built once per preamble and shared, as in the app; build them up front so
+            # the timings measure compiles rather than the one-off format dumps
+            preambles = set(COMMON_PREAMBLES)
+            for note in notes:
+                with open(os.path.join(workdir, f"{note}.tex")) as f:
+                    preambles.add(split_preamble(f.read())[0])
+            for preamble in preambles - {None}:
+                compiler.build_format(preamble)
+        samples, failures = [], 0
+        rounds = 1 if variant == "cold" else 1 + options["repeat"]
+        for round_no in range(rounds):
+            for note in notes:
+                result = compiler.compile(note)
+                if variant == "warm" and round_no == 0:
+                    continue  # the first round only primes latexmk state
+                samples.append(result["seconds"])
+                failures += result["pdf_path"] is None
+        return samples, {}, {"notes": len(notes), "failures": failures}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _bench_pipeline(options, size):
+    """process_images_to_latex end to end in a scratch working directory, vision calls going to the stub LLM."""
+    server = start_stub_llm(options["llm_latency"])
+    workdir = tempfile.mkdtemp(prefix="bench-pipeline-")
+    os.environ.update({
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{server.server_port}/v1",
+        "OPENAI_API_KEY": "sk-benchmark",
+        "DENOISE_WORKERS": "1",  # keep the work in this process so its peak RSS counts
+        "DENOISE_TILE_SIZE": str(options["tile_size"] or 0),
+        "DENOISE_PROFILE": options["profile"],
+        "TRANSCRIPTION_CACHE_DIR": os.path.join(workdir, "cache"),
+    })
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        import app
+        samples, steps = [], {}
+        for name, data in load_corpus(size, options["synthetic"], options["images"]):
+            for _ in range(options["repeat"]):
+                started = time.perf_counter()
+                result = app.process_images_to_latex([data], use_cache=False)
+                samples.append(time.perf_counter() - started)
+                for step, seconds in result["timing"].items():
+                    steps.setdefault(step, []).append(seconds)
+        return samples, steps
+    finally:
+        os.chdir(cwd)
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _bench_parse(options, variant):
+    """Local intent detection and expression clean-up of chat messages (no SymPy, no LLM), per message."""
+    import math_chatbot
+    samples = []
+    for _ in range(options["repeat"]):
+        cache = getattr(math_chatbot, "_closest_keyword", None)
+        if hasattr(cache, "cache_clear"):
+            cache.cache_clear()  # every round starts with cold typo corrections
+        for message in CHAT_MESSAGES:
+            started = time.perf_counter()
+            op, info = math_chatbot.detect_math_op_local(message)
+            math_chatbot.balance_parens(math_chatbot.insert_parens_after_func(info.get("expr") or message))
+            samples.append(time.perf_counter() - started)
+    return samples, {}, {"messages": len(CHAT_MESSAGES), "p50_us": round(percentile(samples, 50) * 1e6, 1),
+                         "p95_us": round(percentile(samples, 95) * 1e6, 1)}
+
+
+def _run_stage(stage, variant, options):
+    """Child-process entry point: run one stage and return its samples and peak memory."""
+    sys.path.insert(0, REPO_DIR)
+    if options["threads"]:
+        cv2.setNumThreads(options["threads"])
+    runner = {"enhance": _bench_enhance, "denoise": _bench_denoise,
+              "compile": _bench_compile, "pipeline": _bench_pipeline, "parse": _bench_parse}[stage]
+    outcome = runner(options, variant)
+    samples, steps = outcome[0], outcome[1]
+    extra = outcome[2] if len(outcome) > 2 else {}
+    return {
+        **summarize(samples),
+        "steps": {step: summarize(values)["p50"] for step, values in steps.items()},
+        # ru_maxrss is in KiB on Linux; children covers pdflatex/latexmk
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "children_peak_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        **extra,
+    }
+
+
+# ---------- statistics / reporting ----------
+def percentile(values, q):
+    """Nearest-rank percentile (q in 0..100)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(q / 100 * len(ordered)) - 1))]
+
+
+def summarize(samples):
+    """Latency percentiles plus throughput of back-to-back runs (items per second of measured time)."""
+    total = sum(samples)
+    return {
+        "count": len(samples),
+        "p50": round(percentile(samples, 50), 4),
+        "p95": round(percentile(samples, 95), 4),
+        "mean": round(total / len(samples), 4) if samples else 0.0,
+        "throughput_per_s": round(len(samples) / total, 3) if total else None,
+    }
+
+
+def run_benchmarks(options):
+    jobs = []
+    for stage in options["stages"]:
+        if stage == "compile":
+            if not shutil.which("pdflatex") and not shutil.which("latexmk"):
+                print("[WARN] No pdflatex/latexmk on PATH, skipping the compile benchmark")
+                continue
+            jobs += [(stage, "cold"), (stage, "warm")]
+        elif stage == "parse":
+            jobs.append((stage, "chat"))
+        else:
+            jobs += [(stage, size) for size in options["sizes"]]
+
+    results = {}
+    ctx = mp.get_context("spawn")
+    for stage, variant in jobs:
+        key = f"{stage}@{variant}"
+        print(f"[INFO] Running {key}...")
+        # A fresh process per stage so peak RSS and warm-up effects don't leak between stages
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+            results[key] = pool.submit(_run_stage, stage, variant, options).result()
+    return results
+
+
+def print_results(results):
+    print(f"\n{'stage':<22}{'n':>5}{'p50 s':>10}{'p95 s':>10}{'items/s':>10}{'RSS MB':>9}")
+    for key, r in results.items():
+        throughput = "-" if r["throughput_per_s"] is None else f"{r['throughput_per_s']:.2f}"
+        print(f"{key:<22}{r['count']:>5}{r['p50']:>10.3f}{r['p95']:>10.3f}{throughput:>10}{r['peak_rss_mb']:>9.0f}")
+        if r["steps"]:
+            print("    " + ", ".join(f"{step} {seconds:.3f}s" for step, seconds in r["steps"].items()))
+        if "p50_us" in r:
+            print(f"    per message: p50 {r['p50_us']:.1f}us, p95 {r['p95_us']:.1f}us")
+
+
+def compare(results, baseline, tolerance, min_delta=0.005):
+    """
+    Print the change against a baseline; returns the keys whose p50/p95 or peak RSS grew by more
+    than `tolerance` (relative). Latency changes under min_delta seconds are treated as noise.
+    """
+    regressions = []
+    print(f"\n{'stage':<22}{'p50 s':>24}{'p95 s':>24}{'RSS MB':>18}")
+    for key, r in results.items():
+        base = baseline["results"].get(key)
+        if base is None:
+            print(f"{key:<22}  (not in baseline)")
+            continue
+        cells, regressed = [], False
+        for field, fmt, noise in (("p50", ".3f", min_delta), ("p95", ".3f", min_delta), ("peak_rss_mb", ".0f", 0)):
+            before, after = base[field], r[field]
+            change = (after - before) / before if before else 0.0
+            regressed |= change > tolerance and after - before > noise
+            cells.append(f"{before:{fmt}} -> {after:{fmt}} ({change:+.0%})")
+        print(f"{key:<22}{cells[0]:>24}{cells[1]:>24}{cells[2]:>18}{'  REGRESSION' if regressed else ''}")
+        if regressed:
+            regressions.append(key)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the denoise -> transcribe -> compile pipeline.")
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"comma-separated subset of {','.join(STAGES)}")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="image long edges in px")
+    parser.add_argument("--synthetic", type=int, default=2, help="synthetic boards per size")
+    parser.add_argument("--images", help="directory of real chalkboard photos to add to the corpus")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per image / note")
+    parser.add_argument("--notes-dir", default=os.path.join(REPO_DIR, "notes_out"), help=".tex files to compile")
+    parser.add_argument("--max-notes", type=int, default=20)
+    parser.add_argument("--no-formats", action="store_true", help="compile without precompiled preambles")
+    parser.add_argument("--compile-timeout", type=int, default=60)
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="seconds the stub LLM waits before replying")
+    parser.add_argument("--vision-max-edge", type=int, default=1536)
+    parser.add_argument("--threads", type=int, default=0, help="cv2 threads (default: cv2's own choice)")
+    parser.add_argument("--profile", default="auto", choices=("fast", "quality", "auto"), help="denoise profile")
+    parser.add_argument("--tile-size", type=int, default=1024, help="denoise tile size in px (0 = whole image)")
+    parser.add_argument("--save", metavar="JSON", help="write the results as a baseline")
+    parser.add_argument("--compare", metavar="JSON", help="compare against a saved baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown before flagging")
+    parser.add_argument("--min-delta", type=float, default=0.005, help="latency changes below this (s) are noise")
+    args = parser.parse_args(argv)
+
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+    options = {
+        "stages": stages,
+        "sizes": [int(s) for s in args.sizes.split(",") if s.strip()],
+        "synthetic": args.synthetic,
+        "images": args.images,
+        "repeat": max(1, args.repeat),
+        "notes_dir": args.notes_dir,
+        "max_notes": args.max_notes,
+        "formats": not args.no_formats,
+        "compile_timeout": args.compile_timeout,
+        "llm_latency": args.llm_latency,
+        "vision_max_edge": args.vision_max_edge,
+        "threads": args.threads,
+        "tile_size": args.tile_size or None,
+        "profile": args.profile,
+    }
+
+    results = run_benchmarks(options)
+    print_results(results)
+
+    if args.save:
+        report = {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "machine": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpu_count": os.cpu_count(), "opencv": cv2.__version__},
+            "options": options,
+            "results": results,
+        }
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\n[INFO] Saved baseline to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance, args.min_delta)
+        if regressions:
+            print(f"\n[WARN] {len(regressions)} stage(s) regressed by more than {args.tolerance:.0%}: "
+                  f"{', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+# Memoized SymPy results for the math chatbot
+# A class asks the same questions over and over; the rendered answer of a CAS plan is kept in an
+# in-memory LRU (optionally backed by SQLite) so a repeat skips parsing and sp.simplify entirely.
+
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from metrics import CAS_CACHE_LOOKUPS
+
+PERSISTED_FACTOR = 10  # the database keeps up to this many times max_entries results
+SCHEMA = "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+
+
+def text_key(op: str, info: Dict[str, Any]) -> str:
+    """Key on the plan as typed (whitespace collapsed); cheap enough to check before any parsing."""
+    fields = [op] + [f"{name}={' '.join(str(value).split())}" for name, value in sorted(info.items())
+                     if value is not None and name != "op"]
+    return "text:" + "\x1f".join(fields)
+
+
+def canonical_key(op: str, info: Dict[str, Any], parse: Callable[[str], Any], srepr: Callable[[Any], str]) -> str:
+    """
+    Key on the parsed plan: op, srepr of the expression and of the integral bounds, limit variable and target.
+    Spellings that parse to the same expression (x^2, x**2, x*x) share it. Solve plans stay text keyed,
+    their systems of equations are parsed piecewise by the solver.
+    """
+    if op == "solve":
+        return text_key(op, info)
+    fields = [op, srepr(parse(info["expr"]))]
+    for bound in ("a", "b"):
+        if info.get(bound):
+            fields.append(f"{bound}={srepr(parse(info[bound]))}")
+    for name in ("var", "to"):
+        if info.get(name):
+            fields.append(f"{name}={' '.join(str(info[name]).split())}")
+    return "plan:" + "\x1f".join(fields)
+
+
+class CASCache:
+    """
+    Bounded LRU of rendered CAS results (key -> LaTeX string).
+    With db_path set, results are also written to SQLite and looked up there on a memory miss,
+    so they survive restarts. Hits and misses are counted for /chat/stats and /metrics.
+    """
+
+    def __init__(self, max_entries: int = 2048, db_path: Optional[str] = None, namespace: str = ""):
+        self.max_entries = max_entries
+        self.db_path = db_path
+        self.namespace = namespace  # e.g. the SymPy version, so persisted results don't outlive an upgrade
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._conn = None
+
+    def _db(self) -> Optional[sqlite3.Connection]:
+        # Called with the lock held
+        if self.db_path and self._conn is None:
+            try:
+                self._conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute(SCHEMA)
+            except sqlite3.Error as e:
+                print(f"[WARN] CAS cache database unavailable ({e}), keeping results in memory only")
+                self.db_path = None
+                self._conn = None
+        return self._conn
+
+    def _remember(self, key: str, value: str):
+        # Called with the lock held
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _lookup(self, key: str) -> Optional[str]:
+        # Called with the lock held
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+            return value
+        conn = self._db()
+        if conn is not None:
+            row = conn.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            if row:
+                self._remember(key, row[0])
+                return row[0]
+        return None
+
+    def _store(self, key: str, value: str):
+        # Called with the lock held
+        self._remember(key, value)
+        conn = self._db()
+        if conn is not None:
+            conn.execute("INSERT OR REPLACE INTO results (key, value) VALUES (?, ?)", (key, value))
+            # Rows are replaced with a new rowid, so this drops the least recently written ones
+            conn.execute("DELETE FROM results WHERE rowid <= (SELECT MAX(rowid) FROM results) - ?",
+                         (self.max_entries * PERSISTED_FACTOR,))
+
+    def get_or_compute(self, keys: Iterable[str], compute: Callable[[], str]) -> str:
+        """
+        Return the result stored under the first of `keys` that has one, else compute() it.
+        `keys` is consumed lazily (cheapest key first), and the result is stored under every key
+        tried, so the next identical query hits the first one. Exceptions from compute() aren't cached.
+        """
+        tried = []
+        value = None
+        for key in keys:
+            key = self.namespace + key
+            with self._lock:
+                value = self._lookup(key)
+            if value is not None:
+                break
+            tried.append(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        CAS_CACHE_LOOKUPS.inc(result="miss" if value is None else "hit")
+        if value is None:
+            value = compute()
+        with self._lock:
+            for key in tried:
+                self._store(key, value)
+        return value
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "persistent": bool(self.db_path),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,152 @@
+# Isolated SymPy workers for the math chatbot
+# Parsing and CAS calls (simplify, integrate, limit, solve) run in separate processes with a
+# wall-clock timeout and an address-space limit, so a runaway input like "integrate exp(x^x)"
+# is killed instead of pinning a core of the web server. A killed worker is replaced in the background.
+
+import multiprocessing as mp
+import queue
+import threading
+import time
+from typing import Any, Optional
+
+from metrics import CAS_CALLS
+
+try:
+    import resource
+except ImportError:  # not available on Windows; workers then run without a memory limit
+    resource = None
+
+WORKER_START_TIMEOUT = 60  # seconds for a fresh worker to import SymPy
+
+
+class CASError(Exception):
+    """The computation failed in the worker (bad input, MemoryError, crashed worker...)."""
+
+
+class CASTimeout(CASError):
+    """No result within the time limit (or no worker free in time); the computation was stopped."""
+
+
+def _worker_main(conn, memory_mb: int):
+    """Worker loop: run math_chatbot.<name>(*args) for each request on the pipe."""
+    if resource is not None and memory_mb:
+        limit = memory_mb * 1024 * 1024
+        try:
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (ValueError, OSError) as e:
+            print(f"[WARN] CAS worker couldn't set its memory limit: {e}")
+    import math_chatbot  # imported here: the parent imports this module from math_chatbot
+    conn.send(("ready", None))
+    while True:
+        try:
+            name, args = conn.recv()
+        except EOFError:
+            return
+        try:
+            conn.send(("ok", getattr(math_chatbot, name)(*args)))
+        except MemoryError:
+            conn.send(("error", f"out of memory (limit {memory_mb} MB)"))
+        except Exception as e:
+            conn.send(("error", f"{e.__class__.__name__}: {e}"))
+
+
+class _Worker:
+    def __init__(self, ctx, memory_mb: int):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn, memory_mb), daemon=True,
+                                   name="cas-worker")
+        self.process.start()
+        child_conn.close()
+
+    def wait_ready(self, timeout: float) -> bool:
+        try:
+            return self.conn.poll(timeout) and self.conn.recv()[0] == "ready"
+        except (EOFError, OSError):
+            return False
+
+    def kill(self):
+        self.process.kill()
+        self.process.join(5)
+        self.conn.close()
+
+
+class CASPool:
+    """
+    A fixed number of worker processes, each used by one call at a time over its own pipe.
+    run() gives up after `timeout` seconds, kills that worker and starts a replacement.
+    Workers are started on first use.
+    """
+
+    def __init__(self, workers: int = 2, timeout: float = 5.0, memory_mb: int = 1024):
+        self.workers = workers
+        self.timeout = timeout
+        self.memory_mb = memory_mb
+        self._ctx = mp.get_context("spawn")  # not fork: called from Flask's request threads
+        self._idle: "queue.Queue[_Worker]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = False
+        self._ready = threading.Event()  # set once the first worker has started
+        self.killed = 0
+
+    def _spawn(self):
+        """Start a worker and hand it to the idle queue once SymPy is imported."""
+        worker = _Worker(self._ctx, self.memory_mb)
+        if worker.wait_ready(WORKER_START_TIMEOUT):
+            self._idle.put(worker)
+            self._ready.set()
+        else:
+            print("[ERROR] CAS worker failed to start, retrying")
+            worker.kill()
+            time.sleep(1)
+            threading.Thread(target=self._spawn, daemon=True).start()
+
+    def _ensure_started(self):
+        with self._lock:
+            if not self._started:
+                self._started = True
+                for _ in range(self.workers):
+                    threading.Thread(target=self._spawn, daemon=True).start()
+
+    def run(self, name: str, *args, timeout: Optional[float] = None) -> Any:
+        """Call math_chatbot.<name>(*args) in a worker. Raises CASTimeout or CASError."""
+        self._ensure_started()
+        timeout = timeout or self.timeout
+        # A fresh pool may still be importing SymPy; that doesn't count against the call
+        if not self._ready.wait(WORKER_START_TIMEOUT):
+            CAS_CALLS.inc(result="error")
+            raise CASError("no CAS worker could be started")
+        started = time.monotonic()
+        try:
+            worker = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            CAS_CALLS.inc(result="busy")
+            raise CASTimeout("all CAS workers are busy")
+        try:
+            worker.conn.send((name, args))
+            remaining = max(0.0, timeout - (time.monotonic() - started))
+            if not worker.conn.poll(remaining):
+                raise TimeoutError
+            status, value = worker.conn.recv()
+        except TimeoutError:
+            self._replace(worker)
+            CAS_CALLS.inc(result="timeout")
+            raise CASTimeout(f"computation stopped after {timeout:g}s")
+        except (EOFError, OSError):
+            self._replace(worker)
+            CAS_CALLS.inc(result="crashed")
+            raise CASError("CAS worker died (probably over its memory limit)")
+        self._idle.put(worker)
+        if status != "ok":
+            CAS_CALLS.inc(result="error")
+            raise CASError(value)
+        CAS_CALLS.inc(result="ok")
+        return value
+
+    def _replace(self, worker: _Worker):
+        self.killed += 1
+        worker.kill()
+        threading.Thread(target=self._spawn, daemon=True).start()
+
+    def stats(self):
+        return {"workers": self.workers, "idle": self._idle.qsize(), "timeout": self.timeout,
+                "memory_mb": self.memory_mb, "killed": self.killed}
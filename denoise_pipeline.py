@@ -1,8 +1,18 @@
 import cv2
 import os
+import time
+import threading
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 import numpy as np
 
-def enhance_chalkboard(img):
+NLM_STRENGTH = 10
+NLM_TEMPLATE_WINDOW = 7
+NLM_SEARCH_WINDOW = 21
+
+def enhance_chalkboard(img, with_edges=True):
+    """Binarize a (denoised) board photo; edges is None when with_edges=False."""
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     blur = cv2.medianBlur(gray, 3)
     _, th = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
@@ -11,10 +21,134 @@ def enhance_chalkboard(img):
     kernel = np.ones((2, 2), np.uint8)
     opened = cv2.morphologyEx(th, cv2.MORPH_OPEN, kernel)
     closed = cv2.morphologyEx(opened, cv2.MORPH_CLOSE, kernel)
-    edges = cv2.Canny(blur, 50, 150)
+    edges = cv2.Canny(blur, 50, 150) if with_edges else None
+    return closed, edges
+
+
+# ---- tiled processing for very large images ----
+# A pixel's NLM output only depends on pixels within this radius (search + template window),
+# so tiles carrying this much extra border stitch back together exactly, without seams
+NLM_HALO = NLM_SEARCH_WINDOW // 2 + NLM_TEMPLATE_WINDOW // 2
+ENHANCE_HALO = 4  # medianBlur 3x3, then 2x2 open and close
+_tile_threads = None  # None = CPU count; set to 1 in pool workers, which already run one image per core
+
+def _tile_workers():
+    return _tile_threads or os.cpu_count() or 1
+
+def denoise_nlm(img, tile_size=None, workers=None):
+    """
+    fastNlMeansDenoisingColored with the pipeline's settings.
+    Images larger than tile_size are denoised tile by tile on a thread pool (cv2 releases the GIL),
+    which bounds NLM's working memory by the tile size and spreads one big board across cores.
+    """
+    h, w = img.shape[:2]
+    if not tile_size or max(h, w) <= tile_size:
+        return cv2.fastNlMeansDenoisingColored(img, None, NLM_STRENGTH, NLM_STRENGTH,
+                                               NLM_TEMPLATE_WINDOW, NLM_SEARCH_WINDOW)
+    out = np.empty_like(img)
+
+    def denoise_tile(origin):
+        y, x = origin
+        y0, x0 = max(0, y - NLM_HALO), max(0, x - NLM_HALO)
+        y1, x1 = min(h, y + tile_size + NLM_HALO), min(w, x + tile_size + NLM_HALO)
+        tile = cv2.fastNlMeansDenoisingColored(img[y0:y1, x0:x1], None, NLM_STRENGTH, NLM_STRENGTH,
+                                               NLM_TEMPLATE_WINDOW, NLM_SEARCH_WINDOW)
+        rows, cols = min(tile_size, h - y), min(tile_size, w - x)
+        out[y:y + rows, x:x + cols] = tile[y - y0:y - y0 + rows, x - x0:x - x0 + cols]
+
+    origins = [(y, x) for y in range(0, h, tile_size) for x in range(0, w, tile_size)]
+    with ThreadPoolExecutor(max_workers=min(len(origins), workers or _tile_workers())) as pool:
+        list(pool.map(denoise_tile, origins))
+    return out
+
+def otsu_threshold(hist):
+    """Otsu's threshold for a 256-bin histogram (the value THRESH_OTSU picks for that image)."""
+    hist = hist.astype(np.float64)
+    levels = np.arange(256)
+    weight_bg = np.cumsum(hist)
+    weight_fg = weight_bg[-1] - weight_bg
+    sum_bg = np.cumsum(hist * levels)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_bg = sum_bg / weight_bg
+        mean_fg = (sum_bg[-1] - sum_bg) / weight_fg
+        between = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+    return int(np.argmax(np.nan_to_num(between)))
+
+def enhance_chalkboard_tiled(img, with_edges=True, tile_size=1024):
+    """
+    enhance_chalkboard in bands of tile_size rows, for very large images.
+    The Otsu threshold and the invert decision come from a histogram of the whole blurred image,
+    so the binarized result is the same as enhance_chalkboard's; only Canny's hysteresis can
+    differ where an edge crosses a band boundary.
+    """
+    h = img.shape[0]
+
+    def bands():
+        for y in range(0, h, tile_size):
+            y0, y1 = max(0, y - ENHANCE_HALO), min(h, y + tile_size + ENHANCE_HALO)
+            blur = cv2.medianBlur(cv2.cvtColor(img[y0:y1], cv2.COLOR_BGR2GRAY), 3)
+            yield y, min(tile_size, h - y), y - y0, blur
+
+    hist = np.zeros(256, np.int64)
+    for y, rows, top, blur in bands():
+        hist += np.bincount(blur[top:top + rows].ravel(), minlength=256)
+    thresh = otsu_threshold(hist)
+    # Same test as np.mean(th) < 127 on the full thresholded image
+    invert = 255 * hist[thresh + 1:].sum() / hist.sum() < 127
+
+    kernel = np.ones((2, 2), np.uint8)
+    closed = np.empty(img.shape[:2], np.uint8)
+    edges = np.empty(img.shape[:2], np.uint8) if with_edges else None
+    for y, rows, top, blur in bands():
+        _, th = cv2.threshold(blur, thresh, 255, cv2.THRESH_BINARY)
+        if invert:
+            th = cv2.bitwise_not(th)
+        band = cv2.morphologyEx(cv2.morphologyEx(th, cv2.MORPH_OPEN, kernel), cv2.MORPH_CLOSE, kernel)
+        closed[y:y + rows] = band[top:top + rows]
+        if with_edges:
+            edges[y:y + rows] = cv2.Canny(blur, 50, 150)[top:top + rows]
     return closed, edges
 
 
+# ---- denoise profiles ----
+DENOISE_PROFILES = ("fast", "quality", "auto")
+NOISE_THRESHOLD = 6.0  # auto: estimated (grayscale) noise sigma above which NLM is worth its cost
+NOISE_PATCH = 256
+_NOISE_KERNEL = np.array([[1, -2, 1], [-2, 4, -2], [1, -2, 1]], np.float32)
+
+def estimate_noise(img):
+    """
+    Noise sigma of a photo with Immerkaer's fast estimator, measured on a 4x4 grid of patches
+    and reduced with the median, so chalk strokes don't skew it and big images stay cheap.
+    """
+    h, w = img.shape[:2]
+    p = NOISE_PATCH
+    ys = sorted(set(np.linspace(0, max(0, h - p), 4).astype(int)))
+    xs = sorted(set(np.linspace(0, max(0, w - p), 4).astype(int)))
+    sigmas = []
+    for y in ys:
+        for x in xs:
+            gray = cv2.cvtColor(img[y:y + p, x:x + p], cv2.COLOR_BGR2GRAY).astype(np.float32)
+            if min(gray.shape) < 3:
+                continue
+            residual = cv2.filter2D(gray, -1, _NOISE_KERNEL)[1:-1, 1:-1]
+            sigmas.append(np.abs(residual).sum() * np.sqrt(np.pi / 2) / (6 * residual.size))
+    return float(np.median(sigmas)) if sigmas else 0.0
+
+def choose_profile(img, profile="auto", noise_threshold=NOISE_THRESHOLD):
+    """(profile, noise sigma): 'auto' resolves to 'quality' only for images noisy enough to need NLM."""
+    if profile not in DENOISE_PROFILES:
+        raise ValueError(f"Unknown denoise profile {profile!r}, expected one of {DENOISE_PROFILES}")
+    if profile != "auto":
+        return profile, None
+    sigma = estimate_noise(img)
+    return ("quality" if sigma > noise_threshold else "fast"), sigma
+
+def denoise_fast(img):
+    """Cheap pre-binarization smoothing: enhance_chalkboard's median blur + Otsu do the rest."""
+    return cv2.GaussianBlur(img, (5, 5), 0)
+
+
 def run_denoise(
     in_path="raw/TestImage2.jpeg",
     processed_dir="processed"
@@ -28,8 +162,7 @@ def run_denoise(
         raise FileNotFoundError(f"Couldn't read {in_path} - did you put the image in raw/?")
 
     # ---- denoise ----
-    denoise_strength = 10
-    img_dn = cv2.fastNlMeansDenoisingColored(img, None, denoise_strength, denoise_strength, 7, 21)
+    img_dn = denoise_nlm(img)
     denoised_path = os.path.join(processed_dir, f"{base_name}_denoised.jpg")
     cv2.imwrite(denoised_path, img_dn)
     print(f"Saved denoised image → {denoised_path}")
@@ -51,5 +184,193 @@ def run_denoise(
         "edges": edg_path,
     }
 
+# ---- parallel denoising ----
+_pool = None
+_pool_workers = None
+_pool_lock = threading.Lock()
+
+def _init_denoise_worker():
+    # One image per process already saturates a core; stop cv2 (and tiling) from oversubscribing
+    global _tile_threads
+    cv2.setNumThreads(1)
+    _tile_threads = 1
+
+def _get_pool(workers):
+    """
+    Shared process pool, rebuilt only when the worker count changes (or after a worker died).
+    The workers are spawned, so they import the calling script's __main__ module: a script that
+    denoises in parallel must keep its top-level code under `if __name__ == "__main__":`.
+    """
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            # spawn, not fork: the web app calls this from worker threads
+            _pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=mp.get_context("spawn"),
+                initializer=_init_denoise_worker,
+            )
+            _pool_workers = workers
+        return _pool
+
+def _discard_pool(pool):
+    """Drop a broken pool (unless another thread already replaced it) so the next call starts a fresh one."""
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is pool:
+            _pool.shutdown(wait=False)
+            _pool = _pool_workers = None
+
+def _map_in_pool(func, arg_tuples, workers=None, on_progress=None):
+    """
+    Run func(*args) for each args tuple across the process pool.
+    Results are returned in input order, whatever order they finish in.
+    workers defaults to the CPU count; on_progress(done, total) is called as items finish.
+    If a worker dies (OOM kill, a crash in cv2), the batch is retried once on a fresh pool.
+    """
+    arg_tuples = list(arg_tuples)
+    total = len(arg_tuples)
+    workers = workers or os.cpu_count() or 1
+    results = [None] * total
+
+    # A single image (or a single worker) isn't worth the IPC; cv2 can use its own threads
+    if total <= 1 or workers <= 1:
+        for idx, args in enumerate(arg_tuples):
+            results[idx] = func(*args)
+            if on_progress:
+                on_progress(idx + 1, total)
+        return results
+
+    for attempt in range(2):
+        pool = _get_pool(workers)
+        try:
+            futures = {pool.submit(func, *args): idx for idx, args in enumerate(arg_tuples)}
+            for done, fut in enumerate(as_completed(futures), start=1):
+                results[futures[fut]] = fut.result()
+                if on_progress:
+                    on_progress(done, total)
+            return results
+        except BrokenProcessPool:
+            _discard_pool(pool)
+            if attempt:
+                raise RuntimeError("Denoise worker processes keep dying (out of memory? if this is a script, "
+                                   "is its code under `if __name__ == \"__main__\":`?)")
+            print("[WARN] A denoise worker process died, retrying on a fresh pool")
+
+def run_denoise_many(in_paths, processed_dir="processed", workers=None, on_progress=None):
+    """run_denoise over several image files in parallel; results keep the input order."""
+    return _map_in_pool(run_denoise, [(path, processed_dir) for path in in_paths],
+                        workers=workers, on_progress=on_progress)
+
+# ---- vision preprocessing ----
+VISION_EXT = ".png"  # the enhanced image is black on white, which PNG compresses far better than JPEG
+VISION_MAX_SHORT_EDGE = 768  # GPT-4o high detail rescales the short side to this anyway
+
+def fit_for_vision(img, max_long_edge=None, max_short_edge=VISION_MAX_SHORT_EDGE):
+    """Downscale (never upscale) so neither edge exceeds its limit; INTER_AREA keeps thin strokes visible."""
+    h, w = img.shape[:2]
+    scale = 1.0
+    if max_long_edge:
+        scale = min(scale, max_long_edge / max(h, w))
+    if max_short_edge:
+        scale = min(scale, max_short_edge / min(h, w))
+    if scale >= 1.0:
+        return img
+    size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+def encode_for_vision(img):
+    """Compact PNG; still-binary images (nothing was resized) are packed 1 bit per pixel."""
+    params = [cv2.IMWRITE_PNG_COMPRESSION, 9]
+    if img.ndim == 2 and cv2.countNonZero(cv2.inRange(img, 1, 254)) == 0:
+        params += [cv2.IMWRITE_PNG_BILEVEL, 1]
+    ok, buf = cv2.imencode(VISION_EXT, img, params)
+    if not ok:
+        raise ValueError("Couldn't encode vision image")
+    return buf.tobytes()
+
+# ---- in-memory pipeline (no temp files) ----
+DENOISE_OUTPUTS = ("denoised", "enhanced", "edges", "vision")
+
+def denoise_image_bytes(data, outputs=("enhanced",), ext=".jpg", vision_max_edge=None, with_info=False,
+                        tile_size=None, profile="quality", noise_threshold=NOISE_THRESHOLD):
+    """
+    Same pipeline as run_denoise, but bytes in -> encoded bytes out.
+    Only the requested outputs are computed and encoded (e.g. edges are skipped unless asked for).
+    Returns {output_name: encoded bytes} using the image format given by ext, except "vision":
+    the enhanced image downscaled to vision_max_edge and encoded with encode_for_vision.
+    profile is "quality" (NLM), "fast" (denoise_fast) or "auto" (see choose_profile).
+    with_info=True returns (encoded, info) where info has the chosen "profile", the estimated
+    "noise_sigma" (auto only) and "timings" {step: seconds} for decode/noise/nlm|fast/enhance/encode.
+    Images with an edge longer than tile_size are processed tile by tile (see denoise_nlm).
+    """
+    unknown = set(outputs) - set(DENOISE_OUTPUTS)
+    if unknown:
+        raise ValueError(f"Unknown denoise outputs: {sorted(unknown)}")
+    timings = {}
+    started = time.perf_counter()
+
+    def lap(step):
+        nonlocal started
+        now = time.perf_counter()
+        timings[step] = now - started
+        started = now
+
+    # ---- decode the uploaded image ----
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("Couldn't decode image - is it a valid png/jpg/gif/bmp?")
+    lap("decode")
+
+    # ---- denoise ----
+    tiled = bool(tile_size) and max(img.shape[:2]) > tile_size
+    profile, sigma = choose_profile(img, profile, noise_threshold)
+    if sigma is not None:
+        lap("noise")
+    if profile == "quality":
+        img_dn = denoise_nlm(img, tile_size=tile_size)
+        lap("nlm")
+    else:
+        img_dn = denoise_fast(img)
+        lap("fast")
+    del img
+    images = {"denoised": img_dn}
+
+    # ---- enhance + edges (only if needed) ----
+    if "enhanced" in outputs or "edges" in outputs or "vision" in outputs:
+        if tiled:
+            enh, edg = enhance_chalkboard_tiled(img_dn, with_edges="edges" in outputs, tile_size=tile_size)
+        else:
+            enh, edg = enhance_chalkboard(img_dn, with_edges="edges" in outputs)
+        images["enhanced"] = enh
+        images["edges"] = edg
+        lap("enhance")
+
+    encoded = {}
+    for name in outputs:
+        if name == "vision":
+            encoded[name] = encode_for_vision(fit_for_vision(images["enhanced"], vision_max_edge))
+            continue
+        ok, buf = cv2.imencode(ext, images[name])
+        if not ok:
+            raise ValueError(f"Couldn't encode {name} image as {ext}")
+        encoded[name] = buf.tobytes()
+    lap("encode")
+    if with_info:
+        return encoded, {"profile": profile, "noise_sigma": None if sigma is None else round(sigma, 2),
+                         "timings": timings}
+    return encoded
+
+def denoise_bytes_many(images, outputs=("enhanced",), ext=".jpg", workers=None, on_progress=None,
+                       vision_max_edge=None, with_info=False, tile_size=None, profile="quality",
+                       noise_threshold=NOISE_THRESHOLD):
+    """denoise_image_bytes over several images in parallel; results keep the input order."""
+    return _map_in_pool(denoise_image_bytes,
+                        [(data, tuple(outputs), ext, vision_max_edge, with_info, tile_size, profile, noise_threshold)
+                         for data in images],
+                        workers=workers, on_progress=on_progress)
+
 if __name__ == "__main__":
     run_denoise()
@@ -0,0 +1,331 @@
+# Background job queue for /upload
+# Uploads are queued and processed by a small pool of worker threads so the
+# denoise -> vision -> compile pipeline never blocks a Flask request thread.
+# With a shared store (serve.py), every job is also published there so the other
+# worker processes can answer /jobs/<id> polls and streams for it.
+
+import queue
+import threading
+import time
+import uuid
+import traceback
+from typing import Optional, Dict, Any, Callable
+
+STAGES = ("denoise", "vision", "compile")
+PUBLISH_INTERVAL = 0.2  # seconds between writes of streamed output to the shared store
+POLL_INTERVAL = 0.25  # how often a job of another worker is re-read while waiting for updates
+
+
+class QueueFull(Exception):
+    """Raised by JobQueue.submit when the queue cannot take another job."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Job queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class Job:
+    """One queued pipeline run with per-stage progress."""
+
+    def __init__(self, func: Callable, args: tuple, kwargs: Dict[str, Any], store=None):
+        self.id = uuid.uuid4().hex
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.status = "queued"  # queued -> running -> done | failed
+        self.stages = {name: {"status": "pending"} for name in STAGES}
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.output = []  # streamed text chunks (e.g. LaTeX token deltas), see emit()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self.store = store
+        self._publish_lock = threading.Lock()  # keeps published output chunks in order
+        self._published_chunks = 0
+        self._published_at = 0.0
+
+    def publish(self, force: bool = True):
+        """Write status, stages, result and new output to the shared store (output at most every PUBLISH_INTERVAL unless forced)."""
+        if self.store is None:
+            return
+        with self._publish_lock:
+            with self._lock:
+                now = time.monotonic()
+                if not force and now - self._published_at < PUBLISH_INTERVAL:
+                    return
+                first = self._published_chunks
+                chunks = self.output[first:]
+                status, state, result = self.status, self._to_dict(), self.result
+                self._published_chunks += len(chunks)
+                self._published_at = now
+            try:
+                self.store.save_job(self.id, status, state, result, first, chunks)
+            except Exception as e:
+                with self._lock:
+                    self._published_chunks = first  # resend them with the next update
+                print(f"[WARN] Could not publish job {self.id}: {e}")
+
+    def set_stage(self, stage: str, status: str, detail: Optional[str] = None):
+        """Progress callback handed to the job function: set_stage('vision', 'running')."""
+        with self._lock:
+            entry = self.stages.setdefault(stage, {"status": "pending"})
+            entry["status"] = status
+            if status == "running":
+                entry["started_at"] = time.time()
+            elif status in ("done", "failed", "skipped"):
+                entry["finished_at"] = time.time()
+            if detail is not None:
+                entry["detail"] = detail
+            self._changed.notify_all()
+        self.publish()
+
+    def emit(self, text: str):
+        """Streaming callback handed to the job function: append a chunk of output."""
+        if not text:
+            return
+        with self._lock:
+            self.output.append(text)
+            self._changed.notify_all()
+        self.publish(force=False)
+
+    def set_status(self, status: str):
+        with self._lock:
+            self.status = status
+            now = time.time()
+            if status == "running":
+                self.started_at = now
+            elif status in ("done", "failed"):
+                self.finished_at = now
+            self._changed.notify_all()
+        self.publish()
+
+    def wait_for_update(self, seen_chunks: int, seen_version: tuple, timeout: float) -> bool:
+        """Block until new output, a stage change or a status change arrives (or timeout)."""
+        with self._lock:
+            return self._changed.wait_for(
+                lambda: len(self.output) > seen_chunks or self._version() != seen_version,
+                timeout=timeout,
+            )
+
+    def _version(self) -> tuple:
+        return (self.status,) + tuple((k, v["status"], v.get("detail")) for k, v in self.stages.items())
+
+    def version(self) -> tuple:
+        """Snapshot of status + stage progress; changes whenever either does."""
+        with self._lock:
+            return self._version()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def _to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "stages": {k: dict(v) for k, v in self.stages.items()},
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return self._to_dict()
+
+
+class StoredJob:
+    """
+    Read-only view of a job run by another worker process, loaded from the shared store.
+    Offers what the /jobs routes use of a Job; wait_for_update() polls the store.
+    """
+
+    def __init__(self, store, job_id: str, row):
+        self.id = job_id
+        self.store = store
+        self.output = []
+        self._load(row)
+        self.output.extend(store.job_output(job_id))
+
+    def _load(self, row):
+        self.status, self._state, self.result = row
+        self.error = self._state.get("error")
+        self.created_at = self._state["created_at"]
+
+    def refresh(self):
+        """Re-read status and new output (status first: output published with it is then already there)."""
+        row = self.store.load_job(self.id)
+        if row is not None:
+            self._load(row)
+        self.output.extend(self.store.job_output(self.id, len(self.output)))
+
+    def wait_for_update(self, seen_chunks: int, seen_version: tuple, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while True:
+            self.refresh()
+            if len(self.output) > seen_chunks or self.version() != seen_version:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(POLL_INTERVAL, remaining))
+
+    def version(self) -> tuple:
+        return (self.status,) + tuple((k, v["status"], v.get("detail")) for k, v in self._state["stages"].items())
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {**self._state, "stages": {k: dict(v) for k, v in self._state["stages"].items()}}
+
+
+class JobQueue:
+    """
+    Bounded in-process job queue served by a fixed pool of worker threads.
+    `workers` jobs run concurrently and at most `max_queued` more may wait;
+    beyond that submit() raises QueueFull so the caller can answer 429.
+    With a shared store (see shared_state.py) jobs of other worker processes can be looked up too,
+    and queue positions count the jobs waiting on all of them.
+    """
+
+    def __init__(self, workers: int = 2, max_queued: int = 8, retention_seconds: int = 3600, store=None):
+        self.workers = max(1, int(workers))
+        self.max_queued = max(1, int(max_queued))
+        self.retention_seconds = retention_seconds
+        self.store = store
+        self._closed = False
+        self._queue: "queue.Queue[Job]" = queue.Queue(maxsize=self.max_queued)
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+        self._threads = []
+        self._durations = []  # recent job durations, used for Retry-After estimates
+
+    def _ensure_started(self):
+        # Workers are started lazily so importing app.py (e.g. the debug reloader) doesn't spawn threads
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker, name=f"upload-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            job.set_status("running")
+            try:
+                job.result = job.func(*job.args, progress=job.set_stage, emit=job.emit, **job.kwargs)
+                job.set_status("done")
+            except Exception as e:
+                print(f"[ERROR] Job {job.id} failed: {str(e)}")
+                traceback.print_exc()
+                job.error = str(e)
+                for stage, entry in list(job.stages.items()):
+                    if entry["status"] == "running":
+                        job.set_stage(stage, "failed")
+                job.set_status("failed")
+            finally:
+                # Drop references to the (possibly large) inputs once the job is over
+                job.args, job.kwargs = (), {}
+                with self._lock:
+                    self._durations = (self._durations + [job.finished_at - job.started_at])[-20:]
+                self._queue.task_done()
+
+    def _prune(self):
+        cutoff = time.time() - self.retention_seconds
+        with self._lock:
+            stale = [jid for jid, j in self._jobs.items() if j.finished and j.finished_at < cutoff]
+            for jid in stale:
+                del self._jobs[jid]
+        if self.store is not None:
+            try:
+                self.store.prune_jobs(cutoff)
+            except Exception as e:
+                print(f"[WARN] Could not prune stored jobs: {e}")
+
+    def retry_after(self) -> int:
+        """Rough number of seconds until a queue slot frees up."""
+        with self._lock:
+            avg = sum(self._durations) / len(self._durations) if self._durations else 30.0
+        return max(1, int(avg / self.workers + 0.5))
+
+    def submit(self, func: Callable, *args, **kwargs) -> Job:
+        """Queue func(*args, progress=..., emit=..., **kwargs); raises QueueFull when saturated."""
+        if self._closed:
+            raise QueueFull(1)  # shutting down; the retry reaches another worker
+        self._ensure_started()
+        self._prune()
+        job = Job(func, args, kwargs, store=self.store)
+        with self._lock:
+            self._jobs[job.id] = job
+        job.publish()  # before a worker thread can pick it up and publish "running"
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            # Never ran: forget it rather than leave a failed job behind in the store and the job counts
+            with self._lock:
+                del self._jobs[job.id]
+            if self.store is not None:
+                try:
+                    self.store.delete_job(job.id)
+                except Exception as e:
+                    print(f"[WARN] Could not remove refused job {job.id}: {e}")
+            raise QueueFull(self.retry_after())
+        return job
+
+    def get(self, job_id: str):
+        """The Job, or a StoredJob if another worker process runs it (None if unknown)."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and self.store is not None:
+            row = self.store.load_job(job_id)
+            if row is not None:
+                job = StoredJob(self.store, job_id, row)
+        return job
+
+    def position(self, job) -> int:
+        """1-based position of a queued job among the waiting jobs (0 once it has started)."""
+        if job.status != "queued":
+            return 0
+        if self.store is not None:
+            return self.store.queued_ahead(job.created_at) + 1
+        with self._lock:
+            waiting = sorted((j for j in self._jobs.values() if j.status == "queued"), key=lambda j: j.created_at)
+        for i, j in enumerate(waiting):
+            if j is job:
+                return i + 1
+        return 0
+
+    def drain(self, timeout: float) -> bool:
+        """Refuse new jobs and wait up to `timeout` seconds for the queued and running ones. True if all finished."""
+        self._closed = True
+        deadline = time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            jobs = list(self._jobs.values())
+        stats = {
+            "workers": self.workers,
+            "max_queued": self.max_queued,
+            "queued": sum(1 for j in jobs if j.status == "queued"),
+            "running": sum(1 for j in jobs if j.status == "running"),
+            "done": sum(1 for j in jobs if j.status == "done"),
+            "failed": sum(1 for j in jobs if j.status == "failed"),
+        }
+        if self.store is not None:
+            stats["all_workers"] = self.store.job_counts()  # this process's counts are above
+        return stats
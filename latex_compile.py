@@ -0,0 +1,431 @@
+# LaTeX -> PDF compilation with a warm, reused preamble
+#
+# Notes generated from the same prompt mostly share an identical preamble
+# (\documentclass + amsmath/amssymb/amsthm ...). The first time a preamble is
+# seen it is dumped into a format file with mylatexformat; later compiles of any
+# note with that preamble load the format instead of re-parsing the packages.
+#
+# Every compile runs in its own temporary build directory; the finished PDF is
+# moved into docs_dir atomically, and a CompilePool bounds how many run at once.
+
+import os
+import re
+import signal
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Optional, Dict, Any
+
+from metrics import COMPILES, record
+
+# Preambles every note starts from (see SYSTEM_PROMPT and clean_latex_source in app.py)
+COMMON_PREAMBLES = (
+    "\\documentclass[12pt]{article}\n\\usepackage{amsmath, amssymb, amsfonts, amsthm}\n",
+    "\\documentclass{article}\n\\usepackage{amsmath}\n\\usepackage{amssymb}\n",
+)
+
+_BEGIN_DOCUMENT = re.compile(r"\\begin\s*\{document\}")
+# Anything written to the .aux that a second pass could need
+_CROSSREF_AUX = re.compile(r"\\(newlabel|bibcite|@writefile|citation)\b")
+_RERUN_LOG = re.compile(r"Rerun to get|Label\(s\) may have changed|There were undefined references")
+# Kept between compiles of a note so latexmk can reuse its state after a correction
+STATE_EXTENSIONS = (".aux", ".fdb_latexmk", ".fls", ".log")
+
+
+class CompileTimeout(Exception):
+    pass
+
+
+class CompileQueueFull(Exception):
+    """Raised by CompilePool.submit when too many compiles are waiting."""
+
+
+def split_preamble(latex: str):
+    """(preamble, rest) split at \\begin{document}; preamble is None if there is no document body."""
+    m = _BEGIN_DOCUMENT.search(latex)
+    if not m:
+        return None, latex
+    return latex[:m.start()], latex[m.start():]
+
+
+def normalize_preamble(preamble: str) -> str:
+    """Drop blank lines and trailing whitespace so cosmetic differences share one format."""
+    lines = [line.rstrip() for line in preamble.splitlines()]
+    return "\n".join(line for line in lines if line) + "\n"
+
+
+def preamble_key(preamble: str) -> str:
+    return hashlib.sha256(normalize_preamble(preamble).encode("utf-8")).hexdigest()[:16]
+
+
+def needs_second_pass(aux_before: Optional[str], aux_after: Optional[str], log: str) -> bool:
+    """A second pdflatex run only matters if LaTeX asked for it or cross-reference data changed."""
+    if _RERUN_LOG.search(log or ""):
+        return True
+    if not aux_after or not _CROSSREF_AUX.search(aux_after):
+        return False
+    return aux_after != aux_before
+
+
+def extract_log_errors(log_path: str, limit: int = 10) -> Optional[str]:
+    """Last few 'Error'/'Fatal' lines of a LaTeX log, or None."""
+    if not os.path.exists(log_path):
+        return None
+    with open(log_path, 'r', errors='ignore') as f:
+        log_content = f.read()
+    error_lines = [line for line in log_content.split('\n') if 'Error' in line or 'Fatal' in line]
+    return '\n'.join(error_lines[-limit:]) if error_lines else None
+
+
+def _run(cmd, cwd: str, env: Dict[str, str], deadline: float):
+    """
+    Run cmd in its own process group, killing the whole group (latexmk and the
+    pdflatex it spawned) if the job's deadline passes.
+    """
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise CompileTimeout()
+    proc = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            start_new_session=True)
+    try:
+        stdout, stderr = proc.communicate(timeout=remaining)
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        proc.communicate()
+        raise CompileTimeout()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, output=stdout, stderr=stderr)
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path, 'r', errors='ignore') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+class LatexCompiler:
+    """
+    Compiles notes in docs_dir to PDF, each in an isolated temporary build directory.
+    latexmk is preferred (its .fdb_latexmk/.aux from the note's previous compile are
+    restored, so recompiles after a correction reuse them); plain pdflatex is the
+    fallback and only runs a second pass when the .aux shows cross-references that
+    changed. Both load a precompiled preamble format from fmt_dir when one exists.
+    """
+
+    def __init__(self, docs_dir: str, fmt_dir: Optional[str] = None, build_root: Optional[str] = None,
+                 timeout: int = 60, use_formats: bool = True):
+        self.docs_dir = docs_dir
+        self.fmt_dir = os.path.abspath(fmt_dir or os.path.join(docs_dir, ".formats"))
+        # Inside docs_dir so the final os.replace of the PDF stays on one filesystem (atomic)
+        self.build_root = os.path.abspath(build_root or os.path.join(docs_dir, ".build"))
+        self.timeout = timeout
+        self.use_formats = use_formats
+        self._building = set()
+        self._lock = threading.Lock()
+        self._formats_supported = None
+
+    # ---------- preamble formats ----------
+    def formats_supported(self) -> bool:
+        """pdftex and mylatexformat.ltx are both needed to dump a preamble."""
+        if self._formats_supported is None:
+            supported = bool(self.use_formats and shutil.which("pdftex") and shutil.which("kpsewhich"))
+            if supported:
+                try:
+                    found = subprocess.run(["kpsewhich", "mylatexformat.ltx"], stdout=subprocess.PIPE,
+                                           stderr=subprocess.DEVNULL, timeout=10)
+                    supported = bool(found.stdout.strip())
+                except (OSError, subprocess.SubprocessError):
+                    supported = False
+            if not supported and self.use_formats:
+                print("[INFO] pdftex/mylatexformat not available, compiling without preamble formats")
+            self._formats_supported = supported
+        return self._formats_supported
+
+    def format_for(self, preamble: str) -> Optional[str]:
+        """Name of a ready format for this preamble, or None."""
+        key = preamble_key(preamble)
+        if os.path.exists(os.path.join(self.fmt_dir, f"{key}.fmt")):
+            return key
+        return None
+
+    def build_format(self, preamble: str) -> Optional[str]:
+        """Dump preamble into <fmt_dir>/<key>.fmt with mylatexformat. Returns the format name or None."""
+        if not self.formats_supported():
+            return None
+        key = preamble_key(preamble)
+        fmt_path = os.path.join(self.fmt_dir, f"{key}.fmt")
+        failed_marker = os.path.join(self.fmt_dir, f"{key}.failed")
+        if os.path.exists(fmt_path):
+            return key
+        if os.path.exists(failed_marker):
+            return None  # some preambles can't be dumped (e.g. packages that write files); don't retry
+        with self._lock:
+            if key in self._building:
+                return None
+            self._building.add(key)
+        os.makedirs(self.fmt_dir, exist_ok=True)
+        work_dir = tempfile.mkdtemp(prefix=f"fmt-{key}-", dir=self.fmt_dir)
+        try:
+            with open(os.path.join(work_dir, f"{key}.tex"), "w") as f:
+                f.write(normalize_preamble(preamble) + "\\begin{document}\n\\end{document}\n")
+            started = time.time()
+            _run(["pdftex", "-ini", "-interaction=nonstopmode", f"-jobname={key}",
+                  "&pdflatex", "mylatexformat.ltx", f"{key}.tex"],
+                 cwd=work_dir, env=dict(os.environ), deadline=started + self.timeout)
+            os.replace(os.path.join(work_dir, f"{key}.fmt"), fmt_path)
+            print(f"[INFO] Built preamble format {key} in {time.time() - started:.1f}s")
+            return key
+        except (OSError, subprocess.SubprocessError, CompileTimeout) as e:
+            print(f"[WARN] Could not build preamble format {key} ({e!r}); notes with it compile without a format")
+            open(failed_marker, "w").close()
+            return None
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            with self._lock:
+                self._building.discard(key)
+
+    def build_format_async(self, preamble: str):
+        threading.Thread(target=self.build_format, args=(preamble,), daemon=True).start()
+
+    def warm(self, preambles=COMMON_PREAMBLES):
+        """Precompile the common preambles in the background so the first notes already hit a format."""
+        def _warm():
+            for preamble in preambles:
+                self.build_format(preamble)
+        threading.Thread(target=_warm, name="latex-format-warmup", daemon=True).start()
+
+    def _env(self):
+        env = dict(os.environ)
+        # Trailing separator keeps kpathsea's default format path after ours
+        env["TEXFORMATS"] = self.fmt_dir + os.pathsep + env.get("TEXFORMATS", "")
+        return env
+
+    # ---------- per-note build state ----------
+    def state_dir(self, note_name: str) -> str:
+        return os.path.join(self.build_root, "state", note_name)
+
+    def _restore_state(self, note_name: str, build_dir: str):
+        state_dir = self.state_dir(note_name)
+        for ext in (".aux", ".fdb_latexmk"):
+            src = os.path.join(state_dir, f"{note_name}{ext}")
+            if os.path.exists(src):
+                shutil.copy2(src, build_dir)
+
+    def _save_state(self, note_name: str, build_dir: str):
+        state_dir = self.state_dir(note_name)
+        os.makedirs(state_dir, exist_ok=True)
+        for ext in STATE_EXTENSIONS:
+            src = os.path.join(build_dir, f"{note_name}{ext}")
+            if os.path.exists(src):
+                os.replace(src, os.path.join(state_dir, f"{note_name}{ext}"))
+
+    def remove_state(self, note_name: str):
+        if note_name in ("", ".", "..") or os.sep in note_name:
+            return
+        shutil.rmtree(self.state_dir(note_name), ignore_errors=True)
+
+    # ---------- compilation ----------
+    def compile(self, note_name: str) -> Dict[str, Any]:
+        """
+        Compile <docs_dir>/<note_name>.tex in a fresh build directory and move the PDF
+        to <docs_dir>/<note_name>.pdf. The whole job (all passes) shares one timeout.
+        A PDF built despite LaTeX errors is kept, with the errors in compilation_error.
+        Returns {"pdf_path", "compilation_error", "engine", "passes", "format", "seconds"}.
+        """
+        started = time.time()
+        deadline = started + self.timeout
+        tex_path = os.path.join(self.docs_dir, f"{note_name}.tex")
+        preamble, _ = split_preamble(_read(tex_path) or "")
+        fmt = None
+        if preamble is not None and self.formats_supported():
+            fmt = self.format_for(preamble)
+            if fmt is None:
+                # Compile this one normally; the next note with the same preamble gets the format
+                self.build_format_async(preamble)
+
+        tmp_root = os.path.join(self.build_root, "tmp")
+        os.makedirs(tmp_root, exist_ok=True)
+        build_dir = tempfile.mkdtemp(prefix=f"{note_name}-", dir=tmp_root)
+        try:
+            shutil.copy2(tex_path, build_dir)
+            self._restore_state(note_name, build_dir)
+
+            result = self._compile_latexmk(note_name, build_dir, fmt, deadline)
+            if result is None:
+                print("[WARN] latexmk not found, trying pdflatex...")
+                result = self._compile_pdflatex(note_name, build_dir, fmt, deadline)
+
+            built_pdf = os.path.join(build_dir, f"{note_name}.pdf")
+            # nonstopmode still writes a PDF past most LaTeX errors: keep it and report the errors with it.
+            # A timed-out run was killed, possibly mid-write, so its PDF isn't trusted.
+            timed_out = (result["compilation_error"] or "").startswith("Compilation timed out")
+            if not timed_out and os.path.exists(built_pdf) and os.path.getsize(built_pdf) > 0:
+                final_pdf = os.path.join(self.docs_dir, f"{note_name}.pdf")
+                os.replace(built_pdf, final_pdf)  # readers never see a half-written PDF
+                result["pdf_path"] = final_pdf
+            elif result["compilation_error"] is None and result["engine"]:
+                print(f"[WARN] PDF file not found after {result['engine']} compilation")
+                result["compilation_error"] = extract_log_errors(
+                    os.path.join(build_dir, f"{note_name}.log"), limit=5)
+            self._save_state(note_name, build_dir)
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+
+        result["format"] = fmt
+        result["seconds"] = round(time.time() - started, 3)
+        if result["pdf_path"]:
+            print(f"[INFO] PDF generated with {result['engine']} → {result['pdf_path']}"
+                  f" ({result['seconds']}s{', format ' + fmt if fmt else ''})")
+        return result
+
+    def _compile_latexmk(self, note_name: str, build_dir: str, fmt: Optional[str],
+                         deadline: float) -> Optional[Dict[str, Any]]:
+        """None if latexmk isn't installed."""
+        cmd = ["latexmk", "-pdf", "-interaction=nonstopmode", f"{note_name}.tex"]
+        if fmt:
+            cmd.append(f"-pdflatex=pdflatex -fmt={fmt} %O %S")
+        log_path = os.path.join(build_dir, f"{note_name}.log")
+        result = {"pdf_path": None, "compilation_error": None, "engine": "latexmk", "passes": None}
+        try:
+            _run(cmd, cwd=build_dir, env=self._env(), deadline=deadline)
+        except FileNotFoundError:
+            return None
+        except CompileTimeout:
+            print("[WARN] PDF compilation timed out")
+            result["compilation_error"] = f"Compilation timed out after {self.timeout} seconds"
+        except subprocess.CalledProcessError as e:
+            print("[WARN] LaTeX compilation failed")
+            stderr_output = e.stderr.decode("utf-8", errors="ignore")
+            stdout_output = e.stdout.decode("utf-8", errors="ignore")
+            result["compilation_error"] = extract_log_errors(log_path) or \
+                (stderr_output[:1000] if stderr_output else stdout_output[:1000]) or \
+                f"latexmk exited with status {e.returncode}"
+            print(f"[ERROR] Compilation error:\n{result['compilation_error']}")
+        return result
+
+    def _run_pdflatex(self, note_name: str, build_dir: str, fmt: Optional[str], deadline: float):
+        cmd = ["pdflatex", "-interaction=nonstopmode"]
+        if fmt:
+            cmd.append(f"-fmt={fmt}")
+        cmd.append(f"{note_name}.tex")
+        _run(cmd, cwd=build_dir, env=self._env(), deadline=deadline)
+
+    def _compile_pdflatex(self, note_name: str, build_dir: str, fmt: Optional[str],
+                          deadline: float) -> Dict[str, Any]:
+        aux_path = os.path.join(build_dir, f"{note_name}.aux")
+        log_path = os.path.join(build_dir, f"{note_name}.log")
+        result = {"pdf_path": None, "compilation_error": None, "engine": "pdflatex", "passes": 0}
+        try:
+            aux_before = _read(aux_path)
+            self._run_pdflatex(note_name, build_dir, fmt, deadline)
+            result["passes"] = 1
+            # Second run only for references/TOC that changed in this pass
+            if needs_second_pass(aux_before, _read(aux_path), _read(log_path)):
+                self._run_pdflatex(note_name, build_dir, fmt, deadline)
+                result["passes"] = 2
+        except FileNotFoundError as e:
+            print(f"[WARN] pdflatex also failed: {str(e)}")
+            result["engine"] = None
+        except CompileTimeout:
+            print("[WARN] PDF compilation timed out")
+            result["compilation_error"] = f"Compilation timed out after {self.timeout} seconds"
+        except subprocess.CalledProcessError as e:
+            print(f"[WARN] pdflatex also failed: {str(e)}")
+            result["compilation_error"] = extract_log_errors(log_path) or \
+                e.stderr.decode("utf-8", errors="ignore")[:1000] or f"pdflatex exited with status {e.returncode}"
+        return result
+
+
+class CompilePool:
+    """
+    Bounded pool of compile workers in front of a LatexCompiler.
+    At most `workers` compiles run at once and `max_queued` more may wait;
+    stats() reports queue depth, outcomes and wait/run times.
+    """
+
+    def __init__(self, compiler: LatexCompiler, workers: int = 2, max_queued: int = 16):
+        self.compiler = compiler
+        self.workers = max(1, int(workers))
+        self.max_queued = max_queued
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="latex-compile")
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._closed = False
+        self._queued = 0
+        self._running = 0
+        self._counts = {"completed": 0, "failed": 0, "timed_out": 0}
+        self._wait_total = 0.0
+        self._run_total = 0.0
+
+    def submit(self, note_name: str) -> "Future[Dict[str, Any]]":
+        with self._lock:
+            if self._closed:
+                raise CompileQueueFull("shutting down")
+            if self._queued >= self.max_queued:
+                raise CompileQueueFull(f"{self._queued} compiles already waiting")
+            self._queued += 1
+        return self._executor.submit(self._run_job, note_name, time.time())
+
+    def compile(self, note_name: str) -> Dict[str, Any]:
+        """Submit and wait for the result."""
+        return self.submit(note_name).result()
+
+    def _run_job(self, note_name: str, submitted_at: float) -> Dict[str, Any]:
+        started = time.time()
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+            self._wait_total += started - submitted_at
+        result = None
+        try:
+            result = self.compiler.compile(note_name)
+            return result
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._idle.notify_all()
+                self._run_total += time.time() - started
+                error = result["compilation_error"] if result else "exception"
+                if result and result["pdf_path"]:
+                    self._counts["completed"] += 1
+                    outcome = "ok"
+                elif error and error.startswith("Compilation timed out"):
+                    self._counts["timed_out"] += 1
+                    outcome = "timed_out"
+                else:
+                    self._counts["failed"] += 1
+                    outcome = "failed"
+            COMPILES.inc(result=outcome)
+            record("compile.queue", started - submitted_at)
+            record("compile.run", time.time() - started)
+            if result is not None:
+                result["queue_seconds"] = round(started - submitted_at, 3)
+
+    def drain(self, timeout: float) -> bool:
+        """Refuse new compiles and wait up to `timeout` seconds for the queued and running ones. True if all finished."""
+        with self._lock:
+            self._closed = True
+            return self._idle.wait_for(lambda: not self._queued and not self._running, timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            finished = sum(self._counts.values())
+            started = finished + self._running
+            return {
+                "workers": self.workers,
+                "max_queued": self.max_queued,
+                "queued": self._queued,
+                "running": self._running,
+                **self._counts,
+                "avg_queue_seconds": round(self._wait_total / started, 3) if started else 0.0,
+                "avg_compile_seconds": round(self._run_total / finished, 3) if finished else 0.0,
+            }
@@ -0,0 +1,308 @@
+# Shared OpenAI client for the web app and the math chatbot
+# One pooled, keep-alive HTTP client per process instead of a new OpenAI(...) per upload,
+# with a per-call timeout budget and jittered exponential backoff on 429/5xx.
+# Every call goes through one scheduler that keeps requests and tokens per minute within budget,
+# lets interactive /chat calls go ahead of transcriptions, and sheds calls it can't serve in time.
+# The openai package (most of a second to import) is only loaded when the client is first needed.
+
+import heapq
+import itertools
+import math
+import os
+import random
+import threading
+import time
+
+from metrics import LLM_REQUESTS, LLM_SHED, record, record_usage
+import shared_state
+
+# Configuration
+MODEL_NAME = "gpt-4o"  # OpenAI GPT-4o with vision capabilities
+API_KEY = os.environ.get("OPENAI_API_KEY") or os.environ.get("DEEPSEEK_API_KEY") or "sk-your-key-here"
+BASE_URL = os.environ.get("OPENAI_BASE_URL") or None  # None uses default OpenAI endpoint (set it to use a local stub)
+LLM_AVAILABLE = bool(API_KEY and API_KEY != "sk-your-key-here")
+
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", 180))  # seconds per call, retries included
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", 4))
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", 20))
+LLM_KEEPALIVE_SECONDS = 60
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 20.0
+LLM_REQUESTS_PER_MINUTE = int(os.environ.get("LLM_REQUESTS_PER_MINUTE", 0))  # 0 = no client-side request limit
+LLM_TOKENS_PER_MINUTE = int(os.environ.get("LLM_TOKENS_PER_MINUTE", 0))  # 0 = no client-side token limit
+LLM_MAX_QUEUED = int(os.environ.get("LLM_MAX_QUEUED", 64))  # calls allowed to wait for budget before new ones are shed
+EXPECTED_COMPLETION_TOKENS = 1500  # what a transcription reply usually costs, charged up front
+
+PRIORITY_INTERACTIVE = 0  # /chat: a student is waiting on the answer
+PRIORITY_BATCH = 10  # transcriptions
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class TokenBucket:
+    """
+    Token bucket: refills at `rate` units per second up to `capacity`.
+    Not locked itself; the scheduler checks and takes from its buckets under its own lock.
+    Amounts above the capacity are clamped to it, so a single large call can still go through.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` is available (0 if it is now)."""
+        self._refill()
+        return max(0.0, (min(amount, self.capacity) - self._tokens) / self.rate)
+
+    def take(self, amount: float):
+        self._refill()
+        self._tokens -= min(amount, self.capacity)
+
+
+class SharedTokenBucket:
+    """
+    TokenBucket whose level lives in the shared store, so all worker processes draw on one budget.
+    Checking and taking aren't one step across processes: two workers may both see room for a call
+    and overdraw the bucket by one; it then goes negative and the next calls wait it out.
+    """
+
+    def __init__(self, store, name: str, rate: float, capacity: float):
+        self.store = store
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+
+    def wait_time(self, amount: float) -> float:
+        level = self.store.bucket_level(self.name, self.rate, self.capacity)
+        return max(0.0, (min(amount, self.capacity) - level) / self.rate)
+
+    def take(self, amount: float):
+        self.store.bucket_take(self.name, self.rate, self.capacity, min(amount, self.capacity))
+
+
+class LLMOverloaded(Exception):
+    """The scheduler shed a call: too many calls waiting, or no budget before the call's deadline."""
+
+
+class LLMScheduler:
+    """
+    Admission control for LLM calls. A call asks for one request and its estimated tokens;
+    waiting calls are served in priority order (then arrival order) as the per-minute budgets refill.
+    A 429 pauses everyone until its Retry-After instead of letting each queued call find out by itself.
+    A call is shed with LLMOverloaded if LLM_MAX_QUEUED calls are already waiting, or if its budget
+    can't be met before its deadline.
+    With a shared store the budgets and 429 pauses are shared by all worker processes;
+    priority order and the queue limit stay per process.
+    """
+
+    def __init__(self, requests_per_minute: int = 0, tokens_per_minute: int = 0, max_queued: int = 64, store=None):
+        def bucket(name, per_minute):
+            if per_minute <= 0:
+                return None
+            if store is not None:
+                return SharedTokenBucket(store, name, per_minute / 60.0, per_minute)
+            return TokenBucket(per_minute / 60.0, per_minute)
+        self.requests = bucket("llm.requests", requests_per_minute)
+        self.tokens = bucket("llm.tokens", tokens_per_minute)
+        self.store = store
+        self.max_queued = max_queued
+        self._cond = threading.Condition()
+        self._waiting = []  # heap of (priority, seq)
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+
+    def _wait_time(self, tokens: int) -> float:
+        wait = max(0.0, self._paused_until - time.monotonic())
+        if self.store is not None:
+            wait = max(wait, self.store.paused_until("llm") - time.time())
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(1))
+        if self.tokens is not None and tokens:
+            wait = max(wait, self.tokens.wait_time(tokens))
+        return wait
+
+    def acquire(self, tokens: int, priority: int = PRIORITY_BATCH, deadline: float = None) -> float:
+        """Block until the call may be sent and charge it to the budgets. Returns the seconds waited."""
+        started = time.monotonic()
+        with self._cond:
+            if (self.requests is None and self.tokens is None and self.store is None
+                    and self._paused_until <= started and not self._waiting):
+                return 0.0
+            if len(self._waiting) >= self.max_queued:
+                raise LLMOverloaded(f"{len(self._waiting)} LLM calls already waiting")
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    if self._waiting[0] == ticket:
+                        wait = self._wait_time(tokens)
+                        if wait <= 0:
+                            break
+                        if deadline is not None and now + wait > deadline:
+                            raise LLMOverloaded("no LLM budget before the call's deadline")
+                    else:
+                        wait = 1.0  # woken when the head is served
+                        if deadline is not None and now >= deadline:
+                            raise LLMOverloaded("no LLM budget before the call's deadline")
+                    self._cond.wait(min(wait, 1.0))
+                heapq.heappop(self._waiting)
+                if self.requests is not None:
+                    self.requests.take(1)
+                if self.tokens is not None and tokens:
+                    self.tokens.take(tokens)
+            except LLMOverloaded:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                raise
+            finally:
+                self._cond.notify_all()
+        return time.monotonic() - started
+
+    def pause(self, seconds: float):
+        """Hold every call back for `seconds` (the server said 429, retry after...)."""
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        if self.store is not None:
+            self.store.pause("llm", time.time() + seconds)
+
+    def queued(self) -> int:
+        with self._cond:
+            return len(self._waiting)
+
+
+scheduler = LLMScheduler(LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE, LLM_MAX_QUEUED, store=shared_state.store)
+
+
+def text_tokens(text: str) -> int:
+    """Rough token count of a prompt string (about 4 characters per token)."""
+    return len(text) // 4 + 1
+
+
+def image_tokens(width: int, height: int, detail: str = "auto") -> int:
+    """
+    GPT-4o prompt tokens for one image: 85 at low detail, otherwise 85 + 170 per 512px tile
+    after the image is fitted into 2048x2048 and its short edge scaled down to 768.
+    """
+    if detail == "low":
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def estimate_tokens(messages, max_tokens: int = None) -> int:
+    """
+    Estimated cost of a chat call: prompt text, images (by their `detail`, at the high-detail
+    worst case of a 768x2048 image when not low) and the reply (max_tokens, or EXPECTED_COMPLETION_TOKENS).
+    """
+    tokens = max_tokens or EXPECTED_COMPLETION_TOKENS
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += text_tokens(content)
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                tokens += text_tokens(part.get("text", ""))
+            elif part.get("type") == "image_url":
+                tokens += image_tokens(768, 2048, part["image_url"].get("detail", "auto"))
+    return tokens
+
+
+def get_client():
+    """The process-wide OpenAI client (created, and openai imported, on first use)."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            import httpx
+            from openai import OpenAI, DefaultHttpxClient  # openai >= 1.17
+            kwargs = {"api_key": API_KEY, "max_retries": 0, "timeout": LLM_TIMEOUT}  # retries are ours, see chat_completion
+            if BASE_URL:
+                kwargs["base_url"] = BASE_URL
+            kwargs["http_client"] = DefaultHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=LLM_MAX_CONNECTIONS,
+                    max_keepalive_connections=LLM_MAX_CONNECTIONS,
+                    keepalive_expiry=LLM_KEEPALIVE_SECONDS,
+                ),
+            )
+            _client = OpenAI(**kwargs)
+        return _client
+
+
+def is_retryable(error: Exception) -> bool:
+    """429s, 5xx and connection problems (timeouts included) are worth retrying."""
+    from openai import APIConnectionError, APIStatusError
+    if isinstance(error, APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, APIConnectionError)
+
+
+def retry_delay(attempt: int, error: Exception) -> float:
+    """Server-provided Retry-After if there is one, else full-jitter exponential backoff."""
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            return min(RETRY_MAX_DELAY, float(response.headers.get("retry-after")))
+        except (TypeError, ValueError):
+            pass
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+
+
+def chat_completion(timeout: float = None, tokens: int = None, priority: int = PRIORITY_BATCH, **kwargs):
+    """
+    client.chat.completions.create(**kwargs) with retries, admitted by the scheduler.
+    `timeout` is the budget for the whole call: each attempt gets what is left of it,
+    and no retry is started that couldn't begin before it runs out. Waiting for the scheduler counts too.
+    `tokens` is the estimated cost of the call (estimated from the messages if not given);
+    `priority` orders waiting calls, lower first. Raises LLMOverloaded if the call is shed.
+    With stream=True only opening the stream is retried, not a stream that breaks midway
+    (and token usage is left to the caller, it arrives with the last chunk).
+    """
+    deadline = time.monotonic() + (timeout or LLM_TIMEOUT)
+    model = kwargs.get("model", MODEL_NAME)
+    if tokens is None:
+        tokens = estimate_tokens(kwargs.get("messages", []), kwargs.get("max_tokens"))
+    attempt = 0
+    while True:
+        try:
+            # Tokens are charged once; each retry still counts as a request
+            waited = scheduler.acquire(tokens if attempt == 0 else 0, priority, deadline)
+        except LLMOverloaded:
+            LLM_SHED.inc(priority="interactive" if priority <= PRIORITY_INTERACTIVE else "batch")
+            raise
+        record("llm.queue_wait", waited)
+        try:
+            response = get_client().chat.completions.create(timeout=max(1.0, deadline - time.monotonic()), **kwargs)
+        except Exception as e:
+            if not is_retryable(e) or attempt >= LLM_MAX_RETRIES:
+                LLM_REQUESTS.inc(model=model, outcome="error")
+                raise
+            delay = retry_delay(attempt, e)
+            if getattr(e, "status_code", None) == 429:
+                scheduler.pause(delay)
+            if time.monotonic() + delay >= deadline:
+                LLM_REQUESTS.inc(model=model, outcome="error")
+                raise
+            LLM_REQUESTS.inc(model=model, outcome="retry")
+            print(f"[WARN] LLM call failed ({e.__class__.__name__}), retry {attempt + 1}/{LLM_MAX_RETRIES} in {delay:.1f}s")
+            if getattr(e, "status_code", None) != 429:
+                time.sleep(delay)  # after a 429 the scheduler holds the retry back
+            attempt += 1
+            continue
+        LLM_REQUESTS.inc(model=model, outcome="ok")
+        if not kwargs.get("stream"):
+            record_usage(model, getattr(response, "usage", None))
+        return response
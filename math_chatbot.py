@@ -4,7 +4,12 @@
 import os
 import re
 import ast
+import collections
 import difflib
+import functools
+import signal
+import threading
+import time
 from typing import Optional, Dict, Any
 
 # Optional deps
@@ -13,23 +18,24 @@ try:
 except Exception:
     sp = None
 
-# OpenAI API client
-from openai import OpenAI
+# OpenAI API client (shared with app.py, see llm_client.py)
+from llm_client import MODEL_NAME, LLM_AVAILABLE, PRIORITY_INTERACTIVE, LLMOverloaded, chat_completion
+from metrics import span, record, SIMPLIFY_TIERS
+from cas_cache import CASCache, text_key, canonical_key
+from cas_workers import CASPool, CASTimeout
 
-# Configuration
-MODEL_NAME = "gpt-4o"  # OpenAI GPT-4o model
-API_KEY = os.environ.get("OPENAI_API_KEY") or os.environ.get("DEEPSEEK_API_KEY") or "sk-your-key-here"
-BASE_URL = None  # None uses default OpenAI endpoint
+CHAT_TIMEOUT = float(os.environ.get("CHAT_LLM_TIMEOUT", 45))  # seconds per chat LLM call, retries included
+CAS_CACHE_SIZE = int(os.environ.get("CAS_CACHE_SIZE", 2048))  # SymPy results kept in memory
+CAS_CACHE_PATH = os.environ.get("CAS_CACHE_PATH") or None  # SQLite file to keep them across restarts
 
-# Initialize client
-try:
-    if BASE_URL:
-        client = OpenAI(api_key=API_KEY, base_url=BASE_URL)
-    else:
-        client = OpenAI(api_key=API_KEY)  # Use default OpenAI endpoint
-    LLM_AVAILABLE = bool(API_KEY and API_KEY != "sk-your-key-here")
-except Exception:
-    LLM_AVAILABLE = False
+CAS_WORKERS = int(os.environ.get("CAS_WORKERS", 2))  # SymPy worker processes; 0 runs SymPy in the request thread
+CAS_TIMEOUT = float(os.environ.get("CAS_TIMEOUT", 5))  # seconds per SymPy call before the worker is killed
+CAS_MEMORY_MB = int(os.environ.get("CAS_MEMORY_MB", 1024))  # address-space limit of a worker
+SIMPLIFY_BUDGET = float(os.environ.get("CAS_SIMPLIFY_BUDGET", 1.0))  # seconds allowed for a full sp.simplify
+SIMPLIFY_UNTIMED_MAX_OPS = 40  # without a timer (SymPy in a request thread) only small results get sp.simplify
+
+cas_pool = CASPool(CAS_WORKERS, CAS_TIMEOUT, CAS_MEMORY_MB) if CAS_WORKERS > 0 else None
+cas_cache = CASCache(CAS_CACHE_SIZE, CAS_CACHE_PATH, namespace=f"sympy-{sp.__version__}:" if sp is not None else "")
 
 # ---------------- Helpers ----------------
 def to_latex(obj) -> str:
@@ -77,9 +83,38 @@ _KEYWORDS = ["derivative", "differentiate", "d/dx",
              "solve", "solution", "roots",
              "simplify", "factor", "expand", "explain"]
 
+_KEYWORD_SET = frozenset(_KEYWORDS)
+# Precomputed per keyword: length and character counts, the two upper bounds on difflib's ratio
+_KEYWORD_INDEX = [(keyword, len(keyword), tuple(collections.Counter(keyword).items())) for keyword in _KEYWORDS]
+
 def fuzzy_fix_keyword(word: str, cutoff=0.75):
-    m = difflib.get_close_matches(word, _KEYWORDS, n=1, cutoff=cutoff)
-    return m[0] if m else word
+    """
+    Closest keyword by difflib ratio (>= cutoff), else the word itself. Same answer as
+    difflib.get_close_matches(word, _KEYWORDS, n=1, cutoff), but exact keywords return at once,
+    other tokens are remembered, and only keywords within both precomputed bounds are scored.
+    """
+    if word in _KEYWORD_SET:
+        return word
+    return _closest_keyword(word, cutoff)
+
+@functools.lru_cache(maxsize=4096)
+def _closest_keyword(word: str, cutoff: float) -> str:
+    # ratio = 2*matches/(n+m), and matches can't exceed min(n, m) nor the characters both share,
+    # so most tokens ("x^2", "of", "what's") are rejected without building a SequenceMatcher
+    n = len(word)
+    matcher = best = None
+    for keyword, m, counts in _KEYWORD_INDEX:
+        if 2.0 * min(n, m) / (n + m) < cutoff:
+            continue
+        if 2.0 * sum(min(c, word.count(ch)) for ch, c in counts) / (n + m) < cutoff:
+            continue
+        if matcher is None:
+            matcher = difflib.SequenceMatcher(None, "", word)
+        matcher.set_seq1(keyword)
+        score = matcher.ratio()
+        if score >= cutoff and (best is None or (score, keyword) > best):
+            best = (score, keyword)
+    return best[1] if best else word
 
 def fuzzy_fix_ops(text: str) -> str:
     toks = text.split()
@@ -89,13 +124,18 @@ def fuzzy_fix_ops(text: str) -> str:
         toks[1] = fuzzy_fix_keyword(toks[1].lower())
     return " ".join(toks)
 
+_LN = re.compile(r"\bln\b")
+# A function name followed by a bare single-letter argument (sinx, sin x) or a number times a letter (sin 2x).
+# One pattern per function, applied in this order: the ")" added for one function can start a word
+# that a later function then matches (cos10tcotx -> cos(10t)cot(x))
+_FUNC_ARGS = [re.compile(rf"\b({func})\s*([a-zA-Z]\b|\d+[a-zA-Z])")
+              for func in ("sin", "cos", "tan", "cot", "sec", "csc", "log", "sqrt")]
+
 def insert_parens_after_func(expr: str) -> str:
     """sinx -> sin(x), sin 2x -> sin(2*x), ln x -> log(x), sqrtx -> sqrt(x)"""
-    expr = re.sub(r"\b(ln)\b", "log", expr)
-    for func in ["sin","cos","tan","cot","sec","csc","log","sqrt"]:
-        expr = re.sub(rf"\b{func}\s*([a-zA-Z]\b)", rf"{func}(\1)", expr)
-        expr = re.sub(rf"\b{func}([a-zA-Z])\b",     rf"{func}(\1)", expr)
-        expr = re.sub(rf"\b{func}\s*(\d+[a-zA-Z])", rf"{func}(\1)", expr)
+    expr = _LN.sub("log", expr)
+    for pattern in _FUNC_ARGS:
+        expr = pattern.sub(r"\1(\2)", expr)
     return expr
 
 def balance_parens(expr: str) -> str:
@@ -112,6 +152,8 @@ if sp is not None:
         convert_xor,
         function_exponentiation,
     )
+    from sympy.functions.elementary.trigonometric import TrigonometricFunction
+    from sympy.functions.elementary.hyperbolic import HyperbolicFunction
     _TRANSFORMS = standard_transformations + (
         implicit_multiplication_application,
         convert_xor,
@@ -129,34 +171,59 @@ else:
     def try_parse(expr_txt: str):
         return None
 
+_EXPLAIN_QUERY = re.compile(r"^(explain|what\s+is|define|why\s+is|intuition\s+for)\s+(.+)$")
+# One scan finds every op keyword in the message (lookahead, so overlapping keywords are all seen)
+_OP_KEYWORDS = re.compile(
+    r"(?=(derivative|differentiate|d/dx|integral|integrate|limit|solve|roots|solution|simplify|factor|expand))")
+_KEYWORD_OP = {"derivative": "derivative", "differentiate": "derivative", "d/dx": "derivative",
+               "integral": "integral", "integrate": "integral", "limit": "limit",
+               "solve": "solve", "roots": "solve", "solution": "solve",
+               "simplify": "simplify", "factor": "simplify", "expand": "simplify"}
+_DERIVATIVE = re.compile(r"(?:what(?:'|)s\s+the\s+)?(?:derivative|differentiate|d/dx)\s+(?:of\s+)?(.+)")
+_INTEGRAL = re.compile(r"(?:integral|integrate)\s+(?:of\s+)?(.+?)\s*(?:from\s+([^\s]+)\s+to\s+([^\s]+))?$")
+_LIMIT = re.compile(r"limit\s*(.+?)\s*as\s*([a-zA-Z])\s*->\s*([^\s]+)")
+_SOLVE = re.compile(r"(?:solve|roots|solution)\s+(.+)")
+_SIMPLIFY = re.compile(r"(simplify|factor|expand)\s+(.+)")
+
 def detect_math_op_local(raw: str):
     """
     Typo-tolerant intent detection for basic ops + 'explain' concept queries.
     Returns (op, info) where op∈{derivative,integral,limit,solve,simplify,factor,expand,explain,None}.
+    A single keyword scan decides which op patterns can match at all; those are then tried in
+    priority order (derivative, integral, limit, solve, simplify/factor/expand).
     """
     t = (raw or "").strip()
     t = fuzzy_fix_ops(t.lower().replace("'","'"))
 
     # explain / what is / define / why queries
-    m = re.search(r"^(explain|what\s+is|define|why\s+is|intuition\s+for)\s+(.+)$", t)
+    m = _EXPLAIN_QUERY.search(t)
     if m:
         topic = m.group(2).strip(" ?.")
         return "explain", {"topic": topic}
 
-    m = re.search(r"(?:what(?:'|)s\s+the\s+)?(?:derivative|differentiate|d/dx)\s+(?:of\s+)?(.+)", t)
-    if m: return "derivative", {"expr": m.group(1).strip()}
+    ops = {_KEYWORD_OP[m.group(1)] for m in _OP_KEYWORDS.finditer(t)}
+    if not ops:
+        return None, {}
 
-    m = re.search(r"(?:integral|integrate)\s+(?:of\s+)?(.+?)\s*(?:from\s+([^\s]+)\s+to\s+([^\s]+))?$", t)
-    if m: return "integral", {"expr": m.group(1).strip(), "a": m.group(2), "b": m.group(3)}
+    if "derivative" in ops:
+        m = _DERIVATIVE.search(t)
+        if m: return "derivative", {"expr": m.group(1).strip()}
 
-    m = re.search(r"limit\s*(.+?)\s*as\s*([a-zA-Z])\s*->\s*([^\s]+)", t)
-    if m: return "limit", {"expr": m.group(1).strip(), "var": m.group(2), "to": m.group(3)}
+    if "integral" in ops:
+        m = _INTEGRAL.search(t)
+        if m: return "integral", {"expr": m.group(1).strip(), "a": m.group(2), "b": m.group(3)}
 
-    m = re.search(r"(?:solve|roots|solution)\s+(.+)", t)
-    if m: return "solve", {"expr": m.group(1).strip()}
+    if "limit" in ops:
+        m = _LIMIT.search(t)
+        if m: return "limit", {"expr": m.group(1).strip(), "var": m.group(2), "to": m.group(3)}
 
-    m = re.search(r"(simplify|factor|expand)\s+(.+)", t)
-    if m: return m.group(1).lower(), {"expr": m.group(2).strip()}
+    if "solve" in ops:
+        m = _SOLVE.search(t)
+        if m: return "solve", {"expr": m.group(1).strip()}
+
+    if "simplify" in ops:
+        m = _SIMPLIFY.search(t)
+        if m: return m.group(1).lower(), {"expr": m.group(2).strip()}
 
     return None, {}
 
@@ -173,8 +240,10 @@ def llm_parse_math(raw: str) -> Dict[str, Any]:
     if not LLM_AVAILABLE:
         return {"op":"none"}
     try:
-        resp = client.chat.completions.create(
+        resp = chat_completion(
             model=MODEL_NAME,
+            timeout=CHAT_TIMEOUT,
+            priority=PRIORITY_INTERACTIVE,
             messages=[{"role":"system","content":LLM_PARSE_SYS},
                       {"role":"user","content":raw}],
             temperature=0.0,
@@ -197,8 +266,10 @@ def llm_explain(user_q: str, result_text: str) -> Optional[str]:
     if not LLM_AVAILABLE:
         return None
     try:
-        resp = client.chat.completions.create(
+        resp = chat_completion(
             model=MODEL_NAME,
+            timeout=CHAT_TIMEOUT,
+            priority=PRIORITY_INTERACTIVE,
             messages=[{"role":"system","content":LLM_EXPLAIN_SYS},
                       {"role":"user","content":f"Question: {user_q}\nCAS result: {result_text}"}],
             temperature=0.2,
@@ -262,8 +333,10 @@ def llm_explain_concept(topic: str) -> str:
     t = (topic or "").strip()
     if LLM_AVAILABLE:
         try:
-            resp = client.chat.completions.create(
+            resp = chat_completion(
                 model=MODEL_NAME,
+                timeout=CHAT_TIMEOUT,
+                priority=PRIORITY_INTERACTIVE,
                 messages=[
                     {"role":"system","content":LLM_EXPLAIN_CONCEPT_SYS},
                     {"role":"user","content":f"Explain this concept: {t}"}
@@ -287,6 +360,98 @@ def _parse_matrix(txt: str):
     except Exception:
         return None
 
+class _BudgetExceeded(Exception):
+    pass
+
+def _on_budget_alarm(signum, frame):
+    raise _BudgetExceeded()
+
+def _can_time_out() -> bool:
+    # SIGALRM only interrupts the main thread, which is where CAS workers run their calls
+    return hasattr(signal, "setitimer") and threading.current_thread() is threading.main_thread()
+
+# (tier, seconds) for each simplification of the current computation; per thread, because with
+# CAS_WORKERS=0 SymPy runs in the request threads, several chats at once
+_simplify_local = threading.local()
+
+def _report_tier(tier: str, started: float):
+    report = getattr(_simplify_local, "report", None)
+    if report is not None:
+        report.append((tier, time.perf_counter() - started))
+
+def _needs_full_simplify(expr) -> bool:
+    """exp, log and roots are what the cheap tier leaves alone"""
+    return any(isinstance(node, (sp.exp, sp.log)) or (node.is_Pow and not node.exp.is_Integer)
+               for node in sp.preorder_traversal(expr))
+
+def _within_budget(func, expr, seconds: float):
+    """func(expr), or None if it doesn't finish within `seconds` (or is too big to try without a timer)"""
+    if seconds <= 0:
+        return None
+    if not _can_time_out():
+        return func(expr) if sp.count_ops(expr) <= SIMPLIFY_UNTIMED_MAX_OPS else None
+    previous = signal.signal(signal.SIGALRM, _on_budget_alarm)
+    try:
+        try:
+            signal.setitimer(signal.ITIMER_REAL, seconds)
+            return func(expr)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    except _BudgetExceeded:
+        return None
+    finally:
+        signal.signal(signal.SIGALRM, previous)
+
+def tiered_simplify(expr, full: bool = False):
+    """
+    Simplify in tiers, cheapest first:
+      none  - numbers and symbols are returned as they are
+      cheap - together + cancel, plus trigsimp when trig
+              functions occur; the shortest form (count_ops) wins
+      full  - sp.simplify, only if the cheap form still has exp, log or roots in it (or `full`)
+    trigsimp and sp.simplify share SIMPLIFY_BUDGET seconds; whatever doesn't finish in time is
+    skipped and the best form so far is kept (reported as the budget tier).
+    Each tier used is recorded for with_simplify_report.
+    """
+    started = time.perf_counter()
+    if not isinstance(expr, sp.Basic) or expr.is_Atom:
+        _report_tier("none", started)
+        return expr
+    deadline = started + SIMPLIFY_BUDGET
+    candidates = [expr]
+    try:
+        candidates.append(sp.cancel(sp.together(expr)))
+    except Exception:
+        pass
+    best = min(candidates, key=sp.count_ops)
+    if expr.has(TrigonometricFunction, HyperbolicFunction):
+        trig = _within_budget(sp.trigsimp, best, deadline - time.perf_counter())
+        if trig is None:
+            _report_tier("budget", started)
+            return best
+        best = min((best, trig), key=sp.count_ops)
+    _report_tier("cheap", started)
+    if not full and not _needs_full_simplify(best):
+        return best
+
+    started = time.perf_counter()
+    result = _within_budget(sp.simplify, best, deadline - started)
+    if result is None:
+        _report_tier("budget", started)
+        return best
+    _report_tier("full", started)
+    return min((best, result), key=sp.count_ops)
+
+def with_simplify_report(name: str, *args):
+    """Run <name>(*args) and return (result, [(tier, seconds), ...]) for the tiers it used"""
+    previous = getattr(_simplify_local, "report", None)
+    _simplify_local.report = report = []
+    try:
+        result = globals()[name](*args)
+    finally:
+        _simplify_local.report = previous
+    return result, report
+
 def do_sympy_compute(op: str, info: Dict[str, Any]) -> str:
     """Run the CAS operation with SymPy based on parsed plan (pretty LaTeX)."""
     if sp is None:
@@ -295,7 +460,7 @@ def do_sympy_compute(op: str, info: Dict[str, Any]) -> str:
 
     if op == "derivative":
         expr = try_parse(info["expr"])
-        deriv = sp.simplify(sp.diff(expr, x))
+        deriv = tiered_simplify(sp.diff(expr, x))
         return f"$$\\frac{{d}}{{dx}}\\,{to_latex(expr)} = {to_latex(deriv)}$$"
 
     if op == "integral":
@@ -303,9 +468,9 @@ def do_sympy_compute(op: str, info: Dict[str, Any]) -> str:
         a, b = info.get("a"), info.get("b")
         if a and b:
             aval = try_parse(a); bval = try_parse(b)
-            val = sp.simplify(sp.integrate(expr, (x, aval, bval)))
+            val = tiered_simplify(sp.integrate(expr, (x, aval, bval)))
             return f"$$\\int_{{{to_latex(aval)}}}^{{{to_latex(bval)}}} {to_latex(expr)}\\,dx = {to_latex(val)}$$"
-        ant = sp.simplify(sp.integrate(expr, x))
+        ant = tiered_simplify(sp.integrate(expr, x))
         return f"$$\\int {to_latex(expr)}\\,dx = {to_latex(ant)} + C$$"
 
     if op == "limit":
@@ -315,7 +480,7 @@ def do_sympy_compute(op: str, info: Dict[str, Any]) -> str:
         to_val = sp.oo if to_txt in ["oo","+inf","+infty","infinity"] else \
                  -sp.oo if to_txt in ["-oo","-inf"] else try_parse(to_txt)
         pretty_to = r"\infty" if to_val == sp.oo else (r"-\infty" if to_val == -sp.oo else to_latex(to_val))
-        res = sp.simplify(sp.limit(expr, var, to_val))
+        res = tiered_simplify(sp.limit(expr, var, to_val))
         return f"$$\\lim_{{{to_latex(var)}\\to {pretty_to}}} {to_latex(expr)} = {to_latex(res)}$$"
 
     if op == "solve":
@@ -342,17 +507,66 @@ def do_sympy_compute(op: str, info: Dict[str, Any]) -> str:
         expr = try_parse(info["expr"])
         if op == "factor":  return f"$$\\mathrm{{factor}}\\big({to_latex(expr)}\\big) = {to_latex(sp.factor(expr))}$$"
         if op == "expand":  return f"$$\\mathrm{{expand}}\\big({to_latex(expr)}\\big) = {to_latex(sp.expand(expr))}$$"
-        return f"$$\\mathrm{{simplify}}\\big({to_latex(expr)}\\big) = {to_latex(sp.simplify(expr))}$$"
+        return f"$$\\mathrm{{simplify}}\\big({to_latex(expr)}\\big) = {to_latex(tiered_simplify(expr, full=True))}$$"
 
     return "I couldn't parse that.\n\n" + MATH_HELP
 
-def math_engine(prompt: str, use_llm: bool = True) -> str:
+def run_cas(name: str, *args):
+    """Call one of this module's SymPy functions in a CAS worker (inline if CAS_WORKERS=0)"""
+    if cas_pool is None:
+        return globals()[name](*args)
+    return cas_pool.run(name, *args)
+
+def plan_key(op: str, info: Dict[str, Any]) -> str:
+    """Canonical CAS cache key of a plan (parses the expression, so it runs in a worker)"""
+    return canonical_key(op, info, try_parse, sp.srepr)
+
+def cached_sympy_compute(op: str, info: Dict[str, Any], compute: str = "do_sympy_compute", *args,
+                         timings: Optional[Dict[str, float]] = None) -> str:
+    """
+    run_cas(compute, *args) (default: do_sympy_compute(op, info)) through the CAS cache: first keyed on
+    the plan as typed, then on the parsed plan (srepr), so "x^2" and "x**2" share one result.
+    A repeat costs a dict lookup. Raises CASTimeout if the worker had to be stopped; a timeout isn't
+    cached, so the question is tried again next time (with a fresh worker, maybe under less load).
+    The simplification tiers used are recorded as chat.simplify.<tier> stages.
+    """
+    def keys():
+        yield text_key(op, info)
+        # Only reached on a text miss: one extra worker round trip (a parse, no simplify) before computing
+        yield run_cas("plan_key", op, info)
+
+    def compute_and_report():
+        result, report = run_cas("with_simplify_report", compute, *(args or (op, info)))
+        for tier, seconds in report:
+            SIMPLIFY_TIERS.inc(tier=tier)
+            record(f"chat.simplify.{tier}", seconds, timings)
+        return result
+
+    return cas_cache.get_or_compute(keys(), compute_and_report)
+
+def evaluate_expression(raw: str) -> str:
+    """Bare expression: simplify it and show the result"""
+    expr = try_parse(raw)
+    val = tiered_simplify(expr)
+    if getattr(val, "is_Number", False):
+        return f"$${to_latex(val)}$$"
+    if val != expr:
+        return f"$${to_latex(expr)} = {to_latex(val)}$$"
+    else:
+        return f"$${to_latex(expr)}$$"
+
+_EXPLAIN_PREFIX = re.compile(r"(?i)\b(explain|what\s+is|define|why\s+is|intuition\s+for)\b")
+
+def math_engine(prompt: str, use_llm: bool = True, timings: Optional[Dict[str, float]] = None) -> str:
     """
     1) Concept queries -> explainer (LLM/offline).
     2) Try to parse intent locally (typo tolerant).
     3) Execute with SymPy (robust parser).
     4) Bare expression fallback (e.g., '9+10').
     5) LLM-assisted parsing/explanation if still unresolved.
+    SymPy runs in CAS worker processes; a computation stopped after CAS_TIMEOUT skips straight to the
+    LLM tutor answer (or a "took too long" reply without the LLM).
+    Time spent in each step is recorded as chat.* stages (and added to `timings` if given).
     """
     if sp is None:
         return "SymPy isn't installed. Add `sympy` to requirements.txt."
@@ -360,61 +574,81 @@ def math_engine(prompt: str, use_llm: bool = True) -> str:
     raw = (prompt or "").strip()
 
     # --- Early: detect concept explanations before any CAS work ---
-    if re.match(r"(?i)\b(explain|what\s+is|define|why\s+is|intuition\s+for)\b", raw):
-        topic = re.sub(r"(?i)\b(explain|what\s+is|define|why\s+is|intuition\s+for)\b", "", raw).strip(" ?.")
+    if _EXPLAIN_PREFIX.match(raw):
+        topic = _EXPLAIN_PREFIX.sub("", raw).strip(" ?.")
         topic = topic or raw
-        return llm_explain_concept(topic)
+        with span("chat.explain", timings):
+            return llm_explain_concept(topic)
 
     # 1) Plan via local detector
-    op, info = detect_math_op_local(raw)
+    with span("chat.parse", timings):
+        op, info = detect_math_op_local(raw)
     plan = {"op": op or "none", **(info or {})}
 
     # 1.5) If detector says "explain", route to explainer
     if plan["op"] == "explain":
         topic = plan.get("topic", raw)
-        return llm_explain_concept(topic)
+        with span("chat.explain", timings):
+            return llm_explain_concept(topic)
 
-    # 2) Compute with SymPy if possible
+    # 2) Compute with SymPy if possible (in a worker, stopped after CAS_TIMEOUT seconds)
+    timed_out = False
     if plan["op"] != "none":
         try:
-            return do_sympy_compute(plan["op"], plan)
+            with span("chat.sympy", timings):
+                return cached_sympy_compute(plan["op"], plan, timings=timings)
+        except CASTimeout:
+            timed_out = True
         except Exception:
             pass
 
     # 3) Bare expression fallback
-    try:
-        expr = try_parse(raw)
-        val = sp.simplify(expr)
-        if getattr(val, "is_Number", False):
-            return f"$${to_latex(val)}$$"
-        if val != expr:
-            return f"$${to_latex(expr)} = {to_latex(val)}$$"
-        else:
-            return f"$${to_latex(expr)}$$"
-    except Exception:
-        pass
+    if not timed_out:
+        try:
+            with span("chat.sympy", timings):
+                return cached_sympy_compute("value", {"expr": raw}, "evaluate_expression", raw, timings=timings)
+        except CASTimeout:
+            timed_out = True
+        except Exception:
+            pass
 
-    # 4) LLM-assisted parsing + explanation (optional)
+    # 4) LLM-assisted parsing + explanation (optional); after a timeout straight to the tutor answer
     if use_llm and LLM_AVAILABLE:
-        plan = llm_parse_math(raw)
-        if plan.get("op") != "none":
-            try:
-                result = do_sympy_compute(plan["op"], plan)
-                expl = llm_explain(raw, result)
-                return result + ("\n\n" + expl if expl else "")
-            except Exception:
+        if not timed_out:
+            with span("chat.llm", timings):
+                plan = llm_parse_math(raw)
+            if plan.get("op") != "none":
                 try:
-                    resp = client.chat.completions.create(
-                        model=MODEL_NAME,
-                        messages=[
-                            {"role":"system","content":"You are a helpful math tutor. Use LaTeX for math, be concise."},
-                            {"role":"user","content":raw}
-                        ],
-                        temperature=0.2,
-                    )
-                    return resp.choices[0].message.content.strip()
-                except Exception as e:
-                    return f"LLM error: {e}"
+                    with span("chat.sympy", timings):
+                        result = cached_sympy_compute(plan["op"], plan, timings=timings)
+                    with span("chat.llm", timings):
+                        expl = llm_explain(raw, result)
+                    return result + ("\n\n" + expl if expl else "")
+                except Exception:
+                    pass
+            else:
+                return "I couldn't parse that.\n\n" + MATH_HELP
+        try:
+            with span("chat.llm", timings):
+                resp = chat_completion(
+                    model=MODEL_NAME,
+                    timeout=CHAT_TIMEOUT,
+                    priority=PRIORITY_INTERACTIVE,
+                    messages=[
+                        {"role":"system","content":"You are a helpful math tutor. Use LaTeX for math, be concise."},
+                        {"role":"user","content":raw}
+                    ],
+                    temperature=0.2,
+                )
+            return resp.choices[0].message.content.strip()
+        except LLMOverloaded:
+            return "The assistant is busy right now, please try again in a minute."
+        except Exception as e:
+            return f"LLM error: {e}"
+
+    if timed_out:
+        return (f"That computation took longer than {CAS_TIMEOUT:g}s and was stopped. "
+                "Try a simpler form of the question, or enable the LLM for an explanation.")
 
     # Last resort
     return "I couldn't parse that.\n\n" + MATH_HELP
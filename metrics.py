@@ -0,0 +1,175 @@
+# Prometheus metrics and per-stage timing spans
+# A small hand-rolled registry (counters and histograms) rendered in the Prometheus
+# text format at /metrics, so timings can be scraped without extra dependencies.
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(pairs) -> str:
+    pairs = list(pairs)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    """Monotonic counter, optionally split by labels: inc(result="hit")."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values: Dict[tuple, float] = {}
+
+    def _key(self, labels: Dict[str, str]) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_labels(zip(self.label_names, key))} {_number(value)}"
+
+
+class Histogram:
+    """Cumulative-bucket histogram (seconds by default), optionally split by labels."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._series: Dict[tuple, list] = {}  # key -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        with self._lock:
+            series = sorted((key, list(values)) for key, values in self._series.items())
+        for key, values in series:
+            pairs = list(zip(self.label_names, key))
+            for bound, count in zip(self.buckets, values):
+                yield f"{self.name}_bucket{_labels(pairs + [('le', _number(bound))])} {count}"
+            yield f"{self.name}_bucket{_labels(pairs + [('le', '+Inf')])} {values[-1]}"
+            yield f"{self.name}_sum{_labels(pairs)} {_number(round(values[-2], 6))}"
+            yield f"{self.name}_count{_labels(pairs)} {values[-1]}"
+
+
+class Registry:
+    """Named collection of metrics; render() produces the /metrics response body."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help_text: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, labels, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "lecture_stage_seconds", "Time spent in each pipeline / request stage", ("stage",))
+LLM_REQUESTS = REGISTRY.counter(
+    "lecture_llm_requests_total", "LLM API attempts by outcome (ok, retry, error)", ("model", "outcome"))
+LLM_TOKENS = REGISTRY.counter(
+    "lecture_llm_tokens_total", "LLM tokens used", ("model", "type"))
+LLM_SHED = REGISTRY.counter(
+    "lecture_llm_shed_total", "LLM calls refused by the scheduler (queue full or no budget in time)", ("priority",))
+CACHE_LOOKUPS = REGISTRY.counter(
+    "lecture_transcription_cache_total", "Transcription cache lookups (hit, miss, bypass)", ("result",))
+CAS_CACHE_LOOKUPS = REGISTRY.counter(
+    "lecture_cas_cache_total", "Chatbot SymPy result cache lookups (hit, miss)", ("result",))
+CAS_CALLS = REGISTRY.counter(
+    "lecture_cas_calls_total", "Chatbot SymPy calls in worker processes (ok, error, timeout, busy, crashed)", ("result",))
+SIMPLIFY_TIERS = REGISTRY.counter(
+    "lecture_cas_simplify_total", "Chatbot simplifications by tier (none, cheap, full, budget)", ("tier",))
+COMPILES = REGISTRY.counter(
+    "lecture_compile_total", "PDF compiles by outcome (ok, failed, timed_out)", ("result",))
+DENOISE_PROFILES = REGISTRY.counter(
+    "lecture_denoise_profile_total", "Images denoised per profile (fast, quality)", ("profile",))
+
+
+def record(stage: str, seconds: float, timings: Optional[Dict[str, float]] = None):
+    """Observe a stage duration; if a timings dict is given, also add it there (for JSON responses)."""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    if timings is not None:
+        timings[stage] = round(timings.get(stage, 0.0) + seconds, 4)
+
+
+@contextmanager
+def span(stage: str, timings: Optional[Dict[str, float]] = None):
+    """with span("vision.request", timings): ... -- times the block, even if it raises."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - started, timings)
+
+
+def record_usage(model: str, usage):
+    """Count the tokens of an OpenAI `usage` object (ignored if the endpoint didn't send one)."""
+    if usage is None:
+        return
+    LLM_TOKENS.inc(getattr(usage, "prompt_tokens", 0) or 0, model=model, type="prompt")
+    LLM_TOKENS.inc(getattr(usage, "completion_tokens", 0) or 0, model=model, type="completion")
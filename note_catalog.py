@@ -0,0 +1,223 @@
+# Persistent catalog of generated notes (SQLite)
+# Upload, compile, delete and feedback update it as they happen, so /history
+# can page through notes without listing and stat-ing notes_out on every request.
+
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Optional, Dict, Any, List, Tuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS notes (
+    note_name TEXT PRIMARY KEY,
+    display_name TEXT NOT NULL,
+    created_at TEXT NOT NULL,          -- ISO timestamp, used for ordering
+    date_sort TEXT NOT NULL,           -- YYYY-MM-DD, used for grouping and date filters
+    has_pdf INTEGER NOT NULL DEFAULT 0,
+    image_count INTEGER,
+    feedback_count INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS notes_created_at ON notes (created_at);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+"""
+
+
+def describe_note(note_name: str):
+    """
+    Display name and image count for a note name like notes_YYYY-MM-DD_HH-MM-SS[_K][_multiN]
+    (_K numbers further notes made in the same second).
+    Falls back to the raw name if it doesn't follow the pattern.
+    """
+    display_name = note_name
+    image_count = None
+    if note_name.startswith('notes_') and len(note_name) > 6:
+        # Try to parse date from filename
+        try:
+            date_part = note_name[6:]  # Remove 'notes_' prefix
+
+            # Check if it's a multi-image file (contains 'multi' and number)
+            if '_multi' in date_part:
+                date_part, count = date_part.split('_multi', 1)
+                image_count = int(count) if count.isdigit() else None
+
+            if '_' in date_part:
+                date_str, time_str = date_part.split('_', 1)
+                time_str, _, copy = time_str.partition('_')
+                if copy and not copy.isdigit():
+                    raise ValueError(copy)
+                parsed_date = datetime.strptime(f"{date_str}_{time_str}", '%Y-%m-%d_%H-%M-%S')
+                display_name = f"Notes from {parsed_date.strftime('%B %d, %Y at %I:%M %p')}"
+                if copy:
+                    display_name += f" #{copy}"
+                if image_count:
+                    display_name += f" ({image_count} images)"
+        except ValueError:
+            # If parsing fails, use the original name
+            pass
+    return display_name, image_count
+
+
+class NoteCatalog:
+    """
+    SQLite index of the notes in docs_dir.
+    Every write bumps a catalog version that /history uses as its ETag.
+    The first use of a fresh catalog imports whatever is already in docs_dir.
+    """
+
+    def __init__(self, db_path: str, docs_dir: str):
+        self.db_path = db_path
+        self.docs_dir = docs_dir
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self) -> sqlite3.Connection:
+        # Called with the lock held
+        if self._conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            self._conn = conn
+            if self._meta("imported") is None:
+                self._import_docs_dir()
+        return self._conn
+
+    def _meta(self, key: str) -> Optional[str]:
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else None
+
+    def _bump_version(self):
+        self._conn.execute(
+            "INSERT INTO meta (key, value) VALUES ('version', '1') "
+            "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+        )
+
+    def _find_pdf(self, note_name: str) -> bool:
+        # latexmk used to put PDFs in a nested notes_out/notes_out directory
+        return os.path.exists(os.path.join(self.docs_dir, f"{note_name}.pdf")) or \
+            os.path.exists(os.path.join(self.docs_dir, os.path.basename(self.docs_dir), f"{note_name}.pdf"))
+
+    def _import_docs_dir(self):
+        """One-off scan of docs_dir for notes created before the catalog existed."""
+        conn = self._conn
+        count = 0
+        conn.execute("BEGIN")
+        try:
+            if os.path.isdir(self.docs_dir):
+                for entry in os.scandir(self.docs_dir):
+                    if entry.is_file() and entry.name.endswith('.tex'):
+                        note_name = entry.name[:-4]
+                        created = datetime.fromtimestamp(entry.stat().st_mtime)
+                        self._upsert(note_name, created, self._find_pdf(note_name), None)
+                        count += 1
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('imported', ?)", (str(time.time()),))
+            self._bump_version()
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        print(f"[INFO] Note catalog imported {count} existing notes from {self.docs_dir}")
+
+    def _upsert(self, note_name: str, created: datetime, has_pdf: bool, image_count: Optional[int]):
+        display_name, parsed_count = describe_note(note_name)
+        self._conn.execute(
+            "INSERT INTO notes (note_name, display_name, created_at, date_sort, has_pdf, image_count, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(note_name) DO UPDATE SET has_pdf = excluded.has_pdf, updated_at = excluded.updated_at",
+            (note_name, display_name, created.isoformat(), created.strftime('%Y-%m-%d'),
+             int(bool(has_pdf)), image_count or parsed_count, time.time()),
+        )
+
+    # ---------- writes ----------
+    def reserve_note(self, make_name: Callable[[int], str], image_count: Optional[int] = None,
+                     created: Optional[datetime] = None) -> str:
+        """
+        Add a note under the first free name of make_name(1), make_name(2), ... (free: not in the catalog
+        and no .tex in docs_dir) and return that name. Check and insert are one transaction, so notes
+        saved at the same moment by several threads or server processes never get the same name.
+        """
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                copy = 1
+                while True:
+                    note_name = make_name(copy)
+                    taken = conn.execute("SELECT 1 FROM notes WHERE note_name = ?", (note_name,)).fetchone()
+                    if not taken and not os.path.exists(os.path.join(self.docs_dir, f"{note_name}.tex")):
+                        break
+                    copy += 1
+                self._upsert(note_name, created or datetime.now(), False, image_count)
+                self._bump_version()
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return note_name
+
+    def add_note(self, note_name: str, has_pdf: bool = False, image_count: Optional[int] = None,
+                 created: Optional[datetime] = None):
+        with self._lock:
+            self._connect()
+            self._upsert(note_name, created or datetime.now(), has_pdf, image_count)
+            if created is not None:
+                # An explicit date (e.g. when the photos were taken) replaces the one the note was listed with
+                self._conn.execute("UPDATE notes SET created_at = ?, date_sort = ? WHERE note_name = ?",
+                                   (created.isoformat(), created.strftime('%Y-%m-%d'), note_name))
+            self._bump_version()
+
+    def set_pdf(self, note_name: str, has_pdf: bool):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("UPDATE notes SET has_pdf = ?, updated_at = ? WHERE note_name = ?",
+                         (int(bool(has_pdf)), time.time(), note_name))
+            self._bump_version()
+
+    def add_feedback(self, note_name: str):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("UPDATE notes SET feedback_count = feedback_count + 1, updated_at = ? WHERE note_name = ?",
+                         (time.time(), note_name))
+            self._bump_version()
+
+    def remove(self, note_name: str):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM notes WHERE note_name = ?", (note_name,))
+            self._bump_version()
+
+    def rebuild(self):
+        """Drop everything and re-import docs_dir (e.g. after notes were copied in by hand)."""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM notes")
+            self._import_docs_dir()
+
+    # ---------- reads ----------
+    def version(self) -> int:
+        with self._lock:
+            self._connect()
+            return int(self._meta("version") or 0)
+
+    def page(self, offset: int = 0, limit: int = 50, date_from: Optional[str] = None,
+             date_to: Optional[str] = None) -> Tuple[List[Dict[str, Any]], int]:
+        """Notes newest first, filtered by YYYY-MM-DD bounds (inclusive). Returns (notes, total matching)."""
+        where, params = [], []
+        if date_from:
+            where.append("date_sort >= ?")
+            params.append(date_from)
+        if date_to:
+            where.append("date_sort <= ?")
+            params.append(date_to)
+        clause = f"WHERE {' AND '.join(where)}" if where else ""
+        with self._lock:
+            conn = self._connect()
+            total = conn.execute(f"SELECT COUNT(*) FROM notes {clause}", params).fetchone()[0]
+            rows = conn.execute(
+                f"SELECT * FROM notes {clause} ORDER BY created_at DESC, note_name DESC LIMIT ? OFFSET ?",
+                params + [limit, offset],
+            ).fetchall()
+        return [dict(row) for row in rows], total
@@ -0,0 +1,587 @@
+# The note pipeline shared by the web app and batch_convert.py:
+# denoise -> GPT-4o vision transcription -> save the .tex -> compile the PDF.
+# Importing it builds no worker pools or threads; callers bring their own CompilePool
+# (app.py's serves /upload and /recompile, batch_convert.py sizes one per run).
+
+import os
+import base64
+import io
+import json
+import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+# denoise_pipeline (cv2, numpy) and PIL are imported by the functions that use them
+from transcription_cache import TranscriptionCache, make_cache_key
+from latex_compile import LatexCompiler, CompileQueueFull, split_preamble
+from note_catalog import NoteCatalog
+from llm_client import MODEL_NAME, EXPECTED_COMPLETION_TOKENS, chat_completion, image_tokens, text_tokens
+import metrics
+from metrics import span, record
+
+# =============== CONFIG ===============
+DOCS_DIR = "notes_out"
+DENOISE_WORKERS = int(os.environ.get("DENOISE_WORKERS", 0)) or None  # denoise processes (default: CPU count)
+DENOISE_TILE_SIZE = int(os.environ.get("DENOISE_TILE_SIZE", 1024))  # larger images are denoised in tiles (0 = never)
+DENOISE_PROFILE = os.environ.get("DENOISE_PROFILE", "auto")  # fast | quality | auto (NLM only for noisy photos)
+DENOISE_NOISE_THRESHOLD = float(os.environ.get("DENOISE_NOISE_THRESHOLD", 6.0))  # auto: noise sigma that needs NLM
+VISION_MAX_EDGE = int(os.environ.get("VISION_MAX_EDGE", 1536))  # long edge (px) of the images sent to the vision API
+VISION_DETAIL = os.environ.get("VISION_DETAIL", "auto")  # low | high | auto (picked per image from its size)
+VISION_LOW_DETAIL_EDGE = 512  # auto uses "low" for images that already fit one 512px tile
+VISION_MODE = os.environ.get("VISION_MODE", "pages")  # pages: one request per image + merge | single: one request
+VISION_CONCURRENCY = int(os.environ.get("VISION_CONCURRENCY", 4))  # page requests in flight per upload
+VISION_MERGE = os.environ.get("VISION_MERGE", "local")  # local: stitch pages under one preamble | llm: merge call
+CACHE_DIR = os.environ.get("TRANSCRIPTION_CACHE_DIR", "transcription_cache")
+CACHE_MAX_MB = int(os.environ.get("TRANSCRIPTION_CACHE_MAX_MB", 200))  # LRU-evicted beyond this size
+LATEX_FORMATS = os.environ.get("LATEX_FORMATS", "1") != "0"  # reuse precompiled preambles (needs mylatexformat)
+COMPILE_WORKERS = int(os.environ.get("COMPILE_WORKERS", 2))  # concurrent latexmk/pdflatex jobs
+COMPILE_QUEUE_SIZE = int(os.environ.get("COMPILE_QUEUE_SIZE", 16))  # waiting compiles before new ones are refused
+COMPILE_TIMEOUT = int(os.environ.get("COMPILE_TIMEOUT", 60))  # seconds per compile job, all passes included
+CATALOG_PATH = os.path.join(DOCS_DIR, ".catalog.sqlite3")
+# ======================================
+
+os.makedirs(DOCS_DIR, exist_ok=True)
+
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
+
+transcription_cache = TranscriptionCache(CACHE_DIR, max_bytes=CACHE_MAX_MB * 1024 * 1024)
+latex_compiler = LatexCompiler(DOCS_DIR, timeout=COMPILE_TIMEOUT, use_formats=LATEX_FORMATS)
+note_catalog = NoteCatalog(CATALOG_PATH, DOCS_DIR)
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+def encode_image_to_base64(image):
+    """Encode an image file (path) or encoded image bytes to base64 string for vision API"""
+    if isinstance(image, (bytes, bytearray)):
+        return base64.b64encode(image).decode('utf-8')
+    with open(image, "rb") as image_file:
+        return base64.b64encode(image_file.read()).decode('utf-8')
+
+def image_size(data):
+    """(width, height) of encoded image bytes, read from the header only"""
+    from PIL import Image
+    with Image.open(io.BytesIO(data)) as img:
+        return img.size
+
+def choose_detail(width, height):
+    """OpenAI vision `detail` level for an image of this size"""
+    if VISION_DETAIL in ("low", "high"):
+        return VISION_DETAIL
+    return "low" if max(width, height) <= VISION_LOW_DETAIL_EDGE else "high"
+
+def get_image_mime_type(image_path):
+    """Determine MIME type based on file extension"""
+    ext = image_path.lower().split('.')[-1]
+    mime_types = {
+        'jpg': 'image/jpeg',
+        'jpeg': 'image/jpeg',
+        'png': 'image/png',
+        'gif': 'image/gif',
+        'bmp': 'image/bmp',
+        'webp': 'image/webp'
+    }
+    return mime_types.get(ext, 'image/jpeg')
+
+SYSTEM_PROMPT = (
+    "You are a LaTeX math transcription AND explanation assistant using GPT-4o vision capabilities. "
+    "You will be given images of handwritten mathematics from a blackboard. "
+    "Your task is to carefully analyze the images, understand the mathematical content, and "
+    "produce a polished, structured LaTeX article with detailed explanations.\n\n"
+
+    "=== CORE TASKS ===\n"
+    "1. Carefully examine the images and transcribe all mathematical content into proper LaTeX.\n"
+    "2. Add clear explanatory text (in full sentences) before or after each major step, "
+    "suitable for an advanced undergraduate or beginning graduate student.\n"
+    "3. Preserve all important equations, derivations, and logical structure.\n"
+    "4. Interpret handwritten symbols, equations, and mathematical notation accurately using your vision capabilities.\n\n"
+
+    "=== STRICT LATEX RULES ===\n"
+    "• Every mathematical symbol or expression MUST be in math mode.\n"
+    "  – Inline math → \\( ... \\)\n"
+    "  – Display math → \\[ ... \\]\n"
+    "• Never leave raw math symbols in text (e.g. x^2, sum, int, a/b).\n"
+    "• Use correct LaTeX operators: \\ker, \\operatorname{Gal}, \\Hom, \\bQ, \\bZ, \\mod, \\leq, etc.\n"
+    "• Use standard formatting for groups, fields, cosets, cyclotomic extensions, etc.\n"
+    "• No markdown code fences. ONLY pure LaTeX.\n\n"
+
+    "=== DOCUMENT STRUCTURE ===\n"
+    "• Output a complete LaTeX document:\n"
+    "  \\documentclass[12pt]{article}\n"
+    "  \\usepackage{amsmath, amssymb, amsfonts, amsthm}\n"
+    "  ...\n"
+    "  \\begin{document}\n"
+    "  ... content ...\n"
+    "  \\end{document}\n"
+    "• Use sections, subsections, and paragraphs to organize the material.\n"
+    "• You may use environments such as theorem, definition, remark, proof, itemize, or enumerate.\n"
+    "• Explanations must also follow the strict math-mode rules when referencing symbols.\n\n"
+
+    "=== STYLE REQUIREMENTS ===\n"
+    "Your output should resemble a clean textbook or research monograph style similar to "
+    "graduate-level algebraic number theory literature. "
+    "Ensure consistent math-mode usage, operator spacing, and paragraph structure.\n\n"
+
+    "If something in an image is ambiguous or unreadable, include a LaTeX comment '% unclear'.\n"
+    "Output ONLY LaTeX, with no markdown and no external commentary."
+)
+
+def build_instruction_text(image_count):
+    """User-message instruction for a vision request over image_count images"""
+    if image_count == 1:
+        return (
+            "Please analyze this image of handwritten mathematics from a blackboard using your vision capabilities. "
+            "Transcribe all mathematical content into clean LaTeX, using article class with packages: amsmath and amssymb. "
+            "Insert detailed explanations and commentary in LaTeX so that a reader can follow the reasoning.\n\n"
+            "You should keep the original mathematical content and derivations, but you are encouraged to:\n"
+            "• Organize the material with sections/subsections,\n"
+            "• Add short explanatory paragraphs around each important formula or step, and\n"
+            "• Clarify the meaning of symbols and assumptions when they are implicit.\n"
+            "• Include \\usepackage{amsmath} and \\usepackage{amssymb} in the preamble."
+        )
+    else:
+        return (
+            f"Please analyze these {image_count} images of handwritten mathematics from a blackboard using your vision capabilities. "
+            "They may be part of a sequence of related content. "
+            "Transcribe all mathematical content from all images into a single coherent LaTeX document, "
+            "using article class with packages: amsmath and amssymb. "
+            "Insert detailed explanations and commentary in LaTeX so that a reader can follow the reasoning.\n\n"
+            "You should keep the original mathematical content and derivations, but you are encouraged to:\n"
+            "• Combine all images into a single coherent document,\n"
+            "• Organize the material with sections/subsections,\n"
+            "• Add short explanatory paragraphs around each important formula or step, and\n"
+            "• Clarify the meaning of symbols and assumptions when they are implicit.\n"
+            "• Include \\usepackage{amsmath} and \\usepackage{amssymb} in the preamble."
+        )
+
+MERGE_SYSTEM_PROMPT = (
+    "You are an expert mathematical typesetter. You receive LaTeX transcriptions of consecutive "
+    "blackboard photos from one lecture, each transcribed on its own, in the order they were taken. "
+    "Merge them into ONE complete LaTeX document:\n"
+    "• A single preamble (\\documentclass[12pt]{article} plus the union of the packages and macros used).\n"
+    "• Keep every equation, derivation and explanation, in page order.\n"
+    "• Where consecutive photos overlap, keep the repeated content only once.\n"
+    "• Join the section structure so it reads as one text; don't add a heading per photo.\n"
+    "• Keep '% unclear' comments.\n"
+    "Output ONLY LaTeX, with no markdown and no external commentary."
+)
+
+def build_merge_text(fragments):
+    """User message for the merge call: the page transcriptions in order"""
+    parts = [f"Merge these {len(fragments)} page transcriptions into one document."]
+    for idx, fragment in enumerate(fragments):
+        parts.append(f"\n\n--- Page {idx + 1} / {len(fragments)} ---\n{fragment.strip()}")
+    return "".join(parts)
+
+# Preamble lines that define something: a second definition of the same name would not compile
+_DEFINITION = re.compile(
+    r"^\\(?:(?:re)?newcommand\*?\s*\{?\\([A-Za-z@]+)|DeclareMathOperator\*?\s*\{?\\([A-Za-z@]+)"
+    r"|newtheorem\*?\s*\{([^}]*)\}|newenvironment\*?\s*\{([^}]*)\})")
+_PAGE_ONLY = re.compile(r"^\\(?:documentclass|title|author|date)\b")
+_END_DOCUMENT = re.compile(r"\\end\s*\{document\}")
+_MAKETITLE = re.compile(r"^\s*\\maketitle\s*$", re.MULTILINE)
+
+def failed_page_latex(page, total):
+    """Placeholder body for a page whose transcription failed"""
+    return (f"% Page {page} / {total} could not be transcribed\n"
+            f"\\begin{{center}}\\fbox{{Page {page} of {total} could not be transcribed; "
+            f"re-upload it to retry.}}\\end{{center}}\n")
+
+def merge_pages_locally(fragments):
+    """
+    Stitch per-page LaTeX documents into one, in page order and without an LLM call.
+    The first page's preamble is kept and the packages and definitions of later pages are
+    added to it (the first definition of a macro or environment wins); each body follows the previous one.
+    None entries are pages that failed and get a placeholder.
+    """
+    preamble_lines, seen_lines, defined = [], set(), set()
+    bodies = []
+    first_page_done = False
+    for idx, fragment in enumerate(fragments):
+        if fragment is None:
+            bodies.append(failed_page_latex(idx + 1, len(fragments)))
+            continue
+        preamble, rest = split_preamble(clean_latex_source(fragment))
+        for line in (preamble or "").splitlines():
+            stripped = line.strip()
+            if not stripped or stripped in seen_lines or (first_page_done and _PAGE_ONLY.match(stripped)):
+                continue
+            definition = _DEFINITION.match(stripped)
+            if definition:
+                name = next(group for group in definition.groups() if group is not None)
+                if name in defined:
+                    continue
+                defined.add(name)
+            seen_lines.add(stripped)
+            preamble_lines.append(line.rstrip())
+        first_page_done = first_page_done or preamble is not None
+        body = re.sub(r"^\s*\\begin\s*\{document\}", "", rest)
+        body = _END_DOCUMENT.split(body)[0]
+        if bodies:
+            body = _MAKETITLE.sub("", body)
+        bodies.append(body.strip() + "\n")
+    if not preamble_lines:
+        preamble_lines = ["\\documentclass[12pt]{article}", "\\usepackage{amsmath}", "\\usepackage{amssymb}"]
+    pages = [f"% --- Page {idx + 1} / {len(bodies)} ---\n{body}" for idx, body in enumerate(bodies)]
+    return "\n".join(preamble_lines) + "\n\\begin{document}\n\n" + "\n".join(pages) + "\n\\end{document}\n"
+
+def clean_latex_source(latex_source):
+    """Strip markdown fences and repair a broken \\documentclass/amssymb preamble"""
+    # Clean up markdown code fences if present
+    if latex_source.strip().startswith("```"):
+        latex_source = latex_source.strip().strip("`")
+        if latex_source.startswith("latex"):
+            latex_source = latex_source[5:].strip()
+        if latex_source.startswith("\n"):
+            latex_source = latex_source[1:]
+    
+    # Ensure document has proper structure (only fix if clearly broken)
+    if "\\documentclass" not in latex_source:
+        # Missing document class - wrap the content
+        latex_source = "\\documentclass{article}\n\\usepackage{amsmath}\n\\usepackage{amssymb}\n\\begin{document}\n" + latex_source + "\n\\end{document}"
+    else:
+        # Ensure amssymb package is included (needed for symbols like \lhd, \rhd, etc.)
+        if "\\usepackage{amssymb}" not in latex_source and "\\usepackage{amsmath}" in latex_source:
+            latex_source = latex_source.replace("\\usepackage{amsmath}", "\\usepackage{amsmath}\n\\usepackage{amssymb}")
+        elif "\\usepackage{amssymb}" not in latex_source:
+            # Add both packages if neither exists
+            if "\\begin{document}" in latex_source:
+                latex_source = latex_source.replace("\\begin{document}", "\\usepackage{amsmath}\n\\usepackage{amssymb}\n\\begin{document}")
+            else:
+                # Add before \documentclass if structure is unusual
+                if "\\documentclass" in latex_source:
+                    docclass_pos = latex_source.find("\\documentclass")
+                    next_line = latex_source.find("\n", docclass_pos)
+                    if next_line != -1:
+                        latex_source = latex_source[:next_line+1] + "\\usepackage{amsmath}\n\\usepackage{amssymb}\n" + latex_source[next_line+1:]
+        
+        if "\\begin{document}" not in latex_source and "\\end{document}" in latex_source:
+            # Has end but no begin - insert begin before end
+            latex_source = latex_source.replace("\\end{document}", "\\begin{document}\n\\end{document}")
+        elif "\\end{document}" not in latex_source and "\\begin{document}" in latex_source:
+            # Has begin but no end - add end
+            latex_source = latex_source + "\n\\end{document}"
+
+    return latex_source
+
+def call_vision_api(enhanced_images, instruction_text, details, on_delta=None, stats=None, timings=None):
+    """
+    Send the enhanced images to GPT-4o vision in one request and return the raw LaTeX reply.
+    details[i] is the `detail` level for image i.
+    With on_delta set the reply is streamed and on_delta(text) is called for every token delta.
+    If a stats dict is given, the request payload size and round-trip time are recorded in it;
+    stage timings (vision.encode, vision.request) go to the metrics and to `timings` if given.
+    """
+    # Build the user message content with text and images (OpenAI vision format)
+    with span("vision.encode", timings):
+        messages = build_vision_messages(enhanced_images, instruction_text, details)
+    if stats is None:
+        stats = {}
+    stats["payload_bytes"] = len(json.dumps({"model": MODEL_NAME, "messages": messages}))
+    tokens = text_tokens(SYSTEM_PROMPT + instruction_text) + EXPECTED_COMPLETION_TOKENS
+    for enh_bytes, detail in zip(enhanced_images, details):
+        tokens += image_tokens(*image_size(enh_bytes), detail)
+    with span("vision.request", timings):
+        return send_llm_request(messages, on_delta, stats, tokens=tokens)
+
+def build_vision_messages(enhanced_images, instruction_text, details):
+    """Chat messages carrying the instruction and the images as base64 data URLs"""
+    from denoise_pipeline import VISION_EXT
+    user_content = [{"type": "text", "text": instruction_text}]
+    
+    # Add each enhanced image
+    mime_type = get_image_mime_type(VISION_EXT)
+    for idx, enh_bytes in enumerate(enhanced_images):
+        print(f"[INFO] Encoding image {idx + 1}/{len(enhanced_images)} for vision API...")
+        base64_image = encode_image_to_base64(enh_bytes)
+        
+        user_content.append({
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:{mime_type};base64,{base64_image}",
+                "detail": details[idx]
+            }
+        })
+        
+        if len(enhanced_images) > 1 and idx < len(enhanced_images) - 1:
+            # Add separator text between images
+            user_content.append({
+                "type": "text",
+                "text": f"\n--- End of Image {idx + 1} / {len(enhanced_images)} ---\n"
+            })
+
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": user_content},
+    ]
+
+def send_llm_request(messages, on_delta, stats, tokens=None):
+    """
+    Run a chat completion (streamed if on_delta is set), recording its round-trip time in stats.
+    `tokens` is the estimated cost charged to the client-side token rate limit.
+    """
+    started = time.perf_counter()
+    if on_delta is None:
+        response = chat_completion(model=MODEL_NAME, messages=messages, stream=False, tokens=tokens)
+        stats["rtt_seconds"] = round(time.perf_counter() - started, 3)
+        return response.choices[0].message.content
+
+    # Streaming mode: forward token deltas as they arrive and assemble the full reply
+    parts = []
+    stream = chat_completion(model=MODEL_NAME, messages=messages, stream=True, tokens=tokens,
+                             stream_options={"include_usage": True})  # openai >= 1.26
+    for chunk in stream:
+        if getattr(chunk, "usage", None):
+            metrics.record_usage(MODEL_NAME, chunk.usage)
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            if not parts:
+                stats["first_token_seconds"] = round(time.perf_counter() - started, 3)
+            parts.append(delta)
+            on_delta(delta)
+    stats["rtt_seconds"] = round(time.perf_counter() - started, 3)
+    return "".join(parts)
+
+def transcribe_page(image, detail, use_cache=True, on_delta=None, stats=None, timings=None):
+    """
+    Transcribe one enhanced image into a standalone LaTeX document, cached by the image's own hash
+    (the key is the same as for a single-image upload, so either can reuse the other's result).
+    """
+    instruction_text = build_instruction_text(1)
+    key = make_cache_key([image], SYSTEM_PROMPT, instruction_text, MODEL_NAME, [detail])
+    if stats is None:
+        stats = {}
+    latex = transcription_cache.get(key) if use_cache else None
+    metrics.CACHE_LOOKUPS.inc(result="bypass" if not use_cache else ("hit" if latex is not None else "miss"))
+    stats["cached"] = latex is not None
+    if latex is not None:
+        if on_delta:
+            on_delta(latex)
+        return latex
+    latex = call_vision_api([image], instruction_text, [detail], on_delta=on_delta, stats=stats, timings=timings)
+    transcription_cache.put(key, latex)
+    return latex
+
+def merge_pages(fragments, on_delta=None, stats=None, timings=None):
+    """Stitch per-page LaTeX documents into one with a text-only LLM call (None = failed page)"""
+    fragments = [failed_page_latex(idx + 1, len(fragments)) if fragment is None else fragment
+                 for idx, fragment in enumerate(fragments)]
+    messages = [
+        {"role": "system", "content": MERGE_SYSTEM_PROMPT},
+        {"role": "user", "content": build_merge_text(fragments)},
+    ]
+    if stats is None:
+        stats = {}
+    stats["payload_bytes"] = len(json.dumps({"model": MODEL_NAME, "messages": messages}))
+    prompt_tokens = text_tokens(MERGE_SYSTEM_PROMPT + messages[1]["content"])
+    with span("vision.merge", timings):
+        return send_llm_request(messages, on_delta, stats, tokens=2 * prompt_tokens)
+
+def transcribe_pages(enhanced_images, details, use_cache=True, progress=None, on_delta=None,
+                     stats=None, timings=None):
+    """
+    Transcribe each image on its own, VISION_CONCURRENCY at a time, then merge the fragments in page order
+    (locally under one preamble, or with an LLM call if VISION_MERGE=llm), so an upload takes about as
+    long as its slowest page. Unchanged pages of a re-upload come from the per-page cache.
+    A page that fails gets a placeholder and is listed in stats["failed_pages"]; if every page fails
+    the first error is raised. on_delta receives the merged document. Per-page and merge stats go to `stats`.
+    """
+    if progress is None:
+        progress = lambda stage, status, detail=None: None
+    if timings is None:
+        timings = {}
+    total = len(enhanced_images)
+    page_stats = [{} for _ in range(total)]
+    page_timings = [{} for _ in range(total)]  # one dict per thread, summed afterwards
+    done = [0]
+    lock = threading.Lock()
+    started = time.perf_counter()
+
+    def transcribe(idx):
+        try:
+            return transcribe_page(enhanced_images[idx], details[idx], use_cache,
+                                   stats=page_stats[idx], timings=page_timings[idx])
+        except Exception as e:
+            print(f"[WARN] Page {idx + 1}/{total} failed: {e}")
+            page_stats[idx]["error"] = str(e)
+            return e
+        finally:
+            with lock:
+                done[0] += 1
+                progress("vision", "running", f"page {done[0]}/{total}")
+
+    with ThreadPoolExecutor(max_workers=max(1, min(VISION_CONCURRENCY, total)),
+                            thread_name_prefix="vision-page") as pool:
+        results = list(pool.map(transcribe, range(total)))
+    for page in page_timings:
+        for stage, seconds in page.items():
+            timings[stage] = round(timings.get(stage, 0.0) + seconds, 4)
+    failed_pages = [idx + 1 for idx, result in enumerate(results) if isinstance(result, Exception)]
+    if len(failed_pages) == total:
+        raise results[0]
+    fragments = [None if isinstance(result, Exception) else result for result in results]
+    cached_pages = sum(1 for page in page_stats if page.get("cached"))
+    print(f"[INFO] Transcribed {total} pages ({cached_pages} from cache, {len(failed_pages)} failed), merging...")
+
+    progress("vision", "running", "merging pages")
+    merge_stats = {"mode": VISION_MERGE}
+    if VISION_MERGE == "llm":
+        latex = merge_pages(fragments, on_delta=on_delta, stats=merge_stats, timings=timings)
+    else:
+        with span("vision.merge", timings):
+            latex = merge_pages_locally(fragments)
+        if on_delta:
+            on_delta(latex)
+    if stats is not None:
+        stats.update({
+            "pages": page_stats,
+            "merge": merge_stats,
+            "failed_pages": failed_pages,
+            "payload_bytes": sum(page.get("payload_bytes", 0) for page in page_stats)
+                             + merge_stats.get("payload_bytes", 0),
+            "rtt_seconds": round(time.perf_counter() - started, 3),
+        })
+    return latex
+
+def denoise_images(images, progress, timings, denoise_profile=None, workers=None):
+    """
+    Step 1: denoise and enhance the images in parallel, in memory (output order matches input order).
+    Returns (encoded images for the vision API, per-image denoise stats).
+    workers defaults to DENOISE_WORKERS, denoise_profile to DENOISE_PROFILE.
+    """
+    from denoise_pipeline import denoise_bytes_many
+    print(f"[INFO] Denoising {len(images)} image(s)...")
+    progress("denoise", "running")
+    with span("denoise", timings):
+        denoised = denoise_bytes_many(
+            images,
+            outputs=("vision",),
+            workers=workers or DENOISE_WORKERS,
+            on_progress=lambda done, total: progress("denoise", "running", f"image {done}/{total}"),
+            vision_max_edge=VISION_MAX_EDGE,
+            with_info=True,
+            tile_size=DENOISE_TILE_SIZE,
+            profile=denoise_profile or DENOISE_PROFILE,
+            noise_threshold=DENOISE_NOISE_THRESHOLD,
+        )
+    # Per-step times are summed over the images (they may have run in parallel)
+    denoise_stats = []
+    for _, info in denoised:
+        for step, seconds in info["timings"].items():
+            record(f"denoise.{step}", seconds, timings)
+        metrics.DENOISE_PROFILES.inc(profile=info["profile"])
+        denoise_stats.append({"profile": info["profile"], "noise_sigma": info["noise_sigma"]})
+    enhanced_images = [outputs["vision"] for outputs, _ in denoised]
+    progress("denoise", "done", f"{len(enhanced_images)} image(s), "
+             f"profile {', '.join(entry['profile'] for entry in denoise_stats)}")
+    return enhanced_images, denoise_stats
+
+def transcribe_images(enhanced_images, progress, timings, use_cache=True, on_delta=None):
+    """
+    Step 2: transcribe the enhanced images with GPT-4o vision (or reuse a cached transcription of the
+    same images + prompt) and clean up the LaTeX. Returns (latex, cached, vision stats).
+    """
+    # Pick the vision detail level for each (downscaled) image
+    vision_stats = {"images": []}
+    with span("vision.prepare", timings):
+        for img_bytes in enhanced_images:
+            width, height = image_size(img_bytes)
+            vision_stats["images"].append({"width": width, "height": height, "bytes": len(img_bytes),
+                                           "detail": choose_detail(width, height)})
+    details = [entry["detail"] for entry in vision_stats["images"]]
+    print(f"[INFO] Enhanced {len(enhanced_images)} images "
+          f"({sum(len(b) for b in enhanced_images) / 1024:.0f} KB). Preparing for GPT-4o vision API...")
+
+    # In pages mode a multi-image upload is transcribed page by page and merged (see transcribe_pages)
+    paged = VISION_MODE == "pages" and len(enhanced_images) > 1
+    instruction_text = build_instruction_text(len(enhanced_images))
+    merge_prompt = MERGE_SYSTEM_PROMPT if VISION_MERGE == "llm" else "merge:local"
+    cache_key = make_cache_key(enhanced_images, merge_prompt if paged else SYSTEM_PROMPT,
+                               instruction_text, MODEL_NAME, details)
+    with span("cache.lookup", timings):
+        latex_source = transcription_cache.get(cache_key) if use_cache else None
+    cached = latex_source is not None
+    metrics.CACHE_LOOKUPS.inc(result="hit" if cached else ("miss" if use_cache else "bypass"))
+    if cached:
+        print(f"[INFO] Transcription cache hit ({cache_key[:12]}), skipping vision API call.")
+        if on_delta:
+            on_delta(latex_source)
+        progress("vision", "done", "cache hit")
+    else:
+        print(f"[INFO] Sending {len(enhanced_images)} image(s) to GPT-4o vision API...")
+        progress("vision", "running")
+        if paged:
+            latex_source = transcribe_pages(enhanced_images, details, use_cache=use_cache, progress=progress,
+                                            on_delta=on_delta, stats=vision_stats, timings=timings)
+        else:
+            latex_source = call_vision_api(enhanced_images, instruction_text, details,
+                                           on_delta=on_delta, stats=vision_stats, timings=timings)
+        print(f"[INFO] LLM returned LaTeX ({vision_stats['payload_bytes'] / 1024:.0f} KB request, "
+              f"{vision_stats['rtt_seconds']:.1f}s round trip).")
+        if vision_stats.get("failed_pages"):
+            print(f"[WARN] Pages {vision_stats['failed_pages']} could not be transcribed, not caching the document.")
+        else:
+            transcription_cache.put(cache_key, latex_source)
+        progress("vision", "done")
+
+    with span("clean", timings):
+        latex_source = clean_latex_source(latex_source)
+    return latex_source, cached, vision_stats
+
+def note_name_for(image_count, when=None, copy=1):
+    """notes_YYYY-MM-DD_HH-MM-SS[_K][_multiN] (the format /history parses) for a note made at `when` (default now)"""
+    note_name = f"notes_{(when or datetime.now()).strftime('%Y-%m-%d_%H-%M-%S')}"
+    if copy > 1:
+        note_name += f"_{copy}"  # another note was made in the same second
+    if image_count > 1:
+        note_name += f"_multi{image_count}"
+    return note_name
+
+def save_note(latex_source, image_count, timings, note_name=None, when=None, created=None):
+    """
+    Step 3: write the .tex and add it to the note catalog (dated `created`, default now).
+    Without a note_name, a free one is reserved from the time `when` (default now).
+    Returns (note_name, tex_path).
+    """
+    with span("save", timings):
+        if note_name is None:
+            note_name = note_catalog.reserve_note(lambda copy: note_name_for(image_count, when, copy),
+                                                  image_count=image_count, created=created)
+        else:
+            note_catalog.add_note(note_name, image_count=image_count, created=created)
+        tex_path = os.path.join(DOCS_DIR, f"{note_name}.tex")
+        with open(tex_path, "w") as f:
+            f.write(latex_source)
+    print(f"[INFO] Wrote LaTeX to {tex_path}")
+    return note_name, tex_path
+
+def compile_note(note_name, pool, progress, timings):
+    """
+    Step 4: compile the PDF on `pool` (a CompilePool; optional, may fail if LaTeX isn't installed).
+    Returns (pdf_path, compilation_error).
+    """
+    progress("compile", "running")
+    try:
+        with span("compile", timings):
+            compiled = pool.compile(note_name)
+        pdf_path = compiled["pdf_path"]
+        compilation_error = compiled["compilation_error"]
+        timings["compile.queue"] = compiled.get("queue_seconds", 0.0)
+        timings["compile.run"] = compiled["seconds"]
+    except CompileQueueFull:
+        print("[WARN] Compile queue full, skipping PDF compilation")
+        pdf_path = None
+        compilation_error = "The PDF compiler is busy. Use recompile to build the PDF later."
+    note_catalog.set_pdf(note_name, pdf_path is not None)
+    progress("compile", "done" if pdf_path else "failed", compilation_error)
+    return pdf_path, compilation_error
+
+def read_image(img):
+    """Image bytes of an upload (bytes pass through) or of a file path"""
+    if not isinstance(img, str):
+        return img
+    with open(img, "rb") as f:
+        return f.read()
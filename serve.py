@@ -0,0 +1,127 @@
+# Production server: gunicorn with several worker processes, each serving requests on threads
+# The app is preloaded in the master, so cv2, SymPy and the OpenAI client are imported once and
+# shared copy-on-write by the forked workers. Upload jobs and LLM rate limits go through a local
+# SQLite store (shared_state.py) and the chatbot's CAS cache through another, so every worker sees
+# the same jobs, cache and budget. SIGTERM lets each worker drain its uploads and compiles first;
+# the jobs of a worker that dies anyway are marked failed.
+#
+# Usage:
+#   python serve.py                                  # 0.0.0.0:8000, workers sized from the CPU count
+#   python serve.py --bind 127.0.0.1:5000 --workers 4 --threads 8
+
+import argparse
+import importlib
+import os
+
+DOCS_DIR = "notes_out"
+# Before the app is imported: these are read at import time
+os.environ.setdefault("SHARED_STATE_PATH", os.path.join(DOCS_DIR, ".shared.sqlite3"))
+os.environ.setdefault("CAS_CACHE_PATH", os.path.join(DOCS_DIR, ".cas_cache.sqlite3"))
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:  # gunicorn doesn't run on Windows
+    BaseApplication = None
+
+WEB_BIND = os.environ.get("WEB_BIND", "0.0.0.0:8000")
+WEB_WORKERS = int(os.environ.get("WEB_WORKERS", 0))  # 0 = sized from the CPU count
+WEB_THREADS = int(os.environ.get("WEB_THREADS", 8))  # request threads per worker
+GRACEFUL_TIMEOUT = int(os.environ.get("GRACEFUL_TIMEOUT", 300))  # seconds a stopping worker gets to drain
+DRAIN_MARGIN = 10  # seconds kept back from GRACEFUL_TIMEOUT so a worker exits before it is killed
+
+
+def default_workers() -> int:
+    """
+    One worker per CPU, between 2 and 4: requests mostly wait on the LLM, and the CPU-heavy work goes
+    to process pools (denoise, SymPy, LaTeX) that every worker has its own copy of.
+    """
+    return max(2, min(4, os.cpu_count() or 1))
+
+
+def post_fork(server, worker):
+    """In each new worker: warm up its own LLM client, SymPy workers and denoiser (nothing of that survives a fork)."""
+    import app
+    if app.APP_WARMUP:
+        app.warm_up()
+
+
+def worker_exit(server, worker):
+    """The worker has stopped taking requests; let its uploads and compiles finish before it exits."""
+    import app
+    app.drain(max(1, server.cfg.graceful_timeout - DRAIN_MARGIN))
+
+
+def child_exit(server, worker):
+    """
+    In the master, once a worker is gone: fail the upload jobs it left queued or running (after a crash,
+    a timeout or a drain that ran out of time), so clients polling them get an answer.
+    """
+    import shared_state
+    if shared_state.store is None:
+        return
+    try:
+        stale = shared_state.store.fail_unfinished_jobs("The server worker running this job stopped", pid=worker.pid)
+    except Exception as e:
+        print(f"[WARN] Could not fail the jobs of worker {worker.pid}: {e}")
+        return
+    if stale:
+        print(f"[WARN] Worker {worker.pid} exited with {stale} unfinished upload job(s), marked them as failed")
+
+
+if BaseApplication is not None:
+    class Server(BaseApplication):
+        """gunicorn application serving app.app with the options given on the command line."""
+
+        def __init__(self, options):
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            # Runs in the master before the workers fork (preload_app): import everything heavy here,
+            # but start no threads or processes, they wouldn't survive the fork
+            import app
+            import shared_state
+            from latex_compile import COMMON_PREAMBLES
+            for name in app.LAZY_MODULES:
+                importlib.import_module(name)
+            for preamble in COMMON_PREAMBLES:
+                app.latex_compiler.build_format(preamble)
+            if shared_state.store is not None:
+                stale = shared_state.store.fail_unfinished_jobs("The server restarted before the job finished")
+                if stale:
+                    print(f"[WARN] Marked {stale} upload job(s) left over from a previous run as failed")
+            return app.app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the Lecture-to-LaTeX web app with gunicorn")
+    parser.add_argument("--bind", default=WEB_BIND, help="address:port to listen on (default %(default)s)")
+    parser.add_argument("--workers", type=int, default=WEB_WORKERS or default_workers(),
+                        help="worker processes (default %(default)s, from the CPU count)")
+    parser.add_argument("--threads", type=int, default=WEB_THREADS, help="request threads per worker")
+    parser.add_argument("--graceful-timeout", type=int, default=GRACEFUL_TIMEOUT,
+                        help="seconds a stopping worker gets to finish its uploads and compiles")
+    args = parser.parse_args()
+    if BaseApplication is None:
+        raise SystemExit("[ERROR] gunicorn is not installed (pip install gunicorn); on Windows use python app.py")
+    print(f"[INFO] Serving on {args.bind} with {args.workers} worker(s) x {args.threads} thread(s)")
+    Server({
+        "bind": args.bind,
+        "workers": args.workers,
+        "threads": args.threads,
+        "worker_class": "gthread",
+        "preload_app": True,
+        "timeout": 120,
+        "graceful_timeout": args.graceful_timeout,
+        "post_fork": post_fork,
+        "worker_exit": worker_exit,
+        "child_exit": child_exit,
+    }).run()
+
+
+if __name__ == "__main__":
+    main()
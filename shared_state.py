@@ -0,0 +1,183 @@
+# Shared state for multi-process serving
+# serve.py runs several worker processes; upload jobs (status, streamed output, result) and the LLM
+# rate budgets are kept in one local SQLite file so whichever worker a request lands on sees the same
+# jobs and draws on the same budget. A single-process server (python app.py) doesn't use it.
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+SHARED_STATE_PATH = os.environ.get("SHARED_STATE_PATH") or None  # set by serve.py
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    state TEXT NOT NULL,
+    result TEXT,
+    pid INTEGER,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+CREATE TABLE IF NOT EXISTS job_output (
+    job_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    PRIMARY KEY (job_id, seq)
+);
+CREATE TABLE IF NOT EXISTS buckets (
+    name TEXT PRIMARY KEY,
+    level REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pauses (
+    name TEXT PRIMARY KEY,
+    until REAL NOT NULL
+);
+"""
+
+
+class SharedStore:
+    """
+    One SQLite file (WAL) shared by the worker processes.
+    Each process and thread opens its own connection on first use; a connection must not cross a fork.
+    Times stored here are wall-clock (time.time()), the only clock the processes share.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            if "pid" not in {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}:
+                conn.execute("ALTER TABLE jobs ADD COLUMN pid INTEGER")  # files made before jobs recorded their worker
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    # ---------- upload jobs ----------
+    def save_job(self, job_id: str, status: str, state: Dict[str, Any], result: Optional[Dict[str, Any]],
+                 first_chunk: int = 0, chunks: List[str] = ()):
+        """
+        Write a job's status, state (Job.to_dict()) and result, and append its new output chunks.
+        The job is recorded as owned by this process, whose exit fails it if it isn't finished by then.
+        """
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("INSERT OR REPLACE INTO job_output (job_id, seq, text) VALUES (?, ?, ?)",
+                             [(job_id, first_chunk + i, text) for i, text in enumerate(chunks)])
+            conn.execute("INSERT OR REPLACE INTO jobs (id, status, state, result, pid, created_at, updated_at) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (job_id, status, json.dumps(state), json.dumps(result) if result is not None else None,
+                          os.getpid(), state["created_at"], time.time()))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def load_job(self, job_id: str) -> Optional[Tuple[str, Dict[str, Any], Optional[Dict[str, Any]]]]:
+        """(status, state, result) of a job, or None if the store doesn't know it."""
+        row = self._conn().execute("SELECT status, state, result FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]), json.loads(row[2]) if row[2] is not None else None
+
+    def delete_job(self, job_id: str):
+        """Forget a job and its output (e.g. one that was refused before it was queued)."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM job_output WHERE job_id = ?", (job_id,))
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def job_output(self, job_id: str, start: int = 0) -> List[str]:
+        """Output chunks of a job from index `start` on."""
+        rows = self._conn().execute("SELECT text FROM job_output WHERE job_id = ? AND seq >= ? ORDER BY seq",
+                                    (job_id, start)).fetchall()
+        return [row[0] for row in rows]
+
+    def queued_ahead(self, created_at: float) -> int:
+        """Queued jobs (on any worker) submitted before `created_at`."""
+        return self._conn().execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created_at < ?",
+                                    (created_at,)).fetchone()[0]
+
+    def job_counts(self) -> Dict[str, int]:
+        rows = self._conn().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return dict(rows)
+
+    def prune_jobs(self, finished_before: float):
+        """Forget finished jobs (and their output) last updated before `finished_before`."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM job_output WHERE job_id IN (SELECT id FROM jobs WHERE status IN "
+                         "('done', 'failed') AND updated_at < ?)", (finished_before,))
+            conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?", (finished_before,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def fail_unfinished_jobs(self, error: str, pid: Optional[int] = None) -> int:
+        """
+        Mark jobs left queued or running by workers that are gone (all of them, or those of the
+        worker process `pid`) as failed. Returns how many.
+        """
+        conn = self._conn()
+        if pid is None:
+            rows = conn.execute("SELECT id, state FROM jobs WHERE status IN ('queued', 'running')").fetchall()
+        else:
+            rows = conn.execute("SELECT id, state FROM jobs WHERE status IN ('queued', 'running') AND pid = ?",
+                                (pid,)).fetchall()
+        for job_id, state in rows:
+            state = json.loads(state)
+            state.update(status="failed", error=error, finished_at=time.time())
+            self.save_job(job_id, "failed", state, None)
+        return len(rows)
+
+    # ---------- rate limits ----------
+    def bucket_level(self, name: str, rate: float, capacity: float) -> float:
+        """Current level of a token bucket (refilled at `rate` per second up to `capacity`; starts full)."""
+        row = self._conn().execute("SELECT level, updated_at FROM buckets WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return capacity
+        return min(capacity, row[0] + (time.time() - row[1]) * rate)
+
+    def bucket_take(self, name: str, rate: float, capacity: float, amount: float):
+        """Take `amount` from a token bucket, atomically across processes (the level may go negative)."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            level = self.bucket_level(name, rate, capacity) - amount
+            conn.execute("INSERT OR REPLACE INTO buckets (name, level, updated_at) VALUES (?, ?, ?)",
+                         (name, level, time.time()))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def pause(self, name: str, until: float):
+        """Hold `name` back until the wall-clock time `until` (a later pause already set wins)."""
+        self._conn().execute("INSERT INTO pauses (name, until) VALUES (?, ?) "
+                             "ON CONFLICT(name) DO UPDATE SET until = MAX(until, excluded.until)", (name, until))
+
+    def paused_until(self, name: str) -> float:
+        row = self._conn().execute("SELECT until FROM pauses WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0.0
+
+
+store = SharedStore(SHARED_STATE_PATH) if SHARED_STATE_PATH else None
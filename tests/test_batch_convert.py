@@ -0,0 +1,168 @@
+import json
+import os
+from concurrent.futures import Future
+from datetime import datetime
+
+import pytest
+
+import batch_convert
+import pipeline
+from batch_convert import BatchRun, Manifest, group_images
+from note_catalog import NoteCatalog
+
+LATEX = "\\documentclass{article}\n\\begin{document}\nx^2\n\\end{document}\n"
+
+
+def photo(path, taken):
+    """A (non-decodable) .jpg whose mtime is `taken`, so photo_time falls back to it."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"not really a jpeg " + path.encode())
+    stamp = taken.timestamp()
+    os.utime(path, (stamp, stamp))
+    return path
+
+
+class FakeCompilePool:
+    def __init__(self, pdf=True):
+        self.pdf = pdf
+        self.submitted = []
+
+    def submit(self, note_name):
+        self.submitted.append(note_name)
+        future = Future()
+        future.set_result({"pdf_path": f"{note_name}.pdf" if self.pdf else None,
+                           "compilation_error": None if self.pdf else "LaTeX Error", "seconds": 0.0})
+        return future
+
+
+@pytest.fixture
+def stages(tmp_path, monkeypatch):
+    """Fake denoise and vision stages (counting calls) writing notes and the catalog under tmp_path."""
+    docs = tmp_path / "notes_out"
+    docs.mkdir()
+    monkeypatch.setattr(pipeline, "DOCS_DIR", str(docs))
+    monkeypatch.setattr(pipeline, "note_catalog", NoteCatalog(str(docs / ".catalog.sqlite3"), str(docs)))
+    calls = {"transcribe": 0, "fail": False}
+
+    def denoise_images(images, progress, timings, denoise_profile=None, workers=None):
+        return images, []
+
+    def transcribe_images(enhanced, progress, timings, use_cache=True, on_delta=None):
+        calls["transcribe"] += 1
+        if calls["fail"]:
+            raise RuntimeError("vision API down")
+        return LATEX, False, {}
+
+    monkeypatch.setattr(pipeline, "denoise_images", denoise_images)
+    monkeypatch.setattr(pipeline, "transcribe_images", transcribe_images)
+    return calls
+
+
+def make_run(tmp_path, pdf=True):
+    run = BatchRun(Manifest(str(tmp_path / "manifest.json")))
+    run.compile_pool = FakeCompilePool(pdf)
+    return run
+
+
+@pytest.fixture
+def groups(tmp_path):
+    day = datetime(2024, 9, 2, 10, 0)
+    paths = [photo(str(tmp_path / "photos" / "lec1" / f"p{i}.jpg"), day.replace(minute=i)) for i in range(2)]
+    paths.append(photo(str(tmp_path / "photos" / "lec2" / "p0.jpg"), day.replace(hour=14)))
+    return group_images(batch_convert.find_images([str(tmp_path / "photos")]))
+
+
+def test_group_images_by_folder_and_gap(tmp_path):
+    day = datetime(2024, 9, 2, 10, 0)
+    folder = tmp_path / "lec"
+    paths = [photo(str(folder / name), day.replace(minute=minute))
+             for name, minute in (("c.jpg", 50), ("a.jpg", 0), ("b.jpg", 5))]
+    by_folder = group_images(sorted(paths))
+    assert [len(group["images"]) for group in by_folder] == [3]
+    assert [os.path.basename(p) for p in by_folder[0]["images"]] == ["a.jpg", "b.jpg", "c.jpg"]
+    assert by_folder[0]["taken"] == day
+
+    by_gap = group_images(sorted(paths), mode="gap", gap_minutes=30)
+    assert [[os.path.basename(p) for p in group["images"]] for group in by_gap] == [["a.jpg", "b.jpg"], ["c.jpg"]]
+    assert by_gap[1]["taken"] == day.replace(minute=50)
+
+
+def test_manifest_entries_survive_reload(tmp_path, groups):
+    path = str(tmp_path / "manifest.json")
+    manifest = Manifest(path)
+    assert manifest.entry(groups[0])["status"] == "pending"
+    manifest.update(groups[0]["id"], status="transcribed", note_name="notes_x")
+
+    reloaded = Manifest(path)
+    entry = reloaded.entry(groups[0])
+    assert (entry["status"], entry["note_name"]) == ("transcribed", "notes_x")
+    assert not os.path.exists(path + ".tmp")
+    with open(path) as f:
+        assert set(json.load(f)["groups"]) == {groups[0]["id"]}
+
+
+def test_manifest_resets_groups_whose_images_changed(tmp_path, groups):
+    manifest = Manifest(str(tmp_path / "manifest.json"))
+    manifest.entry(groups[0])
+    manifest.update(groups[0]["id"], status="done")
+    with open(groups[0]["images"][0], "ab") as f:
+        f.write(b"edited")
+    assert manifest.entry(groups[0])["status"] == "pending"
+
+
+def test_run_converts_then_skips_done_groups(tmp_path, stages, groups):
+    run = make_run(tmp_path)
+    run.run(groups)
+    assert stages["transcribe"] == 2
+    assert run.counts["done"] == 2 and run.counts["images"] == 3
+    manifest = Manifest(str(tmp_path / "manifest.json"))
+    entries = [manifest.entry(group) for group in groups]
+    assert [entry["status"] for entry in entries] == ["done", "done"]
+    # Notes are named after their first photo
+    assert entries[0]["note_name"] == "notes_2024-09-02_10-00-00_multi2"
+    assert os.path.exists(os.path.join(pipeline.DOCS_DIR, entries[1]["note_name"] + ".tex"))
+
+    again = make_run(tmp_path)
+    again.run(groups)
+    assert stages["transcribe"] == 2
+    assert again.counts["skipped"] == 2 and again.compile_pool.submitted == []
+
+
+def test_transcribed_groups_only_recompile(tmp_path, stages, groups):
+    first = make_run(tmp_path, pdf=False)
+    first.run(groups)
+    assert first.counts["no_pdf"] == 2
+    manifest = Manifest(str(tmp_path / "manifest.json"))
+    names = [manifest.entry(group)["note_name"] for group in groups]
+    assert [manifest.entry(group)["status"] for group in groups] == ["transcribed", "transcribed"]
+
+    second = make_run(tmp_path)
+    second.run(groups)
+    assert stages["transcribe"] == 2  # the saved .tex files are compiled again, not re-transcribed
+    assert sorted(second.compile_pool.submitted) == sorted(names)
+    assert [Manifest(str(tmp_path / "manifest.json")).entry(group)["status"] for group in groups] == ["done", "done"]
+
+
+def test_missing_tex_is_transcribed_again_under_the_same_name(tmp_path, stages, groups):
+    make_run(tmp_path, pdf=False).run(groups[:1])
+    note_name = Manifest(str(tmp_path / "manifest.json")).entry(groups[0])["note_name"]
+    os.remove(os.path.join(pipeline.DOCS_DIR, note_name + ".tex"))
+
+    run = make_run(tmp_path)
+    run.run(groups[:1])
+    assert stages["transcribe"] == 2
+    assert run.compile_pool.submitted == [note_name]
+
+
+def test_failed_groups_are_retried(tmp_path, stages, groups):
+    stages["fail"] = True
+    run = make_run(tmp_path)
+    run.run(groups[:1])
+    entry = Manifest(str(tmp_path / "manifest.json")).entry(groups[0])
+    assert (entry["status"], entry["error"]) == ("failed", "vision API down")
+    assert run.counts["failed"] == 1
+
+    stages["fail"] = False
+    make_run(tmp_path).run(groups[:1])
+    assert Manifest(str(tmp_path / "manifest.json")).entry(groups[0])["status"] == "done"
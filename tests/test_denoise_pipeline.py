@@ -0,0 +1,45 @@
+import cv2
+import numpy as np
+import pytest
+
+from denoise_pipeline import (denoise_nlm, enhance_chalkboard, enhance_chalkboard_tiled, otsu_threshold)
+
+
+def noisy_board(h, w, seed=0):
+    """Dark board with a few chalk strokes and sensor noise."""
+    rng = np.random.default_rng(seed)
+    img = np.full((h, w, 3), (45, 70, 40), np.float32)
+    for _ in range(12):
+        p1 = tuple(int(v) for v in rng.integers(0, (w, h)))
+        p2 = tuple(int(v) for v in rng.integers(0, (w, h)))
+        cv2.line(img, p1, p2, (220, 225, 220), int(rng.integers(2, 5)))
+    img += rng.normal(0, 12, img.shape)
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+@pytest.mark.parametrize("shape,tile_size", [((300, 340), 128), ((257, 129), 64), ((200, 200), 100)])
+def test_tiled_nlm_matches_whole_image(shape, tile_size):
+    img = noisy_board(*shape)
+    whole = denoise_nlm(img)
+    tiled = denoise_nlm(img, tile_size=tile_size, workers=2)
+    assert np.array_equal(tiled, whole)
+
+
+def test_small_images_are_not_tiled():
+    img = noisy_board(60, 80)
+    assert np.array_equal(denoise_nlm(img, tile_size=100), denoise_nlm(img))
+
+
+def test_otsu_threshold_matches_opencv():
+    gray = cv2.cvtColor(noisy_board(120, 160, seed=3), cv2.COLOR_BGR2GRAY)
+    expected, _ = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    assert otsu_threshold(np.bincount(gray.ravel(), minlength=256)) == int(expected)
+
+
+@pytest.mark.parametrize("tile_size", [50, 64, 1024])
+def test_tiled_enhance_matches_whole_image(tile_size):
+    img = noisy_board(230, 170, seed=1)
+    closed, _ = enhance_chalkboard(img, with_edges=False)
+    tiled, edges = enhance_chalkboard_tiled(img, with_edges=False, tile_size=tile_size)
+    assert edges is None
+    assert np.array_equal(tiled, closed)
@@ -0,0 +1,92 @@
+import threading
+
+import pytest
+
+from job_queue import JobQueue, QueueFull
+
+
+def blocking_job(started, release):
+    def run(progress=None, emit=None):
+        started.set()
+        release.wait(5)
+        return {"ok": True}
+    return run
+
+
+@pytest.fixture
+def release():
+    event = threading.Event()
+    yield event
+    event.set()  # never leave worker threads blocked
+
+
+def fill(jobs, release):
+    """One running job plus max_queued waiting ones."""
+    started = threading.Event()
+    running = jobs.submit(blocking_job(started, release))
+    assert started.wait(5)
+    waiting = [jobs.submit(blocking_job(threading.Event(), release)) for _ in range(jobs.max_queued)]
+    return running, waiting
+
+
+def test_submit_refuses_beyond_max_queued(release):
+    jobs = JobQueue(workers=1, max_queued=2)
+    running, waiting = fill(jobs, release)
+    assert running.status == "running"
+    assert [job.status for job in waiting] == ["queued", "queued"]
+    assert [jobs.position(job) for job in waiting] == [1, 2]
+
+    with pytest.raises(QueueFull):
+        jobs.submit(blocking_job(threading.Event(), release))
+    # The refused job is not kept around
+    stats = jobs.stats()
+    assert (stats["running"], stats["queued"]) == (1, 2)
+
+
+def test_jobs_run_once_released(release):
+    jobs = JobQueue(workers=1, max_queued=2)
+    running, waiting = fill(jobs, release)
+    release.set()
+    assert jobs.drain(5)
+    assert all(job.status == "done" and job.result == {"ok": True} for job in [running] + waiting)
+    assert jobs.position(running) == 0
+
+
+def test_queue_full_carries_retry_after(release):
+    jobs = JobQueue(workers=1, max_queued=1)
+    fill(jobs, release)
+    with pytest.raises(QueueFull) as refused:
+        jobs.submit(blocking_job(threading.Event(), release))
+    assert refused.value.retry_after == 30  # no finished jobs yet: assume 30s per job
+    assert "30s" in str(refused.value)
+
+
+def test_retry_after_uses_recent_durations():
+    jobs = JobQueue(workers=2, max_queued=1)
+    assert jobs.retry_after() == 15
+    jobs._durations = [10.0, 20.0]
+    assert jobs.retry_after() == 8  # 15s average job over 2 workers, rounded
+    jobs._durations = [0.1]
+    assert jobs.retry_after() == 1  # never below one second
+
+
+def test_drained_queue_refuses_jobs():
+    jobs = JobQueue(workers=1, max_queued=1)
+    assert jobs.drain(1)
+    with pytest.raises(QueueFull) as refused:
+        jobs.submit(lambda progress=None, emit=None: None)
+    assert refused.value.retry_after == 1
+
+
+def test_failed_job_reports_error():
+    jobs = JobQueue(workers=1, max_queued=1)
+
+    def broken(progress=None, emit=None):
+        progress("denoise", "running")
+        raise ValueError("bad image")
+
+    job = jobs.submit(broken)
+    assert jobs.drain(5)
+    assert job.status == "failed"
+    assert job.error == "bad image"
+    assert job.stages["denoise"]["status"] == "failed"
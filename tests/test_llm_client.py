@@ -0,0 +1,67 @@
+import pytest
+
+import llm_client
+import shared_state
+from llm_client import SharedTokenBucket, TokenBucket
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(llm_client.time, "monotonic", clock)
+    monkeypatch.setattr(shared_state.time, "time", clock)
+    return clock
+
+
+def test_bucket_starts_full(clock):
+    bucket = TokenBucket(rate=10, capacity=100)
+    assert bucket.wait_time(100) == 0.0
+    bucket.take(100)
+    assert bucket.wait_time(1) == pytest.approx(0.1)
+
+
+def test_bucket_refills_at_rate_up_to_capacity(clock):
+    bucket = TokenBucket(rate=10, capacity=100)
+    bucket.take(60)
+    assert bucket.wait_time(100) == pytest.approx(6.0)
+    clock.now += 3
+    assert bucket.wait_time(100) == pytest.approx(3.0)
+    clock.now += 60  # long idle: refills only to capacity
+    assert bucket.wait_time(100) == 0.0
+    bucket.take(100)
+    assert bucket.wait_time(50) == pytest.approx(5.0)
+
+
+def test_amounts_above_capacity_are_clamped(clock):
+    bucket = TokenBucket(rate=10, capacity=100)
+    assert bucket.wait_time(500) == 0.0  # a single large call can still go through
+    bucket.take(500)
+    assert bucket.wait_time(100) == pytest.approx(10.0)  # the bucket is empty, not overdrawn
+
+
+def test_shared_bucket_is_shared_between_instances(clock, tmp_path):
+    store = shared_state.SharedStore(str(tmp_path / "shared.sqlite3"))
+    first = SharedTokenBucket(store, "tokens", rate=10, capacity=100)
+    second = SharedTokenBucket(store, "tokens", rate=10, capacity=100)
+    assert second.wait_time(100) == 0.0
+    first.take(80)
+    assert second.wait_time(100) == pytest.approx(8.0)
+    clock.now += 8
+    assert second.wait_time(100) == pytest.approx(0.0)
+
+
+def test_shared_bucket_can_be_overdrawn(clock, tmp_path):
+    store = shared_state.SharedStore(str(tmp_path / "shared.sqlite3"))
+    bucket = SharedTokenBucket(store, "tokens", rate=10, capacity=100)
+    # Two workers that both saw room take at once; the next call waits out the overdraft
+    bucket.take(100)
+    bucket.take(100)
+    assert bucket.wait_time(50) == pytest.approx(15.0)
@@ -0,0 +1,87 @@
+import difflib
+import random
+import re
+import string
+
+import pytest
+
+import math_chatbot
+from math_chatbot import _KEYWORDS, fuzzy_fix_keyword, insert_parens_after_func
+
+FUNCS = ["sin", "cos", "tan", "cot", "sec", "csc", "log", "sqrt"]
+
+
+# The implementations these replaced, as the reference
+def reference_fuzzy_fix_keyword(word, cutoff=0.75):
+    m = difflib.get_close_matches(word, _KEYWORDS, n=1, cutoff=cutoff)
+    return m[0] if m else word
+
+
+def reference_insert_parens_after_func(expr):
+    expr = re.sub(r"\b(ln)\b", "log", expr)
+    for func in FUNCS:
+        expr = re.sub(rf"\b{func}\s*([a-zA-Z]\b)", rf"{func}(\1)", expr)
+        expr = re.sub(rf"\b{func}([a-zA-Z])\b", rf"{func}(\1)", expr)
+        expr = re.sub(rf"\b{func}\s*(\d+[a-zA-Z])", rf"{func}(\1)", expr)
+    return expr
+
+
+def typos(word):
+    """Every single-character deletion, transposition, substitution and insertion of word."""
+    letters = string.ascii_lowercase
+    splits = [(word[:i], word[i:]) for i in range(len(word) + 1)]
+    edits = {a + b[1:] for a, b in splits if b}
+    edits |= {a + b[1] + b[0] + b[2:] for a, b in splits if len(b) > 1}
+    edits |= {a + c + b[1:] for a, b in splits if b for c in letters}
+    edits |= {a + c + b for a, b in splits for c in letters}
+    return sorted(edits)
+
+
+CHAT_TOKENS = ["what", "is", "the", "of", "x^2", "what's", "d/dy", "sin(x)", "", "a", "integrl", "deriv",
+               "solv", "simplfy", "factr", "expnd", "limt", "explian", "rootz", "soluton", "differentate"]
+
+
+@pytest.fixture(autouse=True)
+def cold_cache():
+    math_chatbot._closest_keyword.cache_clear()
+
+
+def test_exact_keywords_are_returned():
+    assert [fuzzy_fix_keyword(keyword) for keyword in _KEYWORDS] == _KEYWORDS
+
+
+@pytest.mark.parametrize("word,expected", [
+    ("integrl", "integral"), ("derivatve", "derivative"), ("simplfy", "simplify"),
+    ("solv", "solve"), ("x^2", "x^2"), ("what", "what"),
+])
+def test_typos_are_corrected(word, expected):
+    assert fuzzy_fix_keyword(word) == expected
+
+
+def test_fuzzy_fix_keyword_matches_get_close_matches():
+    rng = random.Random(0)
+    words = CHAT_TOKENS + [typo for keyword in _KEYWORDS for typo in typos(keyword)]
+    words += ["".join(rng.choice("abcdefilnorstuvx/^") for _ in range(rng.randint(1, 14))) for _ in range(2000)]
+    for cutoff in (0.6, 0.75, 0.9):
+        for word in words:
+            assert fuzzy_fix_keyword(word, cutoff) == reference_fuzzy_fix_keyword(word, cutoff), (word, cutoff)
+    # Answers remembered from the first pass are the same
+    for word in words:
+        assert fuzzy_fix_keyword(word) == reference_fuzzy_fix_keyword(word)
+
+
+@pytest.mark.parametrize("expr,expected", [
+    ("sinx", "sin(x)"), ("sin x", "sin(x)"), ("sin 2x", "sin(2x)"), ("ln x", "log(x)"),
+    ("sqrtx", "sqrt(x)"), ("sin(x)", "sin(x)"), ("cos10tcotx", "cos(10t)cot(x)"),
+    ("sinh x", "sin(h) x"), ("cos x + tan y", "cos(x) + tan(y)"),
+])
+def test_insert_parens_after_func(expr, expected):
+    assert insert_parens_after_func(expr) == expected
+
+
+def test_insert_parens_after_func_matches_previous_rules():
+    rng = random.Random(1)
+    pieces = FUNCS + ["ln", "x", "y", "2x", "10t", " ", " ", "(", ")", "+", "*", "^2", "sinh", "e", "3"]
+    exprs = ["".join(rng.choice(pieces) for _ in range(rng.randint(1, 10))) for _ in range(20000)]
+    for expr in exprs:
+        assert insert_parens_after_func(expr) == reference_insert_parens_after_func(expr), expr
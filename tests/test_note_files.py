@@ -0,0 +1,98 @@
+import hashlib
+
+import pytest
+
+import app as app_module
+
+PDF = b"%PDF-1.5\n" + bytes(range(256)) * 8 + b"\n%%EOF\n"
+
+
+@pytest.fixture
+def docs(tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module, "DOCS_DIR", str(tmp_path))
+    monkeypatch.setattr(app_module, "FILE_OFFLOAD", "")
+    monkeypatch.setattr(app_module, "_file_etags", {})
+    (tmp_path / "notes_a.pdf").write_bytes(PDF)
+    (tmp_path / "notes_a.tex").write_text("\\documentclass{article}\n")
+    return tmp_path
+
+
+@pytest.fixture
+def client(docs):
+    return app_module.app.test_client()
+
+
+def etag_of(data):
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+def test_preview_sends_strong_etag(client):
+    response = client.get("/preview/notes_a")
+    assert response.status_code == 200
+    assert response.data == PDF
+    assert response.headers["ETag"] == f'"{etag_of(PDF)}"'
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert "no-cache" in response.headers["Cache-Control"]
+
+
+def test_if_none_match_answers_304(client):
+    response = client.get("/preview/notes_a", headers={"If-None-Match": f'"{etag_of(PDF)}"'})
+    assert response.status_code == 304
+    assert response.data == b""
+
+
+def test_versioned_url_is_immutable(client):
+    response = client.get(f"/preview/notes_a?v={etag_of(PDF)}")
+    cache_control = response.headers["Cache-Control"]
+    assert "immutable" in cache_control and f"max-age={app_module.NOTE_FILE_MAX_AGE}" in cache_control
+    # A stale version is revalidated instead
+    assert "no-cache" in client.get("/preview/notes_a?v=stale").headers["Cache-Control"]
+
+
+def test_range_answers_206(client):
+    response = client.get("/download/notes_a?type=pdf", headers={"Range": "bytes=9-18"})
+    assert response.status_code == 206
+    assert response.data == PDF[9:19]
+    assert response.headers["Content-Range"] == f"bytes 9-18/{len(PDF)}"
+
+
+def test_if_range_with_old_etag_sends_the_whole_file(client):
+    current = client.get("/preview/notes_a", headers={"Range": "bytes=0-3", "If-Range": f'"{etag_of(PDF)}"'})
+    assert current.status_code == 206 and current.data == PDF[:4]
+    stale = client.get("/preview/notes_a", headers={"Range": "bytes=0-3", "If-Range": '"0123"'})
+    assert stale.status_code == 200 and stale.data == PDF
+
+
+def test_recompiled_file_gets_a_new_etag(client, docs):
+    old = etag_of(PDF)
+    assert client.get("/preview/notes_a").headers["ETag"] == f'"{old}"'
+    rebuilt = PDF + b"% recompiled\n"
+    (docs / "notes_a.pdf").write_bytes(rebuilt)
+    response = client.get("/preview/notes_a", headers={"If-None-Match": f'"{old}"'})
+    assert response.status_code == 200
+    assert response.headers["ETag"] == f'"{etag_of(rebuilt)}"'
+
+
+def test_download_tex_as_attachment(client):
+    response = client.get("/download/notes_a")
+    assert response.status_code == 200
+    assert response.mimetype == "text/x-tex"
+    assert 'filename=notes_a.tex' in response.headers["Content-Disposition"]
+
+
+@pytest.mark.parametrize("url", ["/preview/notes_b", "/download/notes_b?type=pdf", "/preview/notes%20a"])
+def test_missing_or_invalid_notes_are_404(client, url):
+    assert client.get(url).status_code == 404
+
+
+def test_x_accel_offload(client, monkeypatch):
+    monkeypatch.setattr(app_module, "FILE_OFFLOAD", "x-accel")
+    response = client.get("/download/notes_a?type=pdf")
+    assert response.status_code == 200
+    assert response.data == b""
+    assert response.headers["X-Accel-Redirect"] == app_module.FILE_ACCEL_PREFIX + "notes_a.pdf"
+    assert response.headers["ETag"] == f'"{etag_of(PDF)}"'
+    assert 'filename="notes_a.pdf"' in response.headers["Content-Disposition"]
+    cached = client.get("/download/notes_a?type=pdf", headers={"If-None-Match": f'"{etag_of(PDF)}"'})
+    assert cached.status_code == 304
+    assert "X-Accel-Redirect" not in cached.headers
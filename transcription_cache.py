@@ -0,0 +1,121 @@
+# Content-addressed cache for vision transcriptions
+# Re-uploading the same blackboard photos (e.g. after a failed PDF compile) returns the
+# LaTeX from disk instead of paying for another GPT-4o vision call.
+
+import os
+import hashlib
+import threading
+from typing import Optional, Iterable, Dict, Any
+
+
+def make_cache_key(images: Iterable[bytes], system_prompt: str, instruction_text: str, model: str,
+                   details: Iterable[str] = ()) -> str:
+    """
+    sha256 over the model, both prompts, the hash of every (enhanced) image, in order,
+    and the vision detail level each image is sent with.
+    Each field is length-prefixed so different splits of the same bytes can't collide.
+    """
+    h = hashlib.sha256()
+    fields = [model.encode("utf-8"), system_prompt.encode("utf-8"), instruction_text.encode("utf-8")]
+    fields += [hashlib.sha256(img).digest() for img in images]
+    fields += [detail.encode("utf-8") for detail in details]
+    for field in fields:
+        h.update(len(field).to_bytes(8, "big"))
+        h.update(field)
+    return h.hexdigest()
+
+
+class TranscriptionCache:
+    """
+    On-disk LRU cache: one <key>.tex file per entry under cache_dir/<key[:2]>/.
+    Recency is the file mtime (bumped on every hit); once the cache grows past
+    max_bytes or max_entries the least recently used entries are deleted.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 200 * 1024 * 1024, max_entries: int = 10000):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._sizes: Optional[Dict[str, int]] = None  # path -> size, loaded lazily
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.tex")
+
+    def _load_index(self):
+        # Called with the lock held
+        if self._sizes is not None:
+            return
+        self._sizes = {}
+        if not os.path.isdir(self.cache_dir):
+            return
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".tex"):
+                    path = os.path.join(root, name)
+                    try:
+                        self._sizes[path] = os.path.getsize(path)
+                    except OSError:
+                        pass
+
+    def get(self, key: str) -> Optional[str]:
+        """Cached LaTeX for key, or None. A hit marks the entry as most recently used."""
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                latex = f.read()
+            os.utime(path, None)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return latex
+
+    def put(self, key: str, latex: str):
+        """Store LaTeX for key (atomically), then evict down to the size limits."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(latex)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._load_index()
+            self._sizes[path] = os.path.getsize(path)
+            self._evict()
+
+    def _evict(self):
+        # Called with the lock held
+        total = sum(self._sizes.values())
+        if total <= self.max_bytes and len(self._sizes) <= self.max_entries:
+            return
+        by_age = []
+        for path in self._sizes:
+            try:
+                by_age.append((os.path.getmtime(path), path))
+            except OSError:
+                by_age.append((0, path))
+        by_age.sort()
+        for _, path in by_age:
+            if total <= self.max_bytes and len(self._sizes) <= self.max_entries:
+                break
+            total -= self._sizes.pop(path)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._load_index()
+            return {
+                "entries": len(self._sizes),
+                "bytes": sum(self._sizes.values()),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }